@@ -0,0 +1,33 @@
+"""Runtime interval
+
+Revision ID: 9b1c2d3e4f50
+Revises: e627476917aa
+Create Date: 2021-02-08 10:12:44.318572
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b1c2d3e4f50'
+down_revision = 'e627476917aa'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('runtime_interval',
+                    sa.Column('block_from', sa.Integer(), autoincrement=False, nullable=False),
+                    sa.Column('block_to', sa.Integer(), nullable=False),
+                    sa.Column('spec_version', sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint('block_from')
+                    )
+    op.create_index(op.f('ix_runtime_interval_block_to'), 'runtime_interval', ['block_to'], unique=False)
+    op.create_index(op.f('ix_runtime_interval_spec_version'), 'runtime_interval', ['spec_version'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_runtime_interval_spec_version'), table_name='runtime_interval')
+    op.drop_index(op.f('ix_runtime_interval_block_to'), table_name='runtime_interval')
+    op.drop_table('runtime_interval')
@@ -0,0 +1,47 @@
+"""Harvester block range
+
+Revision ID: a4d2e6f81b93
+Revises: 9b1c2d3e4f50
+Create Date: 2021-02-15 14:03:27.905113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d2e6f81b93'
+down_revision = '9b1c2d3e4f50'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('harvester_block_range',
+                    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+                    sa.Column('block_from', sa.Integer(), nullable=False),
+                    sa.Column('block_to', sa.Integer(), nullable=False),
+                    sa.Column('checkpoint', sa.Integer(), nullable=True),
+                    sa.Column('status', sa.String(length=16), nullable=False),
+                    sa.Column('lease_owner', sa.String(length=128), nullable=True),
+                    sa.Column('lease_expires', sa.DateTime(), nullable=True),
+                    sa.Column('attempts', sa.Integer(), nullable=False),
+                    sa.Column('error', sa.String(length=255), nullable=True),
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.Column('updated_at', sa.DateTime(), nullable=False),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index(op.f('ix_harvester_block_range_block_from'), 'harvester_block_range', ['block_from'], unique=False)
+    op.create_index(op.f('ix_harvester_block_range_block_to'), 'harvester_block_range', ['block_to'], unique=False)
+    op.create_index(op.f('ix_harvester_block_range_status'), 'harvester_block_range', ['status'], unique=False)
+    op.create_index(
+        op.f('ix_harvester_block_range_lease_expires'), 'harvester_block_range', ['lease_expires'], unique=False
+    )
+
+
+def downgrade():
+    op.drop_index(op.f('ix_harvester_block_range_lease_expires'), table_name='harvester_block_range')
+    op.drop_index(op.f('ix_harvester_block_range_status'), table_name='harvester_block_range')
+    op.drop_index(op.f('ix_harvester_block_range_block_to'), table_name='harvester_block_range')
+    op.drop_index(op.f('ix_harvester_block_range_block_from'), table_name='harvester_block_range')
+    op.drop_table('harvester_block_range')
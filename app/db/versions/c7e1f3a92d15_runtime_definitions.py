@@ -0,0 +1,447 @@
+"""Runtime definitions stored once by content hash
+
+Revision ID: c7e1f3a92d15
+Revises: a4d2e6f81b93
+Create Date: 2021-02-22 10:41:08.316254
+
+"""
+import hashlib
+import json
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7e1f3a92d15'
+down_revision = 'a4d2e6f81b93'
+branch_labels = None
+depends_on = None
+
+# Rows per executemany when migrating existing definitions
+INSERT_BATCH_SIZE = 1000
+
+# Definition columns per kind, in the same form as RuntimeDefinitionWriter hashes them
+DEFINITION_COLUMNS = {
+    'call': ['call_id', 'name', 'documentation', 'count_params'],
+    'event': ['event_id', 'name', 'documentation', 'count_attributes'],
+    'storage': [
+        'storage_key', 'name', 'default', 'modifier', 'type_hasher', 'type_key1', 'type_key2', 'type_value',
+        'type_is_linked', 'type_key2hasher', 'documentation'
+    ],
+    'constant': ['name', 'type', 'value', 'documentation'],
+    'type': ['type_string', 'decoder_class', 'is_primitive_runtime', 'is_primitive_core']
+}
+
+OLD_TABLES = {
+    'call': 'runtime_call',
+    'event': 'runtime_event',
+    'storage': 'runtime_storage',
+    'constant': 'runtime_constant',
+    'type': 'runtime_type'
+}
+
+# Ids of migrated rows are kept, later rows use ids of runtime_definition_version which start above them. Params and
+# attributes get an id derived from the id of their call or event, calls and events have less than 256 of them.
+VIEWS = {
+    'runtime_call': """
+        SELECT COALESCE(v.legacy_id, v.id) AS id, v.spec_version, v.module_id, d.call_id, v.`index`, NULL AS prefix, NULL AS code, d.name,
+            v.lookup, d.documentation, d.count_params
+        FROM runtime_definition_version AS v
+        INNER JOIN runtime_call_definition AS d ON d.hash = v.definition_hash
+        WHERE v.kind = 'call'
+    """,
+    'runtime_call_param': """
+        SELECT COALESCE(v.legacy_id, v.id) * 256 + p.position AS id, COALESCE(v.legacy_id, v.id) AS runtime_call_id,
+            p.name, p.type
+        FROM runtime_definition_version AS v
+        INNER JOIN runtime_call_param_definition AS p ON p.call_hash = v.definition_hash
+        WHERE v.kind = 'call'
+    """,
+    'runtime_event': """
+        SELECT COALESCE(v.legacy_id, v.id) AS id, v.spec_version, v.module_id, d.event_id, v.`index`, NULL AS prefix, NULL AS code, d.name,
+            v.lookup, d.documentation, d.count_attributes
+        FROM runtime_definition_version AS v
+        INNER JOIN runtime_event_definition AS d ON d.hash = v.definition_hash
+        WHERE v.kind = 'event'
+    """,
+    'runtime_event_attribute': """
+        SELECT COALESCE(v.legacy_id, v.id) * 256 + a.`index` AS id, COALESCE(v.legacy_id, v.id) AS runtime_event_id,
+            a.`index`, a.type
+        FROM runtime_definition_version AS v
+        INNER JOIN runtime_event_attribute_definition AS a ON a.event_hash = v.definition_hash
+        WHERE v.kind = 'event'
+    """,
+    'runtime_storage': """
+        SELECT COALESCE(v.legacy_id, v.id) AS id, v.spec_version, v.module_id, d.storage_key, v.`index`, d.name, v.lookup, d.`default`, d.modifier,
+            d.type_hasher, d.type_key1, d.type_key2, d.type_value, d.type_is_linked, d.type_key2hasher,
+            d.documentation
+        FROM runtime_definition_version AS v
+        INNER JOIN runtime_storage_definition AS d ON d.hash = v.definition_hash
+        WHERE v.kind = 'storage'
+    """,
+    'runtime_constant': """
+        SELECT COALESCE(v.legacy_id, v.id) AS id, v.spec_version, v.module_id, v.`index`, d.name, d.type, d.value, d.documentation
+        FROM runtime_definition_version AS v
+        INNER JOIN runtime_constant_definition AS d ON d.hash = v.definition_hash
+        WHERE v.kind = 'constant'
+    """,
+    'runtime_type': """
+        SELECT COALESCE(v.legacy_id, v.id) AS id, v.spec_version, d.type_string, d.decoder_class, d.is_primitive_runtime, d.is_primitive_core
+        FROM runtime_definition_version AS v
+        INNER JOIN runtime_type_definition AS d ON d.hash = v.definition_hash
+        WHERE v.kind = 'type'
+    """
+}
+
+# Columns identifying a row of the old table in its view, the rows must match one to one
+VIEW_CHECK_COLUMNS = {
+    'runtime_call': ['id', 'spec_version', 'module_id', 'call_id'],
+    'runtime_call_param': ['runtime_call_id', 'name'],
+    'runtime_event': ['id', 'spec_version', 'module_id', 'event_id'],
+    'runtime_event_attribute': ['runtime_event_id', '`index`'],
+    'runtime_storage': ['id', 'spec_version', 'storage_key'],
+    'runtime_constant': ['id', 'spec_version', 'name'],
+    'runtime_type': ['id', 'spec_version', 'type_string']
+}
+
+
+def get_hash(kind, values):
+    # Copy of RuntimeDefinition.get_hash, so migrated definitions are shared with the ones harvested later
+    return hashlib.sha1(json.dumps([kind, values], sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def insert_rows(connection, table, rows):
+    for offset in range(0, len(rows), INSERT_BATCH_SIZE):
+        connection.execute(table.insert(), rows[offset:offset + INSERT_BATCH_SIZE])
+
+
+def migrate_definitions(connection):
+    version_table = sa.table(
+        'runtime_definition_version', *[sa.column(name) for name in [
+            'spec_version', 'kind', 'module_id', 'index', 'lookup', 'definition_hash', 'legacy_id'
+        ]]
+    )
+    param_table = sa.table(
+        'runtime_call_param_definition', *[sa.column(name) for name in ['call_hash', 'position', 'name', 'type']]
+    )
+    attribute_table = sa.table(
+        'runtime_event_attribute_definition', *[sa.column(name) for name in ['event_hash', 'index', 'type']]
+    )
+
+    # Params ordered as they were inserted, which is the order of the call arguments
+    params = {}
+    for row in connection.execute(
+            sa.text('SELECT runtime_call_id, name, type FROM runtime_call_param ORDER BY runtime_call_id, id')):
+        params.setdefault(row.runtime_call_id, []).append({'name': row.name, 'type': row.type})
+
+    attributes = {}
+    for row in connection.execute(sa.text(
+            'SELECT runtime_event_id, `index`, type FROM runtime_event_attribute ORDER BY runtime_event_id, `index`')):
+        attributes.setdefault(row.runtime_event_id, []).append({'index': row['index'], 'type': row.type})
+
+    for kind, columns in DEFINITION_COLUMNS.items():
+        definition_table = sa.table(
+            'runtime_{}_definition'.format(kind), *[sa.column(name) for name in ['hash'] + columns]
+        )
+
+        version_columns = ['id', 'spec_version']
+        if kind != 'type':
+            version_columns += ['module_id', '`index`']
+        if kind in ('call', 'event'):
+            version_columns.append('lookup')
+
+        definitions = []
+        param_rows = []
+        attribute_rows = []
+        version_rows = []
+        known_hashes = set()
+
+        for row in connection.execute(sa.text('SELECT {} FROM {} ORDER BY spec_version, id'.format(
+            ', '.join(version_columns + ['`{}`'.format(column) for column in columns]), OLD_TABLES[kind]
+        ))):
+            values = {
+                column: int(row[column]) if isinstance(row[column], bool) else row[column] for column in columns
+            }
+
+            if kind == 'call':
+                children = params.get(row.id, [])
+            elif kind == 'event':
+                children = attributes.get(row.id, [])
+            else:
+                children = []
+
+            definition_hash = get_hash(kind, [values, children])
+
+            if definition_hash not in known_hashes:
+                known_hashes.add(definition_hash)
+                definitions.append(dict(values, hash=definition_hash))
+
+                if kind == 'call':
+                    param_rows += [
+                        dict(child, call_hash=definition_hash, position=position)
+                        for position, child in enumerate(children)
+                    ]
+                elif kind == 'event':
+                    attribute_rows += [dict(child, event_hash=definition_hash) for child in children]
+
+            version_rows.append({
+                'spec_version': row.spec_version,
+                'kind': kind,
+                'module_id': row.module_id if kind != 'type' else None,
+                'index': row['index'] if kind != 'type' else None,
+                'lookup': row.lookup if kind in ('call', 'event') else None,
+                'definition_hash': definition_hash,
+                'legacy_id': row.id
+            })
+
+        insert_rows(connection, definition_table, definitions)
+        insert_rows(connection, param_table, param_rows)
+        insert_rows(connection, attribute_table, attribute_rows)
+        insert_rows(connection, version_table, version_rows)
+
+        print('Migrated {} {} definitions of {} spec version entries'.format(len(definitions), kind, len(version_rows)))
+
+
+def check_views(connection):
+    """
+    Compares the old tables with the queries of their views before the tables are dropped
+    """
+    for view_name, query in VIEWS.items():
+        old_count = connection.execute(sa.text('SELECT COUNT(*) FROM {}'.format(view_name))).scalar()
+
+        view_count, view_ids = connection.execute(sa.text(
+            'SELECT COUNT(*), COUNT(DISTINCT id) FROM ({}) AS view_rows'.format(query)
+        )).fetchone()
+
+        matched_count = connection.execute(sa.text(
+            'SELECT COUNT(*) FROM {} AS old_rows INNER JOIN ({}) AS view_rows ON {}'.format(
+                view_name, query, ' AND '.join(
+                    '(view_rows.{0} = old_rows.{0} OR view_rows.{0} IS NULL AND old_rows.{0} IS NULL)'.format(column)
+                    for column in VIEW_CHECK_COLUMNS[view_name]
+                )
+            )
+        )).scalar()
+
+        print('View {}: {} rows in table, {} rows in view, {} matched'.format(
+            view_name, old_count, view_count, matched_count
+        ))
+
+        if not old_count == view_count == view_ids == matched_count:
+            raise RuntimeError('Migrated rows of {} do not match the table'.format(view_name))
+
+
+def upgrade():
+    op.create_table('runtime_definition_version',
+                    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+                    sa.Column('spec_version', sa.Integer(), nullable=False),
+                    sa.Column('kind', sa.String(length=16), nullable=False),
+                    sa.Column('module_id', sa.String(length=64), nullable=True),
+                    sa.Column('index', sa.Integer(), nullable=True),
+                    sa.Column('lookup', sa.String(length=4), nullable=True),
+                    sa.Column('definition_hash', sa.String(length=40), nullable=False),
+                    sa.Column('legacy_id', sa.Integer(), nullable=True),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index(
+        'ix_runtime_definition_version_spec_version', 'runtime_definition_version',
+        ['spec_version', 'kind', 'module_id'], unique=False
+    )
+    op.create_index(
+        op.f('ix_runtime_definition_version_definition_hash'), 'runtime_definition_version', ['definition_hash'],
+        unique=False
+    )
+    op.create_table('runtime_call_definition',
+                    sa.Column('hash', sa.String(length=40), nullable=False),
+                    sa.Column('call_id', sa.String(length=64), nullable=False),
+                    sa.Column('name', sa.String(length=255), nullable=True),
+                    sa.Column('documentation', sa.Text(), nullable=True),
+                    sa.Column('count_params', sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint('hash')
+                    )
+    op.create_table('runtime_call_param_definition',
+                    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+                    sa.Column('call_hash', sa.String(length=40), nullable=False),
+                    sa.Column('position', sa.Integer(), nullable=False),
+                    sa.Column('name', sa.String(length=255), nullable=True),
+                    sa.Column('type', sa.String(length=255), nullable=True),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('call_hash', 'name')
+                    )
+    op.create_table('runtime_event_definition',
+                    sa.Column('hash', sa.String(length=40), nullable=False),
+                    sa.Column('event_id', sa.String(length=64), nullable=False),
+                    sa.Column('name', sa.String(length=255), nullable=True),
+                    sa.Column('documentation', sa.Text(), nullable=True),
+                    sa.Column('count_attributes', sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint('hash')
+                    )
+    op.create_table('runtime_event_attribute_definition',
+                    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+                    sa.Column('event_hash', sa.String(length=40), nullable=False),
+                    sa.Column('index', sa.Integer(), nullable=False),
+                    sa.Column('type', sa.String(length=255), nullable=True),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('event_hash', 'index')
+                    )
+    op.create_table('runtime_storage_definition',
+                    sa.Column('hash', sa.String(length=40), nullable=False),
+                    sa.Column('storage_key', sa.String(length=255), nullable=True),
+                    sa.Column('name', sa.String(length=255), nullable=True),
+                    sa.Column('default', mysql.LONGTEXT(), nullable=True),
+                    sa.Column('modifier', sa.String(length=64), nullable=True),
+                    sa.Column('type_hasher', sa.String(length=255), nullable=True),
+                    sa.Column('type_key1', sa.String(length=255), nullable=True),
+                    sa.Column('type_key2', sa.String(length=255), nullable=True),
+                    sa.Column('type_value', sa.String(length=255), nullable=True),
+                    sa.Column('type_is_linked', sa.SmallInteger(), nullable=True),
+                    sa.Column('type_key2hasher', sa.String(length=255), nullable=True),
+                    sa.Column('documentation', sa.Text(), nullable=True),
+                    sa.PrimaryKeyConstraint('hash')
+                    )
+    op.create_table('runtime_constant_definition',
+                    sa.Column('hash', sa.String(length=40), nullable=False),
+                    sa.Column('name', sa.String(length=255), nullable=True),
+                    sa.Column('type', sa.String(length=255), nullable=True),
+                    sa.Column('value', mysql.LONGTEXT(), nullable=True),
+                    sa.Column('documentation', sa.Text(), nullable=True),
+                    sa.PrimaryKeyConstraint('hash')
+                    )
+    op.create_table('runtime_type_definition',
+                    sa.Column('hash', sa.String(length=40), nullable=False),
+                    sa.Column('type_string', sa.String(length=255), nullable=True),
+                    sa.Column('decoder_class', sa.String(length=255), nullable=True),
+                    sa.Column('is_primitive_runtime', sa.Boolean(), nullable=True),
+                    sa.Column('is_primitive_core', sa.Boolean(), nullable=True),
+                    sa.PrimaryKeyConstraint('hash')
+                    )
+
+    connection = op.get_bind()
+
+    # Ids of new rows must not collide with the migrated ids exposed by the views
+    max_legacy_id = max(
+        connection.execute(sa.text('SELECT COALESCE(MAX(id), 0) FROM {}'.format(table_name))).scalar()
+        for table_name in OLD_TABLES.values()
+    )
+    op.execute('ALTER TABLE runtime_definition_version AUTO_INCREMENT = {}'.format(max_legacy_id + 1))
+
+    migrate_definitions(connection)
+    check_views(connection)
+
+    for table_name in VIEWS:
+        op.drop_table(table_name)
+
+    for view_name, query in VIEWS.items():
+        op.execute('CREATE VIEW {} AS {}'.format(view_name, query))
+
+
+def downgrade():
+    for view_name in VIEWS:
+        op.execute('DROP VIEW {}'.format(view_name))
+
+    op.create_table('runtime_call',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('spec_version', sa.Integer(), nullable=False),
+                    sa.Column('module_id', sa.String(length=64), nullable=False),
+                    sa.Column('call_id', sa.String(length=64), nullable=False),
+                    sa.Column('index', sa.Integer(), nullable=False),
+                    sa.Column('prefix', sa.String(length=255), nullable=True),
+                    sa.Column('code', sa.String(length=255), nullable=True),
+                    sa.Column('name', sa.String(length=255), nullable=True),
+                    sa.Column('lookup', sa.String(length=4), nullable=True),
+                    sa.Column('documentation', sa.Text(), nullable=True),
+                    sa.Column('count_params', sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('spec_version', 'module_id', 'call_id')
+                    )
+    op.create_index(op.f('ix_runtime_call_lookup'), 'runtime_call', ['lookup'], unique=False)
+    op.create_table('runtime_call_param',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('runtime_call_id', sa.Integer(), nullable=False),
+                    sa.Column('name', sa.String(length=255), nullable=True),
+                    sa.Column('type', sa.String(length=255), nullable=True),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('runtime_call_id', 'name')
+                    )
+    op.create_table('runtime_event',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('spec_version', sa.Integer(), nullable=False),
+                    sa.Column('module_id', sa.String(length=64), nullable=False),
+                    sa.Column('event_id', sa.String(length=64), nullable=False),
+                    sa.Column('index', sa.Integer(), nullable=False),
+                    sa.Column('prefix', sa.String(length=255), nullable=True),
+                    sa.Column('code', sa.String(length=255), nullable=True),
+                    sa.Column('name', sa.String(length=255), nullable=True),
+                    sa.Column('lookup', sa.String(length=4), nullable=True),
+                    sa.Column('documentation', sa.Text(), nullable=True),
+                    sa.Column('count_attributes', sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('spec_version', 'module_id', 'event_id')
+                    )
+    op.create_index(op.f('ix_runtime_event_lookup'), 'runtime_event', ['lookup'], unique=False)
+    op.create_table('runtime_event_attribute',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('runtime_event_id', sa.Integer(), nullable=False),
+                    sa.Column('index', sa.Integer(), nullable=False),
+                    sa.Column('type', sa.String(length=255), nullable=True),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('runtime_event_id', 'index')
+                    )
+    op.create_table('runtime_storage',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('spec_version', sa.Integer(), nullable=True),
+                    sa.Column('module_id', sa.String(length=64), nullable=True),
+                    sa.Column('storage_key', sa.String(length=255), nullable=True),
+                    sa.Column('index', sa.Integer(), nullable=True),
+                    sa.Column('name', sa.String(length=255), nullable=True),
+                    sa.Column('lookup', sa.String(length=4), nullable=True),
+                    sa.Column('default', mysql.LONGTEXT(), nullable=True),
+                    sa.Column('modifier', sa.String(length=64), nullable=True),
+                    sa.Column('type_hasher', sa.String(length=255), nullable=True),
+                    sa.Column('type_key1', sa.String(length=255), nullable=True),
+                    sa.Column('type_key2', sa.String(length=255), nullable=True),
+                    sa.Column('type_value', sa.String(length=255), nullable=True),
+                    sa.Column('type_is_linked', sa.SmallInteger(), nullable=True),
+                    sa.Column('type_key2hasher', sa.String(length=255), nullable=True),
+                    sa.Column('documentation', sa.Text(), nullable=True),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index(op.f('ix_runtime_storage_lookup'), 'runtime_storage', ['lookup'], unique=False)
+    op.create_table('runtime_constant',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('spec_version', sa.Integer(), nullable=True),
+                    sa.Column('module_id', sa.String(length=64), nullable=True),
+                    sa.Column('index', sa.Integer(), nullable=True),
+                    sa.Column('name', sa.String(length=255), nullable=True),
+                    sa.Column('type', sa.String(length=255), nullable=True),
+                    sa.Column('value', mysql.LONGTEXT(), nullable=True),
+                    sa.Column('documentation', sa.Text(), nullable=True),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index(op.f('ix_runtime_constant_name'), 'runtime_constant', ['name'], unique=False)
+    op.create_table('runtime_type',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('spec_version', sa.Integer(), nullable=False),
+                    sa.Column('type_string', sa.String(length=255), nullable=True),
+                    sa.Column('decoder_class', sa.String(length=255), nullable=True),
+                    sa.Column('is_primitive_runtime', sa.Boolean(), nullable=True),
+                    sa.Column('is_primitive_core', sa.Boolean(), nullable=True),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('spec_version', 'type_string')
+                    )
+
+    # Rows of the views become the per spec version rows again, with the ids the views exposed
+    for table_name, query in VIEWS.items():
+        op.execute('INSERT INTO {} {}'.format(table_name, query))
+
+    op.drop_table('runtime_type_definition')
+    op.drop_table('runtime_constant_definition')
+    op.drop_table('runtime_storage_definition')
+    op.drop_table('runtime_event_attribute_definition')
+    op.drop_table('runtime_event_definition')
+    op.drop_table('runtime_call_param_definition')
+    op.drop_table('runtime_call_definition')
+    op.drop_index(op.f('ix_runtime_definition_version_definition_hash'), table_name='runtime_definition_version')
+    op.drop_index('ix_runtime_definition_version_spec_version', table_name='runtime_definition_version')
+    op.drop_table('runtime_definition_version')
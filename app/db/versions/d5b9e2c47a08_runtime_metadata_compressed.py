@@ -0,0 +1,70 @@
+"""Runtime metadata compressed
+
+Revision ID: d5b9e2c47a08
+Revises: c7e1f3a92d15
+Create Date: 2021-03-01 09:27:51.640378
+
+"""
+import json
+import zlib
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5b9e2c47a08'
+down_revision = 'c7e1f3a92d15'
+branch_labels = None
+depends_on = None
+
+METADATA_COLUMNS = ['json_metadata', 'json_metadata_decoded']
+
+
+def convert_rows(connection, source_columns, target_columns, convert):
+    # One runtime at a time, a decoded metadata can be several MB
+    for row in connection.execute(sa.text('SELECT id FROM runtime ORDER BY id')).fetchall():
+        values = connection.execute(
+            sa.text('SELECT {} FROM runtime WHERE id = :id'.format(', '.join(source_columns))), id=row.id
+        ).fetchone()
+
+        connection.execute(
+            sa.text('UPDATE runtime SET {} WHERE id = :id'.format(
+                ', '.join('{0} = :{0}'.format(column) for column in target_columns)
+            )),
+            id=row.id,
+            **{target: convert(values[source]) for source, target in zip(source_columns, target_columns)}
+        )
+
+
+def compress(value):
+    # Same format as app.models.base.compress_json
+    if value is not None:
+        return zlib.compress(json.dumps(json.loads(value), separators=(',', ':')).encode())
+
+
+def decompress(data):
+    if data is not None:
+        return zlib.decompress(data).decode()
+
+
+def replace_columns(connection, column_type, convert):
+    for column in METADATA_COLUMNS:
+        op.add_column('runtime', sa.Column('{}_new'.format(column), column_type, nullable=True))
+
+    convert_rows(connection, METADATA_COLUMNS, ['{}_new'.format(column) for column in METADATA_COLUMNS], convert)
+
+    for column in METADATA_COLUMNS:
+        op.drop_column('runtime', column)
+        op.alter_column('runtime', '{}_new'.format(column), new_column_name=column,
+                        existing_type=column_type,
+                        existing_nullable=True)
+
+
+def upgrade():
+    replace_columns(op.get_bind(), mysql.LONGBLOB(), compress)
+
+
+def downgrade():
+    replace_columns(op.get_bind(), mysql.JSON(), decompress)
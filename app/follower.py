@@ -0,0 +1,206 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  follower.py
+
+import json
+from time import sleep
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import sessionmaker, scoped_session
+from websocket import create_connection, WebSocketException
+
+from app import settings
+from app.processors.converters import PolkascanHarvesterService, BlockAlreadyAdded
+from app.tasks import accumulate_block_recursive, QUEUE_TIP
+
+
+class HeadFollower(object):
+    """
+    Long running process that subscribes to new or finalised heads over WebSocket and adds every announced block.
+
+    Blocks are added from the announced head following parent hashes until an already added block is reached, so a
+    gap caused by a reconnect is filled by the first head after it. Gaps larger than `max_gap` are handed over to a
+    `accumulate_block_recursive` task.
+    """
+
+    def __init__(self, url, finalized_heads=True, on_head=None, max_gap=None, reconnect_delay=1,
+                 max_reconnect_delay=30):
+        self.url = url
+        self.finalized_heads = finalized_heads
+        self.on_head = on_head or self.add_head
+        self.max_gap = max_gap or settings.FOLLOWER_MAX_GAP
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+
+        self.websocket = None
+        self.subscription_id = None
+        self.request_id = 1
+        self.running = False
+
+        self.db_session = None
+        self.harvester = None
+
+    def connect(self):
+        self.websocket = create_connection(self.url)
+
+        if self.finalized_heads:
+            method = 'chain_subscribeFinalizedHeads'
+        else:
+            method = 'chain_subscribeNewHeads'
+
+        self.websocket.send(json.dumps({
+            "jsonrpc": "2.0",
+            "method": method,
+            "params": [],
+            "id": self.request_id
+        }))
+
+        # Wait for subscription confirmation, notifications can only arrive after it
+        while True:
+            message = json.loads(self.websocket.recv())
+
+            if message.get('id') == self.request_id:
+                if 'error' in message:
+                    raise WebSocketException('Subscription failed: {}'.format(message['error']))
+
+                self.subscription_id = message['result']
+                break
+
+        self.request_id += 1
+
+        print('Follower: subscribed to {} ({})'.format(method, self.subscription_id))
+
+    def close(self):
+        if self.websocket:
+            try:
+                self.websocket.close()
+            except WebSocketException:
+                pass
+
+        self.websocket = None
+        self.subscription_id = None
+
+    def stop(self):
+        self.running = False
+        self.close()
+
+    def run(self):
+        self.running = True
+        delay = self.reconnect_delay
+
+        while self.running:
+            try:
+                self.connect()
+                delay = self.reconnect_delay
+
+                while self.running:
+                    message = json.loads(self.websocket.recv())
+
+                    params = message.get('params') or {}
+
+                    if params.get('subscription') == self.subscription_id and params.get('result'):
+                        self.on_head(params['result'])
+
+            except (WebSocketException, ConnectionError, OSError, ValueError) as e:
+                if not self.running:
+                    break
+
+                print('! Follower: connection lost ({}), reconnecting in {}s'.format(e, delay))
+                self.close()
+                sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+
+            except SQLAlchemyError as e:
+                # Database unavailable, heads announced in the meantime are added as gap of the next head
+                self.rollback()
+
+                if not self.running:
+                    break
+
+                print('! Follower: database error ({}), reconnecting in {}s'.format(e, delay))
+                self.close()
+                sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+
+    def rollback(self):
+        if self.db_session:
+            try:
+                self.db_session.rollback()
+            except SQLAlchemyError as e:
+                print('! Follower: rollback failed ({})'.format(e))
+
+    def init_harvester(self):
+        engine = create_engine(
+            settings.DB_CONNECTION, echo=settings.DEBUG, isolation_level="READ_UNCOMMITTED", pool_pre_ping=True
+        )
+        session_factory = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+        self.db_session = scoped_session(session_factory)
+
+        self.harvester = PolkascanHarvesterService(
+            db_session=self.db_session,
+            type_registry=settings.TYPE_REGISTRY,
+            type_registry_file=settings.TYPE_REGISTRY_FILE
+        )
+
+    def add_head(self, header):
+
+        if not self.harvester:
+            self.init_harvester()
+
+        block_number = int(header['number'], 16)
+
+        # Not using get_block_hash(), its cache could return a hash of a retracted fork
+        block_hash = self.harvester.substrate.rpc_request('chain_getBlockHash', [block_number]).get('result')
+
+        for nr in range(0, self.max_gap):
+            try:
+                if settings.BLOCK_FETCH_WINDOW > 1 and not self.harvester.substrate.is_prefetched(block_hash):
+                    self.harvester.substrate.prefetch_blocks(
+                        block_hash, min(settings.BLOCK_FETCH_WINDOW, self.max_gap - nr)
+                    )
+
+                block = self.harvester.add_block(block_hash)
+                self.db_session.commit()
+
+                print('+ Added {} '.format(block_hash))
+
+            except (BlockAlreadyAdded, IntegrityError):
+                self.db_session.rollback()
+                return
+            except Exception as e:
+                self.db_session.rollback()
+                print('! ERROR adding {}: {}'.format(block_hash, e))
+                return
+
+            if block.id == 0:
+                return
+
+            block_hash = block.parent_hash
+
+        # Gap too large to fill in between heads
+        print('Follower: gap larger than {} blocks, continue from {} in task'.format(self.max_gap, block_hash))
+        accumulate_block_recursive.apply_async((block_hash,), queue=QUEUE_TIP)
+
+
+if __name__ == '__main__':
+    HeadFollower(
+        url=settings.SUBSTRATE_WS_URL,
+        finalized_heads=settings.FINALIZATION_ONLY == 1
+    ).run()
@@ -31,7 +31,8 @@ from app.middleware.sessionmanager import SQLAlchemySessionManager
 from app.resources.harvester import PolkascanStartHarvesterResource, PolkascanStopHarvesterResource, \
     PolkascanHarvesterStatusResource, PolkascanProcessBlockResource, \
     PolkaScanCheckHarvesterTaskResource, SequenceBlockResource, StartSequenceBlockResource, StartIntegrityResource, \
-    RebuildSearchIndexResource, ProcessGenesisBlockResource, PolkascanHarvesterQueueResource, RebuildAccountInfoResource
+    RebuildSearchIndexResource, ProcessGenesisBlockResource, PolkascanHarvesterQueueResource, RebuildAccountInfoResource, \
+    RPCEndpointsResource, ReprocessBlocksResource
 from app.resources.tools import ExtractMetadataResource, ExtractExtrinsicsResource, \
     HealthCheckResource, ExtractEventsResource, CreateSnapshotResource
 
@@ -49,6 +50,7 @@ app.add_route('/start', PolkascanStartHarvesterResource())
 app.add_route('/stop', PolkascanStopHarvesterResource())
 app.add_route('/status', PolkascanHarvesterStatusResource())
 app.add_route('/queue', PolkascanHarvesterQueueResource())
+app.add_route('/rpc-endpoints', RPCEndpointsResource())
 app.add_route('/process', PolkascanProcessBlockResource())
 app.add_route('/sequence', SequenceBlockResource())
 app.add_route('/sequencer/start', StartSequenceBlockResource())
@@ -56,6 +58,7 @@ app.add_route('/integrity-check', StartIntegrityResource())
 app.add_route('/process-genesis', ProcessGenesisBlockResource())
 app.add_route('/rebuild-searchindex', RebuildSearchIndexResource())
 app.add_route('/rebuild-balances', RebuildAccountInfoResource())
+app.add_route('/reprocess', ReprocessBlocksResource())
 app.add_route('/task/result/{task_id}', PolkaScanCheckHarvesterTaskResource())
 
 app.add_route('/tools/metadata/extract', ExtractMetadataResource())
@@ -18,8 +18,301 @@
 #
 #  base.py
 
+import json
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
 from dictalchemy import DictableModel
+from sqlalchemy import inspect, event, Integer
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Query, Session
+
+
+def get_autoincrement_column(table):
+    """
+    :return: primary key column with database generated values, None if the table has none
+    """
+    columns = list(table.primary_key.columns)
+
+    for column in columns:
+        if column.autoincrement is True:
+            return column
+
+    # Same as SQLAlchemy for autoincrement='auto', only a single integer column without foreign key
+    if len(columns) == 1 and columns[0].autoincrement == 'auto' and isinstance(columns[0].type, Integer) and \
+            not columns[0].foreign_keys:
+        return columns[0]
+
+
+def get_row_values(obj):
+    """
+    Column values of a new model object for a Core INSERT. Python side scalar defaults are applied (normally done
+    during flush), autoincrement primary keys without value are omitted.
+
+    :return: dict of values by column key
+    """
+    values = {}
+    autoincrement_column = get_autoincrement_column(obj.__table__)
+
+    for column in obj.__table__.columns:
+        value = getattr(obj, column.key)
+
+        if value is None:
+            if column is autoincrement_column:
+                # Generated by database, assigned after insert
+                continue
+
+            if column.default is not None and column.default.is_scalar:
+                value = column.default.arg
+                setattr(obj, column.key, value)
+
+        values[column.key] = value
+
+    return values
+
+
+def get_upsert_statement(table, columns):
+    """
+    MySQL `INSERT ... ON DUPLICATE KEY UPDATE` of given columns, rows that already exist are replaced by the new values
+
+    :param table:
+    :param columns: keys of the inserted columns
+    """
+    statement = mysql_insert(table)
+
+    update_columns = {
+        column: statement.inserted[column] for column in columns if not table.columns[column].primary_key
+    }
+
+    if not update_columns:
+        return table.insert().prefix_with('IGNORE')
+
+    return statement.on_duplicate_key_update(**update_columns)
+
+
+def supports_upsert(session):
+    return session.get_bind().dialect.name == 'mysql'
+
+
+def upsert(session, table, rows):
+    """
+    Inserts rows or replaces existing rows with the same primary key, only supported on MySQL
+    """
+    if rows:
+        session.execute(get_upsert_statement(table, list(rows[0].keys())), rows)
+
+
+def has_consecutive_autoincrement(session):
+    """
+    InnoDB allocates consecutive autoincrement values to the rows of one multi-row INSERT when
+    innodb_autoinc_lock_mode is 0 (traditional) or 1 (consecutive), with 2 (interleaved, the MySQL 8 default) values of
+    concurrent inserts can interleave
+
+    :return: True if ids of a multi-row INSERT can be derived from LAST_INSERT_ID()
+    """
+    if 'consecutive_autoincrement' not in session.info:
+        session.info['consecutive_autoincrement'] = supports_upsert(session) and \
+            session.execute('SELECT @@innodb_autoinc_lock_mode').scalar() in (0, 1)
+
+    return session.info['consecutive_autoincrement']
+
+
+def insert_ignore(session, table, row):
+    """
+    Inserts row if no row with the same primary key exists, only supported on MySQL
+
+    :return: True if row is inserted
+    """
+    return session.execute(table.insert().prefix_with('IGNORE'), row).rowcount > 0
+
+
+class BulkWriter(object):
+    """
+    Collects new objects of the given model classes instead of flushing them one by one, `flush()` inserts them per
+    table with one executemany. Attached to a session with `bulk_insert()`, `BaseModelObj.save()` hands over objects.
+
+    With `upsert` rows of tables without autoincrement primary key replace existing rows, so writing the same block
+    twice is harmless.
+
+    Generated autoincrement ids are assigned to the objects. On MySQL with innodb_autoinc_lock_mode 0 or 1 they are
+    derived from LAST_INSERT_ID() of multi-row INSERTs, otherwise these rows are inserted one by one.
+    """
+
+    # Rows per multi-row INSERT of a table with autoincrement id
+    MAX_INSERT_ROWS = 1000
+
+    def __init__(self, models, upsert=False):
+        self.models = tuple(models)
+        self.upsert = upsert
+        self.rows = OrderedDict()
+        self.objects = OrderedDict()
+
+    def accepts(self, obj):
+        # Only new objects, changes of persistent objects are still flushed by the session
+        return isinstance(obj, self.models) and inspect(obj).transient
+
+    def add(self, obj):
+        table = obj.__table__
+        values = get_row_values(obj)
+
+        # Executemany requires the same columns for every row
+        key = (table, tuple(values.keys()))
+
+        self.rows.setdefault(key, []).append(values)
+        self.objects.setdefault(key, []).append(obj)
+
+    def get_insert_statement(self, table, columns):
+        if self.upsert and get_autoincrement_column(table) is None:
+            return get_upsert_statement(table, columns)
+
+        return table.insert()
+
+    def insert_autoincrement(self, session, table, column, rows, objects):
+        if has_consecutive_autoincrement(session):
+            for offset in range(0, len(rows), self.MAX_INSERT_ROWS):
+                # One statement, LAST_INSERT_ID() is the id of its first row
+                result = session.execute(table.insert().values(rows[offset:offset + self.MAX_INSERT_ROWS]))
+
+                for idx, obj in enumerate(objects[offset:offset + self.MAX_INSERT_ROWS]):
+                    setattr(obj, column.key, result.lastrowid + idx)
+        else:
+            for row, obj in zip(rows, objects):
+                setattr(obj, column.key, session.execute(table.insert(), row).lastrowid)
+
+    def flush(self, session):
+        for key, rows in self.rows.items():
+            table, columns = key
+
+            autoincrement_column = get_autoincrement_column(table)
+
+            if autoincrement_column is not None and autoincrement_column.key not in columns:
+                self.insert_autoincrement(session, table, autoincrement_column, rows, self.objects[key])
+            else:
+                session.execute(self.get_insert_statement(table, columns), rows)
+
+        self.rows = OrderedDict()
+        self.objects = OrderedDict()
+
+
+@contextmanager
+def bulk_insert(session, models, upsert=False):
+    """
+    Collects objects of `models` saved within the context and inserts them at exit. Objects are not added to the
+    session, use `flush_bulk_insert()` before querying them. Autoincrement ids are assigned to the objects at flush.
+    """
+    bulk_writer = BulkWriter(models, upsert=upsert)
+    previous_writer = session.info.get('bulk_writer')
+
+    session.info['bulk_writer'] = bulk_writer
+
+    try:
+        yield bulk_writer
+        bulk_writer.flush(session)
+    finally:
+        session.info['bulk_writer'] = previous_writer
+
+
+def flush_bulk_insert(session):
+    bulk_writer = session.info.get('bulk_writer')
+
+    if bulk_writer:
+        bulk_writer.flush(session)
+
+
+@contextmanager
+def deferred_flush(session):
+    """
+    Unit of work mode in which `BaseModelObj.save()` only adds objects to the session. Pending objects are flushed by
+    autoflush when a query needs them, before bulk updates and deletes, and at exit.
+
+    :return: dict with counts of deferred saves, performed flushes and flushes avoided
+    """
+    stats = {'saves': 0, 'flushes': 0, 'flushes_avoided': 0}
+    previous_stats = session.info.get('deferred_flush')
+    previous_autoflush = session.autoflush
+
+    session.info['deferred_flush'] = stats
+    session.autoflush = True
+
+    try:
+        yield stats
+        session.flush()
+    finally:
+        stats['flushes_avoided'] = max(stats['saves'] - stats['flushes'], 0)
+        session.autoflush = previous_autoflush
+        session.info['deferred_flush'] = previous_stats
+
+
+@event.listens_for(Session, 'after_flush')
+def count_deferred_flush(session, flush_context):
+    stats = session.info.get('deferred_flush')
+
+    if stats is not None:
+        stats['flushes'] += 1
+
+
+@event.listens_for(Query, 'before_compile_update')
+@event.listens_for(Query, 'before_compile_delete')
+def flush_before_bulk_statement(query, context):
+    # Query.update() and Query.delete() don't autoflush, pending rows must be in the database first
+    if query.session is not None and query.session.info.get('deferred_flush') is not None:
+        query.session.flush()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def count_rows_written(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and (context.isinsert or context.isupdate or context.isdelete) and cursor.rowcount > 0:
+        conn.info['rows_written'] = conn.info.get('rows_written', 0) + cursor.rowcount
+
+
+def pop_rows_written(session):
+    """
+    :return: amount of rows inserted, updated or deleted on the connection of the session since the previous call
+    """
+    return session.connection().info.pop('rows_written', 0)
+
+
+def compress_json(value):
+    if value is not None:
+        return zlib.compress(json.dumps(value, separators=(',', ':')).encode())
+
+
+def decompress_json(data):
+    if data is not None:
+        return json.loads(zlib.decompress(data).decode())
+
+
+class CompressedJSON(object):
+    """
+    JSON value stored zlib compressed in the binary column attribute `data_attribute`. Decompressed on first access
+    and kept until the column attribute changes, combine with a deferred column so loads that don't need the value
+    don't select the data.
+    """
+
+    def __init__(self, data_attribute):
+        self.data_attribute = data_attribute
+        self.cache_key = '_{}_value'.format(data_attribute)
+
+    def __get__(self, obj, owner):
+        if obj is None:
+            return self
+
+        data = getattr(obj, self.data_attribute)
+        cached = obj.__dict__.get(self.cache_key)
+
+        if cached is None or cached[0] is not data:
+            cached = (data, decompress_json(data))
+            obj.__dict__[self.cache_key] = cached
+
+        return cached[1]
+
+    def __set__(self, obj, value):
+        data = compress_json(value)
+        setattr(obj, self.data_attribute, data)
+        obj.__dict__[self.cache_key] = (data, value)
 
 
 class BaseModelObj(DictableModel):
@@ -27,7 +320,20 @@ class BaseModelObj(DictableModel):
     serialize_exclude = None
 
     def save(self, session):
+        bulk_writer = session.info.get('bulk_writer')
+
+        if bulk_writer and bulk_writer.accepts(self):
+            bulk_writer.add(self)
+            return
+
         session.add(self)
+
+        deferred_flush_stats = session.info.get('deferred_flush')
+
+        if deferred_flush_stats is not None:
+            deferred_flush_stats['saves'] += 1
+            return
+
         session.flush()
 
     @property
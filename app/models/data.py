@@ -18,12 +18,15 @@
 #
 #  data.py
 
+import hashlib
+import json
+
 import sqlalchemy as sa
 from sqlalchemy import text
-from sqlalchemy.dialects.mysql import LONGTEXT
-from sqlalchemy.orm import relationship
+from sqlalchemy.dialects.mysql import LONGTEXT, LONGBLOB
+from sqlalchemy.orm import relationship, deferred
 
-from app.models.base import BaseModel
+from app.models.base import BaseModel, CompressedJSON
 
 
 class Block(BaseModel):
@@ -394,7 +397,7 @@ class Contract(BaseModel):
 class Runtime(BaseModel):
     __tablename__ = 'runtime'
 
-    serialize_exclude = ['json_metadata', 'json_metadata_decoded']
+    serialize_exclude = ['json_metadata_data', 'json_metadata_decoded_data']
 
     id = sa.Column(sa.Integer(), primary_key=True, autoincrement=False)
     impl_name = sa.Column(sa.String(255))
@@ -403,8 +406,9 @@ class Runtime(BaseModel):
     spec_name = sa.Column(sa.String(255))
     authoring_version = sa.Column(sa.Integer())
     apis = sa.Column(sa.JSON(), default=None, server_default=None, nullable=True)
-    json_metadata = sa.Column(sa.JSON(), default=None, server_default=None, nullable=True)
-    json_metadata_decoded = sa.Column(sa.JSON(), default=None, server_default=None, nullable=True)
+    # Metadata hex and decoded metadata, zlib compressed and only selected when accessed
+    json_metadata_data = deferred(sa.Column('json_metadata', LONGBLOB(), nullable=True))
+    json_metadata_decoded_data = deferred(sa.Column('json_metadata_decoded', LONGBLOB(), nullable=True))
     count_modules = sa.Column(sa.Integer(), default=0, nullable=False)
     count_call_functions = sa.Column(sa.Integer(), default=0, nullable=False)
     count_storage_functions = sa.Column(sa.Integer(), default=0, nullable=False)
@@ -412,10 +416,24 @@ class Runtime(BaseModel):
     count_constants = sa.Column(sa.Integer(), nullable=False, server_default='0')
     count_errors = sa.Column(sa.Integer(), nullable=False, server_default='0')
 
+    json_metadata = CompressedJSON('json_metadata_data')
+    json_metadata_decoded = CompressedJSON('json_metadata_decoded_data')
+
     def serialize_id(self):
         return self.spec_version
 
 
+class RuntimeInterval(BaseModel):
+    __tablename__ = 'runtime_interval'
+
+    block_from = sa.Column(sa.Integer(), primary_key=True, autoincrement=False)
+    block_to = sa.Column(sa.Integer(), nullable=False, index=True)
+    spec_version = sa.Column(sa.Integer(), nullable=False, index=True)
+
+    def serialize_id(self):
+        return self.block_from
+
+
 class RuntimeModule(BaseModel):
     __tablename__ = 'runtime_module'
     __table_args__ = (sa.UniqueConstraint('spec_version', 'module_id'),)
@@ -440,6 +458,7 @@ class RuntimeModule(BaseModel):
 
 
 class RuntimeCall(BaseModel):
+    # Compatibility view of RuntimeCallDefinition per spec version
     __tablename__ = 'runtime_call'
     __table_args__ = (sa.UniqueConstraint('spec_version', 'module_id', 'call_id'),)
 
@@ -460,6 +479,7 @@ class RuntimeCall(BaseModel):
 
 
 class RuntimeCallParam(BaseModel):
+    # Compatibility view, `id` is derived from the call id and the position of the param
     __tablename__ = 'runtime_call_param'
     __table_args__ = (sa.UniqueConstraint('runtime_call_id', 'name'),)
 
@@ -470,6 +490,7 @@ class RuntimeCallParam(BaseModel):
 
 
 class RuntimeEvent(BaseModel):
+    # Compatibility view of RuntimeEventDefinition per spec version
     __tablename__ = 'runtime_event'
     __table_args__ = (sa.UniqueConstraint('spec_version', 'module_id', 'event_id'),)
 
@@ -490,6 +511,7 @@ class RuntimeEvent(BaseModel):
 
 
 class RuntimeEventAttribute(BaseModel):
+    # Compatibility view, `id` is derived from the event id and the index of the attribute
     __tablename__ = 'runtime_event_attribute'
     __table_args__ = (sa.UniqueConstraint('runtime_event_id', 'index'),)
 
@@ -500,6 +522,7 @@ class RuntimeEventAttribute(BaseModel):
 
 
 class RuntimeStorage(BaseModel):
+    # Compatibility view of RuntimeStorageDefinition per spec version
     __tablename__ = 'runtime_storage'
 
     id = sa.Column(sa.Integer(), primary_key=True)
@@ -530,6 +553,7 @@ class RuntimeStorage(BaseModel):
 
 
 class RuntimeConstant(BaseModel):
+    # Compatibility view of RuntimeConstantDefinition per spec version
     __tablename__ = 'runtime_constant'
 
     id = sa.Column(sa.Integer(), primary_key=True)
@@ -561,6 +585,7 @@ class RuntimeErrorMessage(BaseModel):
 
 
 class RuntimeType(BaseModel):
+    # Compatibility view of RuntimeTypeDefinition per spec version
     __tablename__ = 'runtime_type'
     __table_args__ = (sa.UniqueConstraint('spec_version', 'type_string'),)
 
@@ -572,6 +597,120 @@ class RuntimeType(BaseModel):
     is_primitive_core = sa.Column(sa.Boolean(), default=False)
 
 
+class RuntimeDefinitionVersion(BaseModel):
+    """
+    Definition of a call, event, storage function, constant or type contained in a spec version
+    """
+    __tablename__ = 'runtime_definition_version'
+    __table_args__ = (sa.Index('ix_runtime_definition_version_spec_version', 'spec_version', 'kind', 'module_id'),)
+
+    KIND_CALL = 'call'
+    KIND_EVENT = 'event'
+    KIND_STORAGE = 'storage'
+    KIND_CONSTANT = 'constant'
+    KIND_TYPE = 'type'
+
+    id = sa.Column(sa.Integer(), primary_key=True)
+    spec_version = sa.Column(sa.Integer(), nullable=False)
+    kind = sa.Column(sa.String(16), nullable=False)
+    module_id = sa.Column(sa.String(64))
+    index = sa.Column(sa.Integer())
+    lookup = sa.Column(sa.String(4))
+    definition_hash = sa.Column(sa.String(40), nullable=False, index=True)
+    # Id of the migrated row of runtime_call, runtime_event etc., the compatibility views keep exposing it
+    legacy_id = sa.Column(sa.Integer())
+
+
+class RuntimeDefinition(object):
+    """
+    Runtime definition stored once for all spec versions containing it, identified by the hash of its content
+    """
+
+    hash = sa.Column(sa.String(40), primary_key=True, autoincrement=False)
+
+    @staticmethod
+    def get_hash(kind, values):
+        """
+        :param kind: one of the RuntimeDefinitionVersion kinds
+        :param values: JSON serializable content of the definition, including its params or attributes
+        :return: hex SHA-1 hash
+        """
+        return hashlib.sha1(json.dumps([kind, values], sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+class RuntimeCallDefinition(RuntimeDefinition, BaseModel):
+    __tablename__ = 'runtime_call_definition'
+
+    call_id = sa.Column(sa.String(64), nullable=False)
+    name = sa.Column(sa.String(255))
+    documentation = sa.Column(sa.Text())
+    count_params = sa.Column(sa.Integer(), nullable=False)
+
+
+class RuntimeCallParamDefinition(BaseModel):
+    __tablename__ = 'runtime_call_param_definition'
+    __table_args__ = (sa.UniqueConstraint('call_hash', 'name'),)
+
+    id = sa.Column(sa.Integer(), primary_key=True)
+    call_hash = sa.Column(sa.String(40), nullable=False)
+    position = sa.Column(sa.Integer(), nullable=False)
+    name = sa.Column(sa.String(255))
+    type = sa.Column(sa.String(255))
+
+
+class RuntimeEventDefinition(RuntimeDefinition, BaseModel):
+    __tablename__ = 'runtime_event_definition'
+
+    event_id = sa.Column(sa.String(64), nullable=False)
+    name = sa.Column(sa.String(255))
+    documentation = sa.Column(sa.Text())
+    count_attributes = sa.Column(sa.Integer(), nullable=False)
+
+
+class RuntimeEventAttributeDefinition(BaseModel):
+    __tablename__ = 'runtime_event_attribute_definition'
+    __table_args__ = (sa.UniqueConstraint('event_hash', 'index'),)
+
+    id = sa.Column(sa.Integer(), primary_key=True)
+    event_hash = sa.Column(sa.String(40), nullable=False)
+    index = sa.Column(sa.Integer(), nullable=False)
+    type = sa.Column(sa.String(255))
+
+
+class RuntimeStorageDefinition(RuntimeDefinition, BaseModel):
+    __tablename__ = 'runtime_storage_definition'
+
+    storage_key = sa.Column(sa.String(255))
+    name = sa.Column(sa.String(255))
+    default = sa.Column(LONGTEXT())
+    modifier = sa.Column(sa.String(64))
+    type_hasher = sa.Column(sa.String(255))
+    type_key1 = sa.Column(sa.String(255))
+    type_key2 = sa.Column(sa.String(255))
+    type_value = sa.Column(sa.String(255))
+    type_is_linked = sa.Column(sa.SmallInteger())
+    type_key2hasher = sa.Column(sa.String(255))
+    documentation = sa.Column(sa.Text())
+
+
+class RuntimeConstantDefinition(RuntimeDefinition, BaseModel):
+    __tablename__ = 'runtime_constant_definition'
+
+    name = sa.Column(sa.String(255))
+    type = sa.Column(sa.String(255))
+    value = sa.Column(LONGTEXT())
+    documentation = sa.Column(sa.Text())
+
+
+class RuntimeTypeDefinition(RuntimeDefinition, BaseModel):
+    __tablename__ = 'runtime_type_definition'
+
+    type_string = sa.Column(sa.String(255))
+    decoder_class = sa.Column(sa.String(255), nullable=True)
+    is_primitive_runtime = sa.Column(sa.Boolean(), default=False)
+    is_primitive_core = sa.Column(sa.Boolean(), default=False)
+
+
 class ReorgBlock(BaseModel):
     __tablename__ = 'data_reorg_block'
 
@@ -18,6 +18,8 @@
 #
 #  harvester.py
 #
+import datetime
+
 from app.models.base import BaseModel
 import sqlalchemy as sa
 
@@ -46,3 +48,157 @@ class Setting(BaseModel):
     key = sa.Column(sa.String(64), primary_key=True)
     value = sa.Column(sa.String(255))
     notes = sa.Column(sa.String(255))
+
+
+class BlockRange(BaseModel):
+    """
+    Range of blocks to accumulate, claimed by a worker with a lease. Blocks are added from `block_to` down to
+    `block_from`, `checkpoint` is the highest block number not yet processed, so an expired lease is resumed there.
+    """
+    __tablename__ = 'harvester_block_range'
+
+    STATUS_PENDING = 'pending'
+    STATUS_LEASED = 'leased'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+
+    id = sa.Column(sa.Integer(), primary_key=True, autoincrement=True)
+    block_from = sa.Column(sa.Integer(), nullable=False, index=True)
+    block_to = sa.Column(sa.Integer(), nullable=False, index=True)
+    checkpoint = sa.Column(sa.Integer(), nullable=True)
+    status = sa.Column(sa.String(16), nullable=False, index=True)
+    lease_owner = sa.Column(sa.String(128), nullable=True)
+    lease_expires = sa.Column(sa.DateTime(), nullable=True, index=True)
+    attempts = sa.Column(sa.Integer(), nullable=False, default=0)
+    error = sa.Column(sa.String(255), nullable=True)
+    created_at = sa.Column(sa.DateTime(), nullable=False)
+    updated_at = sa.Column(sa.DateTime(), nullable=False)
+
+    @classmethod
+    def get_unfinished(cls, session):
+        return cls.query(session).filter(
+            cls.status.in_([cls.STATUS_PENDING, cls.STATUS_LEASED])
+        ).order_by(cls.block_to.desc())
+
+    @classmethod
+    def add_ranges(cls, session, block_from, block_to, range_size):
+        """
+        Splits [block_from, block_to] in ranges of `range_size` blocks and adds the ones not overlapping an unfinished
+        range
+
+        :return: list of added BlockRange
+        """
+        unfinished = [
+            (block_range.block_from, block_range.block_to) for block_range in cls.get_unfinished(session)
+        ]
+
+        now = datetime.datetime.utcnow()
+        added = []
+
+        for range_to in range(block_to, block_from - 1, -range_size):
+            range_from = max(range_to - range_size + 1, block_from)
+
+            overlaps = any(
+                range_from <= existing_to and range_to >= existing_from for existing_from, existing_to in unfinished
+            )
+
+            if overlaps:
+                continue
+
+            block_range = cls(
+                block_from=range_from,
+                block_to=range_to,
+                status=cls.STATUS_PENDING,
+                attempts=0,
+                created_at=now,
+                updated_at=now
+            )
+            block_range.save(session)
+            added.append(block_range)
+
+        session.commit()
+
+        return added
+
+    @classmethod
+    def claimable(cls, now):
+        return sa.and_(
+            cls.status.in_([cls.STATUS_PENDING, cls.STATUS_LEASED]),
+            sa.or_(cls.lease_expires.is_(None), cls.lease_expires < now)
+        )
+
+    @classmethod
+    def claim(cls, session, owner, lease_duration):
+        """
+        Atomically leases the highest unleased range or range with expired lease
+
+        :param owner: unique identifier of the worker
+        :param lease_duration: seconds
+        :return: BlockRange or None if nothing to claim
+        """
+        now = datetime.datetime.utcnow()
+
+        candidates = [
+            range_id for range_id, in session.query(cls.id).filter(cls.claimable(now)).order_by(
+                cls.block_to.desc()
+            ).limit(10)
+        ]
+
+        for range_id in candidates:
+            # Conditional update, a concurrent claim of the same range updates no rows
+            claimed = session.query(cls).filter(cls.id == range_id, cls.claimable(now)).update({
+                cls.status: cls.STATUS_LEASED,
+                cls.lease_owner: owner,
+                cls.lease_expires: now + datetime.timedelta(seconds=lease_duration),
+                cls.attempts: cls.attempts + 1,
+                cls.updated_at: now
+            }, synchronize_session=False)
+
+            session.commit()
+
+            if claimed:
+                return cls.query(session).get(range_id)
+
+    def update_lease(self, session, lease_duration, values=None):
+        """
+        Renews lease and updates given columns in the current transaction, if still owned by `lease_owner`
+
+        :return: False if lease is lost to another worker
+        """
+        now = datetime.datetime.utcnow()
+
+        update_values = {
+            BlockRange.lease_expires: now + datetime.timedelta(seconds=lease_duration),
+            BlockRange.updated_at: now
+        }
+        update_values.update(values or {})
+
+        return session.query(BlockRange).filter(
+            BlockRange.id == self.id, BlockRange.lease_owner == self.lease_owner
+        ).update(update_values, synchronize_session=False) > 0
+
+    def checkpoint_lease(self, session, checkpoint, lease_duration):
+        return self.update_lease(session, lease_duration, {BlockRange.checkpoint: checkpoint})
+
+    def finish(self, session):
+        return self.update_lease(session, 0, {
+            BlockRange.status: BlockRange.STATUS_DONE,
+            BlockRange.checkpoint: self.block_from - 1,
+            BlockRange.lease_expires: None,
+            BlockRange.error: None
+        })
+
+    def release(self, session, error, max_attempts):
+        """
+        Gives up lease after an error, the range is claimable again unless it failed `max_attempts` times
+        """
+        if self.attempts >= max_attempts:
+            status = BlockRange.STATUS_FAILED
+        else:
+            status = BlockRange.STATUS_PENDING
+
+        return self.update_lease(session, 0, {
+            BlockRange.status: status,
+            BlockRange.lease_expires: None,
+            BlockRange.error: str(error)[:255]
+        })
@@ -0,0 +1,253 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  async_harvester.py
+
+import asyncio
+import functools
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy.exc import IntegrityError
+
+from app import settings
+from app.processors.converters import PolkascanHarvesterService, BlockAlreadyAdded
+from app.utils.substrate_pool import get_substrate_pool
+
+
+class AsyncStorage(object):
+    """
+    Runs substrate calls on a pool of HarvesterSubstrateInterface instances sharing one HTTP connection pool, with at
+    most `concurrency` requests in flight. Must be created inside the running event loop.
+
+    Processor hooks run outside the event loop thread and can fan out with `get_runtime_states()`.
+    """
+
+    def __init__(self, type_registry, type_registry_file, metadata_cache, concurrency):
+        self.loop = asyncio.get_event_loop()
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+        self.http_session = requests.Session()
+        self.http_session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=concurrency))
+        self.http_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=concurrency))
+
+        # All instances are borrowed up front, creating one reloads the type registry of the shared RuntimeConfiguration
+        self.substrates = queue.Queue()
+
+        for nr in range(concurrency):
+            substrate = get_substrate_pool().borrow(
+                url=settings.SUBSTRATE_RPC_URL,
+                type_registry_preset=type_registry,
+                type_registry_file=type_registry_file,
+                owner=self
+            )
+            substrate.http_session = self.http_session
+            substrate.metadata_cache = metadata_cache
+
+            self.substrates.put(substrate)
+
+    def call(self, method, *args, **kwargs):
+        substrate = self.substrates.get()
+        try:
+            return getattr(substrate, method)(*args, **kwargs)
+        finally:
+            self.substrates.put(substrate)
+
+    async def run(self, method, *args, **kwargs):
+        async with self.semaphore:
+            return await self.loop.run_in_executor(
+                self.executor, functools.partial(self.call, method, *args, **kwargs)
+            )
+
+    async def rpc_request(self, method, params):
+        return await self.run('rpc_request', method, params)
+
+    async def get_runtime_state(self, module, storage_function, params=None, block_hash=None):
+        return await self.run(
+            'get_runtime_state', module=module, storage_function=storage_function, params=params,
+            block_hash=block_hash
+        )
+
+    async def gather_runtime_states(self, queries):
+        return await asyncio.gather(
+            *[self.get_runtime_state(**query) for query in queries], return_exceptions=True
+        )
+
+    def get_runtime_states(self, queries):
+        """
+        Performs storage queries concurrently, for use in processor hooks
+
+        :param queries: list of dicts with keyword arguments of `get_runtime_state()`
+        :return: list of results in the same order, failed queries return the exception
+        """
+        return asyncio.run_coroutine_threadsafe(self.gather_runtime_states(queries), self.loop).result()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.http_session.close()
+
+
+class AsyncPolkascanHarvesterService(PolkascanHarvesterService):
+    """
+    Harvester service running on an asyncio event loop. The RPC calls for a window of blocks are performed
+    concurrently and fed to the prefetch store of the substrate interface. Meanwhile the blocks of the previous
+    window are stored in order by a database thread with the regular `add_block()` and processor hooks.
+    """
+
+    def __init__(self, db_session, type_registry='default', type_registry_file=None, concurrency=None,
+                 window_size=None):
+        super().__init__(db_session, type_registry=type_registry, type_registry_file=type_registry_file)
+        self.concurrency = concurrency or settings.ASYNC_RPC_CONCURRENCY
+        self.window_size = window_size or settings.ASYNC_BLOCK_WINDOW
+        self.async_storage = None
+        self.add_count = 0
+
+        # Database session is thread-local, all database work runs in this thread
+        self.db_executor = ThreadPoolExecutor(max_workers=1)
+
+    async def fetch_block_responses(self, block_number):
+        block_hash = (await self.async_storage.rpc_request('chain_getBlockHash', [block_number])).get('result')
+
+        if not block_hash:
+            return None, {}
+
+        events_storage_hash = self.substrate.get_events_storage_hash(self.substrate.metadata_decoder)
+
+        calls = [
+            ('chain_getBlock', [block_hash]),
+            ('state_getStorageAt', [events_storage_hash, block_hash]),
+            ('chain_getRuntimeVersion', [block_hash])
+        ]
+
+        results = await asyncio.gather(
+            *[self.async_storage.rpc_request(method, params) for method, params in calls], return_exceptions=True
+        )
+
+        responses = {}
+
+        for (method, params), result in zip(calls, results):
+            # Failed calls are retried by the regular code path, which raises the appropriate error
+            if not isinstance(result, Exception):
+                responses[self.substrate.rpc_key(method, params)] = result
+
+        block_response = responses.get(self.substrate.rpc_key('chain_getBlock', [block_hash]))
+
+        if block_response and block_response.get('result'):
+            responses[self.substrate.rpc_key('chain_getHeader', [block_hash])] = {
+                'jsonrpc': '2.0',
+                'result': block_response['result']['block']['header'],
+                'id': block_response.get('id')
+            }
+
+        return block_hash, responses
+
+    async def fetch_window(self, block_numbers):
+        results = await asyncio.gather(*[self.fetch_block_responses(block_number) for block_number in block_numbers])
+
+        block_hashes = []
+        prefetch_store = {}
+
+        for block_hash, responses in results:
+            block_hashes.append(block_hash)
+            prefetch_store.update(responses)
+
+        return block_hashes, prefetch_store
+
+    def store_block(self, block_hash):
+        try:
+            self.add_block(block_hash)
+            self.db_session.commit()
+            self.add_count += 1
+
+            print('+ Added {} '.format(block_hash))
+
+        except BlockAlreadyAdded:
+            print('. Skipped {} '.format(block_hash))
+        except IntegrityError:
+            self.db_session.rollback()
+            print('. Skipped duplicate {} '.format(block_hash))
+        except Exception:
+            self.db_session.rollback()
+            raise
+
+    async def accumulate(self, block_numbers):
+        loop = asyncio.get_event_loop()
+
+        self.async_storage = AsyncStorage(
+            type_registry=self.type_registry,
+            type_registry_file=self.type_registry_file,
+            metadata_cache=self.metadata_store,
+            concurrency=self.concurrency
+        )
+
+        windows = [
+            block_numbers[offset:offset + self.window_size]
+            for offset in range(0, len(block_numbers), self.window_size)
+        ]
+
+        next_window = None
+
+        try:
+            if windows:
+                next_window = asyncio.ensure_future(self.fetch_window(windows[0]))
+
+            for window_idx in range(len(windows)):
+                block_hashes, prefetch_store = await next_window
+
+                # Fetch next window while the current one is stored
+                if window_idx + 1 < len(windows):
+                    next_window = asyncio.ensure_future(self.fetch_window(windows[window_idx + 1]))
+                else:
+                    next_window = None
+
+                self.substrate.prefetch_store = prefetch_store
+
+                for block_number, block_hash in zip(windows[window_idx], block_hashes):
+                    if not block_hash:
+                        print('! No block hash for #{}'.format(block_number))
+                        continue
+
+                    await loop.run_in_executor(self.db_executor, self.store_block, block_hash)
+
+        finally:
+            if next_window:
+                next_window.cancel()
+
+            await loop.run_in_executor(self.db_executor, self.db_session.remove)
+            self.async_storage.close()
+            self.async_storage = None
+
+    def accumulate_block_numbers(self, block_numbers):
+        """
+        Adds blocks by number, blocks are processed in the given order
+
+        :param block_numbers: list of block numbers, preferably descending so prefetched parent runtimes are used
+        :return: amount of blocks added
+        """
+        loop = asyncio.new_event_loop()
+
+        try:
+            loop.run_until_complete(self.accumulate(block_numbers))
+        finally:
+            loop.close()
+            self.db_executor.shutdown()
+
+        return self.add_count
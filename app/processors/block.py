@@ -484,11 +484,30 @@ class AccountInfoBlockProcessor(BlockProcessor):
                 update_balances_in_block(self.block.id)
         else:
             # Retrieve unique accounts in all searchindex records for current block
-            for search_index in db_session.query(distinct(SearchIndex.account_id)).filter_by(block_id=self.block.id):
+            account_ids = [
+                search_index[0] for search_index in
+                db_session.query(distinct(SearchIndex.account_id)).filter_by(block_id=self.block.id)
+            ]
+
+            async_storage = getattr(self.harvester, 'async_storage', None)
+
+            if async_storage:
+                # Retrieve account info of all accounts concurrently
+                account_infos = async_storage.get_runtime_states([{
+                    'module': 'System',
+                    'storage_function': 'Account',
+                    'params': ['0x{}'.format(account_id)],
+                    'block_hash': self.block.hash
+                } for account_id in account_ids])
+            else:
+                account_infos = [None] * len(account_ids)
+
+            for account_id, account_info in zip(account_ids, account_infos):
                 self.harvester.create_balance_snapshot(
                     block_id=self.block.id,
                     block_hash=self.block.hash,
-                    account_id=search_index[0]
+                    account_id=account_id,
+                    account_info=account_info
                 )
 
     def sequencing_hook(self, db_session, parent_block, parent_sequenced_block):
@@ -21,26 +21,33 @@ import json
 import logging
 
 import math
+from contextlib import ExitStack
 
 from app import settings
 
 from sqlalchemy import func, distinct
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from app.models.base import bulk_insert, flush_bulk_insert, deferred_flush, get_row_values, insert_ignore, \
+    supports_upsert, upsert
 from app.models.harvester import Status
 from app.processors import NewSessionEventProcessor, Log, SlashEventProcessor, BalancesTransferProcessor
 from scalecodec.base import ScaleBytes, ScaleDecoder, RuntimeConfiguration
 from scalecodec.exceptions import RemainingScaleBytesNotEmptyException
-from scalecodec.block import ExtrinsicsDecoder
 
 from app.processors.base import BaseService, ProcessorRegistry
-from scalecodec.type_registry import load_type_registry_file
-from substrateinterface import SubstrateInterface, logger
+from app.processors.decoding import decode_extrinsic, decode_events, decode_in_pool
+from app.utils.block_archive import get_block_archive
+from app.utils.block_index import get_block_index
+from app.utils.metadata_cache import create_metadata_store
+from app.utils.runtime import SpecVersionIndex, RuntimeDefinitionWriter
+from app.utils.substrate_pool import get_substrate_pool
+from substrateinterface import logger
+from substrateinterface.constants import STORAGE_HASH_SYSTEM_EVENTS, STORAGE_HASH_SYSTEM_EVENTS_V9
 from substrateinterface.exceptions import SubstrateRequestException
 from substrateinterface.utils.hasher import xxh128
 
-from app.models.data import Extrinsic, Block, Event, Runtime, RuntimeModule, RuntimeCall, RuntimeCallParam, \
-    RuntimeEvent, RuntimeEventAttribute, RuntimeType, RuntimeStorage, BlockTotal, RuntimeConstant, AccountAudit, \
-    AccountIndexAudit, ReorgBlock, ReorgExtrinsic, ReorgEvent, ReorgLog, RuntimeErrorMessage, Account, \
+from app.models.data import Extrinsic, Block, Event, Runtime, RuntimeModule, RuntimeDefinitionVersion, BlockTotal, \
+    AccountAudit, AccountIndexAudit, ReorgBlock, ReorgExtrinsic, ReorgEvent, ReorgLog, RuntimeErrorMessage, Account, \
     AccountInfoSnapshot, SearchIndex
 
 
@@ -67,19 +74,32 @@ class PolkascanHarvesterService(BaseService):
 
     def __init__(self, db_session, type_registry='default', type_registry_file=None):
         self.db_session = db_session
+        self.type_registry = type_registry
+        self.type_registry_file = type_registry_file
+        self.deferred_flush = settings.DEFERRED_FLUSH
+        self.flush_stats = None
 
-        if type_registry_file:
-            custom_type_registry = load_type_registry_file(type_registry_file)
+        if settings.SPEC_VERSION_INDEX:
+            self.spec_version_index = SpecVersionIndex.load(db_session)
         else:
-            custom_type_registry = None
+            self.spec_version_index = None
 
-        self.substrate = SubstrateInterface(
+        # Returned to the pool when the service is garbage collected
+        self.substrate = get_substrate_pool().borrow(
             url=settings.SUBSTRATE_RPC_URL,
-            type_registry=custom_type_registry,
             type_registry_preset=type_registry,
-            runtime_config=RuntimeConfiguration()
+            type_registry_file=type_registry_file,
+            owner=self
         )
-        self.metadata_store = {}
+        # Backed by the metadata cache when METADATA_CACHE_PATH is set
+        self.metadata_store = create_metadata_store()
+        # Spec versions with a Runtime row in the database
+        self.stored_spec_versions = set()
+
+        self.upsert = False
+
+        # Disabled when blocks are read from the archive itself
+        self.archive_blocks = bool(settings.BLOCK_ARCHIVE_PATH)
 
     def process_genesis(self, block):
 
@@ -211,6 +231,21 @@ class PolkascanHarvesterService(BaseService):
         else:
             initial_session_event.add_session_old(db_session=self.db_session, session_id=0)
 
+    def runtime_stored(self, spec_version):
+        """
+        Metadata store entries can be loaded from the metadata cache without the spec version being processed in this
+        database, e.g. after the database is reset
+
+        :return: True if a Runtime row of spec version exists
+        """
+        if spec_version not in self.stored_spec_versions:
+            if not Runtime.query(self.db_session).get(spec_version):
+                return False
+
+            self.stored_spec_versions.add(spec_version)
+
+        return True
+
     def process_metadata(self, spec_version, block_hash):
 
         # Check if metadata already stored
@@ -220,6 +255,9 @@ class PolkascanHarvesterService(BaseService):
 
             if spec_version in self.substrate.metadata_cache:
                 self.metadata_store[spec_version] = self.substrate.metadata_cache[spec_version]
+            elif spec_version in self.metadata_store:
+                # Loaded from metadata cache
+                self.substrate.metadata_cache[spec_version] = self.metadata_store[spec_version]
             else:
                 self.metadata_store[spec_version] = self.substrate.get_block_metadata(block_hash=block_hash)
 
@@ -228,7 +266,8 @@ class PolkascanHarvesterService(BaseService):
 
             runtime_version_data = self.substrate.get_block_runtime_version(block_hash)
 
-            self.db_session.begin(subtransactions=True)
+            # Savepoint, a failed insert must not roll back blocks pending in the session
+            savepoint = self.db_session.begin_nested()
             try:
 
                 # Store metadata in database
@@ -250,24 +289,27 @@ class PolkascanHarvesterService(BaseService):
                     count_errors=0
                 )
 
-                runtime.save(self.db_session)
-
                 print('store version to db', self.substrate.metadata_decoder.version)
 
+                # Rows are built in memory and written per table with multi-row inserts, calls, events, storage
+                # functions, constants and types are only stored when not contained by an earlier spec version
+                runtime_rows = []
+                definition_writer = RuntimeDefinitionWriter(spec_version)
+                module_ids = set()
+
                 for module_index, module in enumerate(self.substrate.metadata_decoder.metadata.modules):
 
                     if hasattr(module, 'index'):
                         module_index = module.index
 
                     # Check if module exists
-                    if RuntimeModule.query(self.db_session).filter_by(
-                        spec_version=spec_version,
-                        module_id=module.get_identifier()
-                    ).count() == 0:
+                    if module.get_identifier() not in module_ids:
                         module_id = module.get_identifier()
                     else:
                         module_id = '{}_1'.format(module.get_identifier())
 
+                    module_ids.add(module_id)
+
                     # Storage backwards compt check
                     if module.storage and isinstance(module.storage, list):
                         storage_functions = module.storage
@@ -287,7 +329,7 @@ class PolkascanHarvesterService(BaseService):
                         count_constants=len(module.constants or []),
                         count_errors=len(module.errors or []),
                     )
-                    runtime_module.save(self.db_session)
+                    runtime_rows.append(runtime_module)
 
                     # Update totals in runtime
                     runtime.count_call_functions += runtime_module.count_call_functions
@@ -298,47 +340,37 @@ class PolkascanHarvesterService(BaseService):
 
                     if len(module.calls or []) > 0:
                         for idx, call in enumerate(module.calls):
-                            runtime_call = RuntimeCall(
-                                spec_version=spec_version,
+                            definition_writer.add(
+                                RuntimeDefinitionVersion.KIND_CALL,
+                                {
+                                    'call_id': call.get_identifier(),
+                                    'name': call.name,
+                                    'documentation': '\n'.join(call.docs),
+                                    'count_params': len(call.args)
+                                },
+                                children=[{'name': arg.name, 'type': arg.type} for arg in call.args],
                                 module_id=module_id,
-                                call_id=call.get_identifier(),
                                 index=idx,
-                                name=call.name,
-                                lookup=call.lookup,
-                                documentation='\n'.join(call.docs),
-                                count_params=len(call.args)
+                                lookup=call.lookup
                             )
-                            runtime_call.save(self.db_session)
-
-                            for arg in call.args:
-                                runtime_call_param = RuntimeCallParam(
-                                    runtime_call_id=runtime_call.id,
-                                    name=arg.name,
-                                    type=arg.type
-                                )
-                                runtime_call_param.save(self.db_session)
 
                     if len(module.events or []) > 0:
                         for event_index, event in enumerate(module.events):
-                            runtime_event = RuntimeEvent(
-                                spec_version=spec_version,
+                            definition_writer.add(
+                                RuntimeDefinitionVersion.KIND_EVENT,
+                                {
+                                    'event_id': event.name,
+                                    'name': event.name,
+                                    'documentation': '\n'.join(event.docs),
+                                    'count_attributes': len(event.args)
+                                },
+                                children=[
+                                    {'index': arg_index, 'type': arg} for arg_index, arg in enumerate(event.args)
+                                ],
                                 module_id=module_id,
-                                event_id=event.name,
                                 index=event_index,
-                                name=event.name,
-                                lookup=event.lookup,
-                                documentation='\n'.join(event.docs),
-                                count_attributes=len(event.args)
+                                lookup=event.lookup
                             )
-                            runtime_event.save(self.db_session)
-
-                            for arg_index, arg in enumerate(event.args):
-                                runtime_event_attr = RuntimeEventAttribute(
-                                    runtime_event_id=runtime_event.id,
-                                    index=arg_index,
-                                    type=arg
-                                )
-                                runtime_event_attr.save(self.db_session)
 
                     if len(storage_functions) > 0:
                         for idx, storage in enumerate(storage_functions):
@@ -367,23 +399,24 @@ class PolkascanHarvesterService(BaseService):
                                 type_value = storage.type['DoubleMapType'].get('value')
                                 type_key2hasher = storage.type['DoubleMapType'].get('key2Hasher')
 
-                            runtime_storage = RuntimeStorage(
-                                spec_version=spec_version,
+                            definition_writer.add(
+                                RuntimeDefinitionVersion.KIND_STORAGE,
+                                {
+                                    'name': storage.name,
+                                    'default': storage.fallback,
+                                    'modifier': storage.modifier,
+                                    'type_hasher': type_hasher,
+                                    'storage_key': xxh128(module.prefix.encode()) + xxh128(storage.name.encode()),
+                                    'type_key1': type_key1,
+                                    'type_key2': type_key2,
+                                    'type_value': type_value,
+                                    'type_is_linked': type_is_linked,
+                                    'type_key2hasher': type_key2hasher,
+                                    'documentation': None
+                                },
                                 module_id=module_id,
-                                index=idx,
-                                name=storage.name,
-                                lookup=None,
-                                default=storage.fallback,
-                                modifier=storage.modifier,
-                                type_hasher=type_hasher,
-                                storage_key=xxh128(module.prefix.encode()) + xxh128(storage.name.encode()),
-                                type_key1=type_key1,
-                                type_key2=type_key2,
-                                type_value=type_value,
-                                type_is_linked=type_is_linked,
-                                type_key2hasher=type_key2hasher
+                                index=idx
                             )
-                            runtime_storage.save(self.db_session)
 
                     if len(module.constants or []) > 0:
                         for idx, constant in enumerate(module.constants):
@@ -406,15 +439,18 @@ class PolkascanHarvesterService(BaseService):
                             if type(value) is list or type(value) is dict:
                                 value = json.dumps(value)
 
-                            runtime_constant = RuntimeConstant(
-                                spec_version=spec_version,
+                            definition_writer.add(
+                                RuntimeDefinitionVersion.KIND_CONSTANT,
+                                {
+                                    'name': constant.name,
+                                    'type': constant.type,
+                                    # As read back from the text column
+                                    'value': str(value) if value is not None else None,
+                                    'documentation': None
+                                },
                                 module_id=module_id,
-                                index=idx,
-                                name=constant.name,
-                                type=constant.type,
-                                value=value
+                                index=idx
                             )
-                            runtime_constant.save(self.db_session)
 
                     if len(module.errors or []) > 0:
                         for idx, error in enumerate(module.errors):
@@ -425,35 +461,69 @@ class PolkascanHarvesterService(BaseService):
                                 index=idx,
                                 name=error.name
                             )
-                            runtime_error.save(self.db_session)
-
-                    runtime.save(self.db_session)
+                            runtime_rows.append(runtime_error)
 
                 # Process types
                 for runtime_type_data in list(self.substrate.get_type_registry(block_hash=block_hash).values()):
 
-                    runtime_type = RuntimeType(
-                        spec_version=runtime_type_data["spec_version"],
-                        type_string=runtime_type_data["type_string"],
-                        decoder_class=runtime_type_data["decoder_class"],
-                        is_primitive_core=runtime_type_data["is_primitive_core"],
-                        is_primitive_runtime=runtime_type_data["is_primitive_runtime"]
+                    definition_writer.add(
+                        RuntimeDefinitionVersion.KIND_TYPE,
+                        {
+                            'type_string': runtime_type_data["type_string"],
+                            'decoder_class': runtime_type_data["decoder_class"],
+                            'is_primitive_core': runtime_type_data["is_primitive_core"],
+                            'is_primitive_runtime': runtime_type_data["is_primitive_runtime"]
+                        }
                     )
-                    runtime_type.save(self.db_session)
 
-                self.db_session.commit()
+                runtime.save(self.db_session)
+
+                with bulk_insert(self.db_session, [RuntimeModule, RuntimeErrorMessage]):
+                    for runtime_row in runtime_rows:
+                        runtime_row.save(self.db_session)
+
+                new_definitions = definition_writer.flush(self.db_session)
+
+                print('Metadata: new definitions', new_definitions)
+
+                savepoint.commit()
 
                 # Put in local store
                 self.metadata_store[spec_version] = self.substrate.metadata_decoder
-            except SQLAlchemyError as e:
-                self.db_session.rollback()
+            except IntegrityError:
+                savepoint.rollback()
+
+                # Same spec version stored by a concurrent worker
+                if not Runtime.query(self.db_session).get(spec_version):
+                    raise
+
+                self.metadata_store[spec_version] = self.substrate.metadata_decoder
+            except SQLAlchemyError:
+                savepoint.rollback()
+                raise
 
     def add_block(self, block_hash):
 
         # Check if block is already process
-        if Block.query(self.db_session).filter_by(hash=block_hash).count() > 0:
+        if self.block_exists(block_hash):
             raise BlockAlreadyAdded(block_hash)
 
+        return self.persist_block(self.decode_block(block_hash))
+
+    def block_exists(self, block_hash):
+        if settings.BLOCK_INDEX:
+            return get_block_index(self.db_session).block_exists(self.db_session, block_hash)
+
+        return Block.query(self.db_session).filter_by(hash=block_hash).count() > 0
+
+    def decode_block(self, block_hash):
+        """
+        Retrieves block, runtime and events for given block hash from Substrate and decodes events and extrinsics
+
+        :param block_hash:
+        :return: dict with plain block data ready for `persist_block()`
+        """
+
         if settings.SUBSTRATE_MOCK_EXTRINSICS:
             self.substrate.mock_extrinsics = settings.SUBSTRATE_MOCK_EXTRINSICS
 
@@ -469,32 +539,153 @@ class PolkascanHarvesterService(BaseService):
         if not block_id.isnumeric():
             block_id = int(block_id, 16)
 
-        # ==== Get block runtime from Substrate ==================
+        # ==== Lookup block runtime in spec version index ==================
+
+        # Runtime of a block is applied from the state of its parent block, see `init_runtime()`
+        indexed_spec_version = None
+
+        if self.spec_version_index:
+            indexed_spec_version = self.spec_version_index.get_spec_version(max(block_id - 1, 0))
+
+        if indexed_spec_version is not None and self.runtime_stored(indexed_spec_version) and \
+                indexed_spec_version in self.metadata_store:
+
+            self.substrate.set_runtime(block_hash, indexed_spec_version, self.metadata_store[indexed_spec_version])
+
+            spec_version = parent_spec_version = indexed_spec_version
+
+        else:
+
+            # ==== Get block runtime from Substrate ==================
+
+            self.substrate.init_runtime(block_hash=block_hash)
+
+            self.process_metadata(self.substrate.runtime_version, block_hash)
+
+            spec_version = self.substrate.runtime_version
+
+            # ==== Get parent block runtime ===================
+
+            if block_id > 0:
+                json_parent_runtime_version = self.substrate.get_block_runtime_version(parent_hash)
+
+                parent_spec_version = json_parent_runtime_version.get('specVersion', 0)
+
+                self.process_metadata(parent_spec_version, parent_hash)
+            else:
+                parent_spec_version = self.substrate.runtime_version
+
+        extrinsics_data = json_block['block'].pop('extrinsics')
 
-        self.substrate.init_runtime(block_hash=block_hash)
+        # ==== Get block events from Substrate ==================
 
-        self.process_metadata(self.substrate.runtime_version, block_hash)
+        try:
+            # Events are decoded against runtime of parent block
+            events_data = self.substrate.get_block_events_data(block_hash, self.metadata_store[parent_spec_version])
+        except SubstrateRequestException:
+            events_data = None
 
-        # ==== Get parent block runtime ===================
+        if settings.DECODE_POOL_SIZE > 0 and len(extrinsics_data) >= settings.DECODE_POOL_MIN_EXTRINSICS:
 
-        if block_id > 0:
-            json_parent_runtime_version = self.substrate.get_block_runtime_version(parent_hash)
+            # ==== Decode large block in process pool ==================
 
-            parent_spec_version = json_parent_runtime_version.get('specVersion', 0)
+            events, extrinsics = decode_in_pool(
+                type_registry=self.type_registry,
+                type_registry_file=self.type_registry_file,
+                spec_version=spec_version,
+                parent_spec_version=parent_spec_version,
+                metadata_block_hash=parent_hash if block_id > 0 else block_hash,
+                extrinsics=extrinsics_data,
+                events_data=events_data
+            )
 
-            self.process_metadata(parent_spec_version, parent_hash)
         else:
-            parent_spec_version = self.substrate.runtime_version
+
+            if events_data:
+                # TODO implemented solution in substrate interface for runtime transition blocks
+                RuntimeConfiguration().set_active_spec_version_id(parent_spec_version)
+
+                events = decode_events(events_data, self.metadata_store[parent_spec_version])
+
+                # Revert back to current runtime
+                RuntimeConfiguration().set_active_spec_version_id(spec_version)
+            else:
+                events = None
+
+            # === Decode extrinsics from block ====
+
+            extrinsics = [
+                decode_extrinsic(extrinsic, self.metadata_store[parent_spec_version])
+                for extrinsic in extrinsics_data
+            ]
+
+        if self.archive_blocks and not settings.SUBSTRATE_MOCK_EXTRINSICS:
+            get_block_archive().add_block(
+                block_number=block_id,
+                block_hash=block_hash,
+                header={
+                    'parentHash': parent_hash,
+                    'stateRoot': state_root,
+                    'extrinsicsRoot': extrinsics_root,
+                    'digest': {'logs': digest_logs or []}
+                },
+                extrinsics=extrinsics_data,
+                events_data=events_data
+            )
+
+        return {
+            'block_hash': block_hash,
+            'block_id': block_id,
+            'parent_hash': parent_hash,
+            'state_root': state_root,
+            'extrinsics_root': extrinsics_root,
+            'digest_logs': digest_logs,
+            'spec_version': spec_version,
+            'parent_spec_version': parent_spec_version,
+            'events': events,
+            'extrinsics': extrinsics,
+            'json_block': json_block
+        }
+
+    def persist_block(self, block_data):
+        """
+        Stores decoded block data as returned by `decode_block()` and runs the accumulation hooks of the processors
+
+        :param block_data:
+        :return: Block
+        """
+        self.upsert = settings.UPSERT_INGESTION and supports_upsert(self.db_session)
+
+        with ExitStack() as stack:
+            if self.deferred_flush:
+                self.flush_stats = stack.enter_context(deferred_flush(self.db_session))
+
+            if settings.BULK_INSERT:
+                stack.enter_context(
+                    bulk_insert(self.db_session, [Event, Extrinsic, Log, SearchIndex], upsert=self.upsert)
+                )
+
+            block = self._persist_block(block_data)
+
+        if self.deferred_flush and settings.DEBUG:
+            print('Block #{}: {} flushes avoided'.format(block.id, self.flush_stats['flushes_avoided']))
+
+        return block
+
+    def _persist_block(self, block_data):
+
+        block_id = block_data['block_id']
+        parent_spec_version = block_data['parent_spec_version']
 
         # ==== Set initial block properties =====================
 
         block = Block(
             id=block_id,
             parent_id=block_id - 1,
-            hash=block_hash,
-            parent_hash=parent_hash,
-            state_root=state_root,
-            extrinsics_root=extrinsics_root,
+            hash=block_data['block_hash'],
+            parent_hash=block_data['parent_hash'],
+            state_root=block_data['state_root'],
+            extrinsics_root=block_data['extrinsics_root'],
             count_extrinsics=0,
             count_events=0,
             count_accounts_new=0,
@@ -516,66 +707,72 @@ class PolkascanHarvesterService(BaseService):
             range10000=math.floor(block_id / 10000),
             range100000=math.floor(block_id / 100000),
             range1000000=math.floor(block_id / 1000000),
-            spec_version_id=self.substrate.runtime_version,
-            logs=digest_logs
+            spec_version_id=block_data['spec_version'],
+            logs=block_data['digest_logs']
         )
 
+        if self.upsert:
+            # Claim block number, a concurrent transaction adding the same block holds the lock until it finishes
+            if not insert_ignore(self.db_session, Block.__table__, get_row_values(block)):
+                existing_hash = self.db_session.query(Block.hash).filter_by(id=block_id).scalar()
+
+                if existing_hash == block.hash:
+                    raise BlockAlreadyAdded(block.hash)
+
+                raise BlockIntegrityError('Block #{} already added with hash {}'.format(block_id, existing_hash))
+
+            # Write set of a block is deterministic, search index rows have no natural key so are replaced
+            SearchIndex.query(self.db_session).filter_by(block_id=block_id).delete(synchronize_session=False)
+
         # Set temp helper variables
         block._accounts_new = []
         block._accounts_reaped = []
 
-        # ==== Get block events from Substrate ==================
+        # ==== Store block events ==================
         extrinsic_success_idx = {}
         events = []
 
-        try:
-            # TODO implemented solution in substrate interface for runtime transition blocks
-            # Events are decoded against runtime of parent block
-            RuntimeConfiguration().set_active_spec_version_id(parent_spec_version)
-            events_decoder = self.substrate.get_block_events(block_hash, self.metadata_store[parent_spec_version])
-
-            # Revert back to current runtime
-            RuntimeConfiguration().set_active_spec_version_id(block.spec_version_id)
+        if block_data['events'] is not None:
 
             event_idx = 0
 
-            for event in events_decoder.elements:
+            for event_data in block_data['events']:
 
-                event.value['module_id'] = event.value['module_id'].lower()
+                event_data['module_id'] = event_data['module_id'].lower()
 
                 model = Event(
                     block_id=block_id,
                     event_idx=event_idx,
-                    phase=event.value['phase'],
-                    extrinsic_idx=event.value['extrinsic_idx'],
-                    type=event.value.get('event_index') or event.value.get('type'),
+                    phase=event_data['phase'],
+                    extrinsic_idx=event_data['extrinsic_idx'],
+                    type=event_data.get('event_index') or event_data.get('type'),
                     spec_version_id=parent_spec_version,
-                    module_id=event.value['module_id'],
-                    event_id=event.value['event_id'],
-                    system=int(event.value['module_id'] == 'system'),
-                    module=int(event.value['module_id'] != 'system'),
-                    attributes=event.value['params'],
+                    module_id=event_data['module_id'],
+                    event_id=event_data['event_id'],
+                    system=int(event_data['module_id'] == 'system'),
+                    module=int(event_data['module_id'] != 'system'),
+                    attributes=event_data['params'],
                     codec_error=False
                 )
 
                 # Process event
 
-                if event.value['phase'] == 0:
+                if event_data['phase'] == 0:
                     block.count_events_extrinsic += 1
-                elif event.value['phase'] == 1:
+                elif event_data['phase'] == 1:
                     block.count_events_finalization += 1
 
-                if event.value['module_id'] == 'system':
+                if event_data['module_id'] == 'system':
 
                     block.count_events_system += 1
 
                     # Store result of extrinsic
-                    if event.value['event_id'] == 'ExtrinsicSuccess':
-                        extrinsic_success_idx[event.value['extrinsic_idx']] = True
+                    if event_data['event_id'] == 'ExtrinsicSuccess':
+                        extrinsic_success_idx[event_data['extrinsic_idx']] = True
                         block.count_extrinsics_success += 1
 
-                    if event.value['event_id'] == 'ExtrinsicFailed':
-                        extrinsic_success_idx[event.value['extrinsic_idx']] = False
+                    if event_data['event_id'] == 'ExtrinsicFailed':
+                        extrinsic_success_idx[event_data['extrinsic_idx']] = False
                         block.count_extrinsics_error += 1
                 else:
 
@@ -587,55 +784,43 @@ class PolkascanHarvesterService(BaseService):
 
                 event_idx += 1
 
-            block.count_events = len(events_decoder.elements)
+            block.count_events = len(block_data['events'])
 
-        except SubstrateRequestException:
+        else:
             block.count_events = 0
 
-        # === Extract extrinsics from block ====
+        # === Store extrinsics of block ====
 
-        extrinsics_data = json_block['block'].pop('extrinsics')
-
-        block.count_extrinsics = len(extrinsics_data)
+        block.count_extrinsics = len(block_data['extrinsics'])
 
         extrinsic_idx = 0
 
         extrinsics = []
 
-        for extrinsic in extrinsics_data:
-
-            extrinsics_decoder = ExtrinsicsDecoder(
-                data=ScaleBytes(extrinsic),
-                metadata=self.metadata_store[parent_spec_version]
-            )
+        for extrinsic in block_data['extrinsics']:
 
-            extrinsic_data = extrinsics_decoder.decode()
+            extrinsic_data = extrinsic['data']
 
             # Lookup result of extrinsic
             extrinsic_success = extrinsic_success_idx.get(extrinsic_idx, False)
 
-            if extrinsics_decoder.era:
-                era = extrinsics_decoder.era.raw_value
-            else:
-                era = None
-
             model = Extrinsic(
                 block_id=block_id,
                 extrinsic_idx=extrinsic_idx,
-                extrinsic_hash=extrinsics_decoder.extrinsic_hash,
+                extrinsic_hash=extrinsic['extrinsic_hash'],
                 extrinsic_length=extrinsic_data.get('extrinsic_length'),
                 extrinsic_version=extrinsic_data.get('version_info'),
-                signed=extrinsics_decoder.contains_transaction,
-                unsigned=not extrinsics_decoder.contains_transaction,
-                signedby_address=bool(extrinsics_decoder.contains_transaction and extrinsic_data.get('account_id')),
-                signedby_index=bool(extrinsics_decoder.contains_transaction and extrinsic_data.get('account_index')),
+                signed=extrinsic['contains_transaction'],
+                unsigned=not extrinsic['contains_transaction'],
+                signedby_address=bool(extrinsic['contains_transaction'] and extrinsic_data.get('account_id')),
+                signedby_index=bool(extrinsic['contains_transaction'] and extrinsic_data.get('account_index')),
                 address_length=extrinsic_data.get('account_length'),
                 address=extrinsic_data.get('account_id'),
                 account_index=extrinsic_data.get('account_index'),
                 account_idx=extrinsic_data.get('account_idx'),
                 signature=extrinsic_data.get('signature'),
                 nonce=extrinsic_data.get('nonce'),
-                era=era,
+                era=extrinsic['era'],
                 call=extrinsic_data.get('call_code'),
                 module_id=extrinsic_data.get('call_module'),
                 call_id=extrinsic_data.get('call_function'),
@@ -652,7 +837,7 @@ class PolkascanHarvesterService(BaseService):
             extrinsic_idx += 1
 
             # Process extrinsic
-            if extrinsics_decoder.contains_transaction:
+            if extrinsic['contains_transaction']:
                 block.count_extrinsics_signed += 1
 
                 if model.signedby_address:
@@ -694,6 +879,9 @@ class PolkascanHarvesterService(BaseService):
                 event_processor.accumulation_hook(self.db_session)
                 event_processor.process_search_index(self.db_session)
 
+        # Block processors query rows of this block
+        flush_bulk_insert(self.db_session)
+
         # Process block processors
         for processor_class in ProcessorRegistry().get_block_processors():
             block_processor = processor_class(block, substrate=self.substrate, harvester=self)
@@ -701,11 +889,17 @@ class PolkascanHarvesterService(BaseService):
 
         # Debug info
         if settings.DEBUG:
-            block.debug_info = json_block
+            block.debug_info = block_data['json_block']
 
         # ==== Save data block ==================================
 
-        block.save(self.db_session)
+        if self.upsert:
+            upsert(self.db_session, Block.__table__, [get_row_values(block)])
+        else:
+            block.save(self.db_session)
+
+        if settings.BLOCK_INDEX:
+            get_block_index(self.db_session).add(block.id, block.hash)
 
         return block
 
@@ -736,10 +930,56 @@ class PolkascanHarvesterService(BaseService):
         # Delete extrinsics
         for item in Extrinsic.query(self.db_session).filter_by(block_id=block.id):
             self.db_session.delete(item)
+        # Delete logs and search index entries
+        Log.query(self.db_session).filter_by(block_id=block.id).delete(synchronize_session=False)
+        SearchIndex.query(self.db_session).filter_by(block_id=block.id).delete(synchronize_session=False)
 
         # Delete block
         self.db_session.delete(block)
 
+        if settings.BLOCK_INDEX:
+            get_block_index(self.db_session).remove(block.id)
+
+    def reprocess_block(self, block_number, block_archive):
+        """
+        Decodes and processes an archived block again, replacing the block if already added. Block, events and runtime
+        version responses are served from the archive, other RPC requests (e.g. storage by processors) still go to the
+        node or response cache.
+
+        :param block_number:
+        :param block_archive: BlockArchive
+        :return: Block or None if block is not archived
+        """
+        archived_block = block_archive.get_block(block_number)
+
+        if not archived_block:
+            return None
+
+        block_hash = archived_block.block_hash
+        header = archived_block.get_header()
+        chain_block = archived_block.get_chain_block()
+        events_data = archived_block.get_events_data()
+
+        self.substrate.prefetch_store = {
+            self.substrate.rpc_key('chain_getBlock', [block_hash]): {'jsonrpc': '2.0', 'result': chain_block},
+            self.substrate.rpc_key('chain_getHeader', [block_hash]): {'jsonrpc': '2.0', 'result': header}
+        }
+
+        if events_data:
+            # Storage key depends on the metadata version, which is not known yet
+            for events_storage_hash in [STORAGE_HASH_SYSTEM_EVENTS, STORAGE_HASH_SYSTEM_EVENTS_V9]:
+                self.substrate.prefetch_store[
+                    self.substrate.rpc_key('state_getStorageAt', [events_storage_hash, block_hash])
+                ] = {'jsonrpc': '2.0', 'result': events_data}
+
+        existing_block = Block.query(self.db_session).filter_by(id=block_number).first()
+
+        if existing_block:
+            self.remove_block(existing_block.hash)
+            self.db_session.flush()
+
+        return self.add_block(block_hash)
+
     def sequence_block(self, block, parent_block_data=None, parent_sequenced_block_data=None):
 
         sequenced_block = BlockTotal(
@@ -793,11 +1033,7 @@ class PolkascanHarvesterService(BaseService):
     def integrity_checks(self):
 
         # 1. Check finalized head
-        substrate = SubstrateInterface(
-            url=settings.SUBSTRATE_RPC_URL,
-            runtime_config=RuntimeConfiguration(),
-            type_registry_preset=settings.TYPE_REGISTRY
-        )
+        substrate = get_substrate_pool().borrow(owner=self)
 
         if settings.FINALIZATION_BY_BLOCK_CONFIRMATIONS > 0:
             finalized_block_hash = substrate.get_chain_head()
@@ -975,44 +1211,51 @@ class PolkascanHarvesterService(BaseService):
         self.db_session.execute('truncate table {}'.format(SearchIndex.__tablename__))
 
         for block in Block.query(self.db_session).order_by('id').yield_per(1000):
+            if settings.BULK_INSERT:
+                with bulk_insert(self.db_session, [SearchIndex]):
+                    self.rebuild_block_search_index(block)
+            else:
+                self.rebuild_block_search_index(block)
 
-            extrinsic_lookup = {}
-            block._accounts_new = []
-            block._accounts_reaped = []
+            self.db_session.commit()
 
-            for extrinsic in Extrinsic.query(self.db_session).filter_by(block_id=block.id).order_by('extrinsic_idx'):
-                extrinsic_lookup[extrinsic.extrinsic_idx] = extrinsic
+    def rebuild_block_search_index(self, block):
 
-                # Add search index for signed extrinsics
-                if extrinsic.address:
-                    search_index = SearchIndex(
-                        index_type_id=settings.SEARCH_INDEX_SIGNED_EXTRINSIC,
-                        block_id=block.id,
-                        extrinsic_idx=extrinsic.extrinsic_idx,
-                        account_id=extrinsic.address
-                    )
-                    search_index.save(self.db_session)
-
-                # Process extrinsic processors
-                for processor_class in ProcessorRegistry().get_extrinsic_processors(extrinsic.module_id, extrinsic.call_id):
-                    extrinsic_processor = processor_class(block=block, extrinsic=extrinsic, substrate=self.substrate)
-                    extrinsic_processor.process_search_index(self.db_session)
-
-            for event in Event.query(self.db_session).filter_by(block_id=block.id).order_by('event_idx'):
-                extrinsic = None
-                if event.extrinsic_idx is not None:
-                    try:
-                        extrinsic = extrinsic_lookup[event.extrinsic_idx]
-                    except (IndexError, KeyError):
-                        extrinsic = None
-
-                for processor_class in ProcessorRegistry().get_event_processors(event.module_id, event.event_id):
-                    event_processor = processor_class(block, event, extrinsic,
-                                                      metadata=self.metadata_store.get(block.spec_version_id),
-                                                      substrate=self.substrate)
-                    event_processor.process_search_index(self.db_session)
+        extrinsic_lookup = {}
+        block._accounts_new = []
+        block._accounts_reaped = []
 
-            self.db_session.commit()
+        for extrinsic in Extrinsic.query(self.db_session).filter_by(block_id=block.id).order_by('extrinsic_idx'):
+            extrinsic_lookup[extrinsic.extrinsic_idx] = extrinsic
+
+            # Add search index for signed extrinsics
+            if extrinsic.address:
+                search_index = SearchIndex(
+                    index_type_id=settings.SEARCH_INDEX_SIGNED_EXTRINSIC,
+                    block_id=block.id,
+                    extrinsic_idx=extrinsic.extrinsic_idx,
+                    account_id=extrinsic.address
+                )
+                search_index.save(self.db_session)
+
+            # Process extrinsic processors
+            for processor_class in ProcessorRegistry().get_extrinsic_processors(extrinsic.module_id, extrinsic.call_id):
+                extrinsic_processor = processor_class(block=block, extrinsic=extrinsic, substrate=self.substrate)
+                extrinsic_processor.process_search_index(self.db_session)
+
+        for event in Event.query(self.db_session).filter_by(block_id=block.id).order_by('event_idx'):
+            extrinsic = None
+            if event.extrinsic_idx is not None:
+                try:
+                    extrinsic = extrinsic_lookup[event.extrinsic_idx]
+                except (IndexError, KeyError):
+                    extrinsic = None
+
+            for processor_class in ProcessorRegistry().get_event_processors(event.module_id, event.event_id):
+                event_processor = processor_class(block, event, extrinsic,
+                                                  metadata=self.metadata_store.get(block.spec_version_id),
+                                                  substrate=self.substrate)
+                event_processor.process_search_index(self.db_session)
 
     def create_full_balance_snaphot(self, block_id):
 
@@ -1048,22 +1291,24 @@ class PolkascanHarvesterService(BaseService):
 
                 self.create_balance_snapshot(block_id=block_id, account_id=account_id, block_hash=block_hash)
 
-    def create_balance_snapshot(self, block_id, account_id, block_hash=None):
+    def create_balance_snapshot(self, block_id, account_id, block_hash=None, account_info=None):
 
         if not block_hash:
             block_hash = self.substrate.get_block_hash(block_id)
 
         # Get balance for account
         try:
-            account_info_data = self.substrate.get_runtime_state(
-                module='System',
-                storage_function='Account',
-                params=['0x{}'.format(account_id)],
-                block_hash=block_hash
-            ).get('result')
+            if account_info is None:
+                account_info = self.substrate.get_runtime_state(
+                    module='System',
+                    storage_function='Account',
+                    params=['0x{}'.format(account_id)],
+                    block_hash=block_hash
+                )
+            elif isinstance(account_info, Exception):
+                raise account_info
 
-            # Make sure no rows inserted before processing this record
-            AccountInfoSnapshot.query(self.db_session).filter_by(block_id=block_id, account_id=account_id).delete()
+            account_info_data = account_info.get('result')
 
             if account_info_data:
                 account_info_obj = AccountInfoSnapshot(
@@ -1086,7 +1331,15 @@ class PolkascanHarvesterService(BaseService):
                     nonce=None
                 )
 
-            account_info_obj.save(self.db_session)
+            if settings.UPSERT_INGESTION and supports_upsert(self.db_session):
+                upsert(self.db_session, AccountInfoSnapshot.__table__, [get_row_values(account_info_obj)])
+            else:
+                # Make sure no rows inserted before processing this record
+                AccountInfoSnapshot.query(self.db_session).filter_by(
+                    block_id=block_id, account_id=account_id
+                ).delete()
+
+                account_info_obj.save(self.db_session)
         except ValueError:
             pass
 
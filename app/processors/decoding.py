@@ -0,0 +1,190 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  decoding.py
+
+import billiard
+from scalecodec.base import ScaleBytes, RuntimeConfiguration
+from scalecodec.block import ExtrinsicsDecoder, EventsDecoder
+from scalecodec.type_registry import load_type_registry_file
+
+from app import settings
+from app.utils.metadata_cache import create_metadata_store
+from app.utils.response_cache import reset_response_cache
+from app.utils.rpc_pool import reset_rpc_pool
+from app.utils.substrate import HarvesterSubstrateInterface
+
+# State of a decode pool worker process
+worker_substrate = None
+worker_metadata_store = {}
+
+# Decode pool of the current process, created on first use
+decode_pool = None
+
+
+def decode_extrinsic(extrinsic, metadata):
+    """
+    Decodes SCALE encoded extrinsic
+
+    :param extrinsic: hex string of extrinsic
+    :param metadata: MetadataDecoder of runtime the extrinsic is decoded with
+    :return: dict ready for constructing an Extrinsic model
+    """
+    extrinsics_decoder = ExtrinsicsDecoder(
+        data=ScaleBytes(extrinsic),
+        metadata=metadata
+    )
+
+    extrinsic_data = extrinsics_decoder.decode()
+
+    if extrinsics_decoder.era:
+        era = extrinsics_decoder.era.raw_value
+    else:
+        era = None
+
+    return {
+        'extrinsic_hash': extrinsics_decoder.extrinsic_hash,
+        'contains_transaction': extrinsics_decoder.contains_transaction,
+        'era': era,
+        'data': extrinsic_data
+    }
+
+
+def decode_events(events_data, metadata):
+    """
+    Decodes SCALE encoded System.Events storage
+
+    :param events_data: hex string of storage value
+    :param metadata: MetadataDecoder of runtime the events are decoded with
+    :return: list of event dicts
+    """
+    events_decoder = EventsDecoder(
+        data=ScaleBytes(events_data),
+        metadata=metadata
+    )
+    events_decoder.decode()
+
+    return [event.value for event in events_decoder.elements]
+
+
+def init_decode_worker(type_registry, type_registry_file):
+    global worker_substrate, worker_metadata_store
+
+    # Created again on first use, the ones of the harvester process don't survive the fork
+    reset_response_cache()
+    reset_rpc_pool()
+
+    if type_registry_file:
+        custom_type_registry = load_type_registry_file(type_registry_file)
+    else:
+        custom_type_registry = None
+
+    # Worker process has its own RuntimeConfiguration singleton
+    worker_substrate = HarvesterSubstrateInterface(
+        url=settings.SUBSTRATE_RPC_URL,
+        type_registry=custom_type_registry,
+        type_registry_preset=type_registry,
+        runtime_config=RuntimeConfiguration()
+    )
+
+    worker_metadata_store = create_metadata_store()
+
+
+def get_worker_metadata(spec_version, block_hash):
+    if spec_version not in worker_metadata_store:
+        RuntimeConfiguration().set_active_spec_version_id(spec_version)
+        worker_metadata_store[spec_version] = worker_substrate.get_block_metadata(block_hash)
+
+    return worker_metadata_store[spec_version]
+
+
+def decode_extrinsics_job(spec_version, metadata_spec_version, metadata_block_hash, extrinsics):
+    metadata = get_worker_metadata(metadata_spec_version, metadata_block_hash)
+
+    RuntimeConfiguration().set_active_spec_version_id(spec_version)
+
+    return [decode_extrinsic(extrinsic, metadata) for extrinsic in extrinsics]
+
+
+def decode_events_job(metadata_spec_version, metadata_block_hash, events_data):
+    metadata = get_worker_metadata(metadata_spec_version, metadata_block_hash)
+
+    RuntimeConfiguration().set_active_spec_version_id(metadata_spec_version)
+
+    return decode_events(events_data, metadata)
+
+
+def get_decode_pool(type_registry, type_registry_file):
+    """
+    Returns the process pool used for decoding large blocks, workers retrieve and cache metadata per spec version
+
+    :return: billiard.Pool
+    """
+    global decode_pool
+
+    if decode_pool is None:
+        # billiard allows pools inside (daemonic) Celery worker processes
+        decode_pool = billiard.Pool(
+            processes=settings.DECODE_POOL_SIZE,
+            initializer=init_decode_worker,
+            initargs=(type_registry, type_registry_file)
+        )
+
+    return decode_pool
+
+
+def decode_in_pool(type_registry, type_registry_file, spec_version, parent_spec_version, metadata_block_hash,
+                   extrinsics, events_data):
+    """
+    Decodes extrinsics and events of a block in the decode pool, extrinsics are split in a chunk per worker.
+    Extrinsics are decoded with the metadata of the parent runtime, like in `PolkascanHarvesterService.decode_block`
+
+    :param metadata_block_hash: Block hash to retrieve metadata of `parent_spec_version`
+    :param extrinsics: list of hex strings
+    :param events_data: hex string of System.Events storage or None
+    :return: tuple (list of event dicts or None, list of extrinsic dicts)
+    """
+    pool = get_decode_pool(type_registry, type_registry_file)
+
+    events_result = None
+
+    if events_data:
+        events_result = pool.apply_async(
+            decode_events_job, (parent_spec_version, metadata_block_hash, events_data)
+        )
+
+    chunk_size = max(-(-len(extrinsics) // settings.DECODE_POOL_SIZE), 1)
+
+    extrinsic_results = [
+        pool.apply_async(
+            decode_extrinsics_job,
+            (spec_version, parent_spec_version, metadata_block_hash, extrinsics[offset:offset + chunk_size])
+        )
+        for offset in range(0, len(extrinsics), chunk_size)
+    ]
+
+    decoded_extrinsics = []
+    for result in extrinsic_results:
+        decoded_extrinsics += result.get()
+
+    if events_result:
+        events = events_result.get()
+    else:
+        events = None
+
+    return events, decoded_extrinsics
@@ -19,7 +19,6 @@
 #  event.py
 #
 from packaging import version
-from scalecodec.base import RuntimeConfiguration
 
 from app import settings
 from app.models.data import Contract, Session, AccountAudit, \
@@ -33,7 +32,7 @@ from app.settings import ACCOUNT_AUDIT_TYPE_NEW, ACCOUNT_AUDIT_TYPE_REAPED, ACCO
     IDENTITY_JUDGEMENT_TYPE_GIVEN
 
 from scalecodec.exceptions import RemainingScaleBytesNotEmptyException
-from substrateinterface import SubstrateInterface
+from app.utils.substrate_pool import get_substrate_pool
 from substrateinterface.exceptions import StorageFunctionNotFound
 
 
@@ -218,11 +217,7 @@ class NewSessionEventProcessor(EventProcessor):
         nominators = []
         validation_session_lookup = {}
 
-        substrate = SubstrateInterface(
-            url=settings.SUBSTRATE_RPC_URL,
-            runtime_config=RuntimeConfiguration(),
-            type_registry_preset=settings.TYPE_REGISTRY
-        )
+        substrate = get_substrate_pool().borrow(owner=self)
 
         # Retrieve current era
         storage_call = RuntimeStorage.query(db_session).filter_by(
@@ -0,0 +1,260 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  pipeline.py
+
+import queue
+import threading
+
+from scalecodec.base import RuntimeConfigurationObject
+
+from app import settings
+from app.processors.converters import PolkascanHarvesterService, BlockAlreadyAdded
+from app.utils.substrate import HarvesterSubstrateInterface
+
+
+class HarvesterPipeline(object):
+    """
+    Accumulates a chain of blocks from `block_hash` towards genesis in three stages connected by bounded queues:
+
+    * fetch: retrieves windows of blocks with JSON-RPC batch requests (own HarvesterSubstrateInterface)
+    * decode: decodes extrinsics and events of fetched blocks (own PolkascanHarvesterService)
+    * persist: stores decoded blocks and runs the processors (the provided harvester, in the calling thread)
+
+    The queue sizes limit how far the fetch and decode stages can run ahead of the database. Each stage is a single
+    thread: fetch follows parent hashes and is sized by BLOCK_FETCH_WINDOW, decode of large blocks is spread over
+    DECODE_POOL_SIZE processes and persist uses the one database session.
+
+    Decoding a block and persisting a block both use the process wide RuntimeConfiguration, processor hooks can switch
+    its runtime, so those two steps never run at the same time.
+    """
+
+    def __init__(self, harvester, block_hash, end_block_hash=None, max_blocks=None, fetch_window=None,
+                 fetch_queue_size=None, persist_queue_size=None):
+        self.harvester = harvester
+        self.block_hash = block_hash
+        self.end_block_hash = end_block_hash
+        self.max_blocks = max_blocks or settings.PIPELINE_BLOCKS_PER_TASK
+        self.fetch_window = max(fetch_window or settings.BLOCK_FETCH_WINDOW, 1)
+
+        self.fetch_queue = queue.Queue(maxsize=fetch_queue_size or settings.PIPELINE_FETCH_QUEUE_SIZE)
+        self.persist_queue = queue.Queue(maxsize=persist_queue_size or settings.PIPELINE_PERSIST_QUEUE_SIZE)
+
+        self.stop_event = threading.Event()
+        self.runtime_lock = threading.Lock()
+        self.error = None
+        self.error_block_hash = None
+
+        self.add_count = 0
+        self.flushes_avoided = 0
+        self.last_block = None
+        self.last_block_hash = block_hash
+
+        # Fetch stage only performs raw RPC calls, a separate runtime config keeps the shared singleton untouched
+        self.fetch_substrate = HarvesterSubstrateInterface(
+            url=settings.SUBSTRATE_RPC_URL,
+            runtime_config=RuntimeConfigurationObject()
+        )
+
+        # Decode stage uses its own substrate connection and database session (thread-local scoped session)
+        self.decoder = PolkascanHarvesterService(
+            db_session=harvester.db_session,
+            type_registry=harvester.type_registry,
+            type_registry_file=harvester.type_registry_file
+        )
+        self.decoder.metadata_store = harvester.metadata_store
+        self.decoder.substrate.metadata_cache = harvester.metadata_store
+
+    @property
+    def rpc_requests(self):
+        return self.fetch_substrate.rpc_stats['requests'] + \
+               self.decoder.substrate.rpc_stats['requests'] + \
+               self.harvester.substrate.rpc_stats['requests']
+
+    def set_error(self, exc, block_hash):
+        if self.error is None:
+            self.error = exc
+            self.error_block_hash = block_hash
+        self.stop_event.set()
+
+    def put(self, target_queue, item):
+        # Blocks while the next stage is behind, gives up when the pipeline is stopped
+        while not self.stop_event.is_set():
+            try:
+                target_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch_stage(self):
+        block_hash = self.block_hash
+        count = 0
+
+        try:
+            while count < self.max_blocks and not self.stop_event.is_set():
+
+                prefetched_hashes = self.fetch_substrate.prefetch_blocks(
+                    block_hash, min(self.fetch_window, self.max_blocks - count)
+                )
+
+                if not prefetched_hashes:
+                    # Let decode stage retrieve the block itself and raise the appropriate error
+                    self.put(self.fetch_queue, {'block_hash': block_hash, 'spec_versions': None, 'responses': {}})
+                    return
+
+                for prefetched_hash in prefetched_hashes:
+                    header = self.fetch_substrate.prefetch_store[
+                        self.fetch_substrate.rpc_key('chain_getHeader', [prefetched_hash])
+                    ]['result']
+
+                    parent_hash = header['parentHash']
+                    block_id = int(header['number'], 16)
+
+                    responses = self.fetch_substrate.prefetched_responses(prefetched_hash, parent_hash)
+
+                    spec_versions = (
+                        self.get_spec_version(responses, prefetched_hash),
+                        self.get_spec_version(responses, parent_hash) if block_id > 0 else None
+                    )
+
+                    if not self.put(self.fetch_queue, {
+                        'block_hash': prefetched_hash,
+                        'spec_versions': spec_versions,
+                        'responses': responses
+                    }):
+                        return
+
+                    count += 1
+
+                    if prefetched_hash == self.end_block_hash or block_id == 0 or count >= self.max_blocks:
+                        return
+
+                    block_hash = parent_hash
+
+        except Exception as exc:
+            self.set_error(exc, block_hash)
+        finally:
+            # Sentinel is always delivered, the decode stage keeps draining until it arrives
+            self.fetch_queue.put(None)
+
+    def get_spec_version(self, responses, block_hash):
+        response = responses.get(self.fetch_substrate.rpc_key('chain_getRuntimeVersion', [block_hash]))
+        if response and response.get('result'):
+            return response['result'].get('specVersion')
+
+    def decode_stage(self):
+        current_spec_versions = None
+
+        try:
+            while True:
+                item = self.fetch_queue.get()
+
+                if item is None:
+                    break
+
+                if self.stop_event.is_set():
+                    continue
+
+                try:
+                    # RuntimeConfiguration is shared with the persist stage, so a runtime change waits until all
+                    # blocks decoded with the previous runtime are stored
+                    if item['spec_versions'] != current_spec_versions or item['spec_versions'] is None:
+                        self.persist_queue.join()
+                        current_spec_versions = item['spec_versions']
+
+                    self.decoder.substrate.prefetch_store = item['responses']
+
+                    with self.runtime_lock:
+                        block_data = self.decoder.decode_block(item['block_hash'])
+
+                    self.put(self.persist_queue, block_data)
+
+                except Exception as exc:
+                    self.set_error(exc, item['block_hash'])
+
+        finally:
+            self.persist_queue.put(None)
+            self.decoder.db_session.remove()
+
+    def persist_stage(self):
+        db_session = self.harvester.db_session
+
+        while True:
+            block_data = self.persist_queue.get()
+
+            try:
+                if block_data is None:
+                    break
+
+                if self.stop_event.is_set():
+                    continue
+
+                self.last_block_hash = block_data['block_hash']
+
+                if self.harvester.block_exists(block_data['block_hash']):
+                    raise BlockAlreadyAdded(block_data['block_hash'])
+
+                with self.runtime_lock:
+                    block = self.harvester.persist_block(block_data)
+
+                print('+ Added {} '.format(block_data['block_hash']))
+
+                db_session.commit()
+
+                self.add_count += 1
+                if self.harvester.flush_stats:
+                    self.flushes_avoided += self.harvester.flush_stats['flushes_avoided']
+                self.last_block = block
+
+            except Exception as exc:
+                db_session.rollback()
+                self.set_error(exc, block_data['block_hash'])
+            finally:
+                self.persist_queue.task_done()
+
+    def run(self):
+        """
+        Runs the pipeline until `max_blocks` are stored, `end_block_hash` or genesis is reached or an error occurred.
+        The first error of any stage is raised after all stages are finished.
+
+        :return: last stored Block or None
+        """
+        fetch_thread = threading.Thread(target=self.fetch_stage, name='harvester-fetch', daemon=True)
+        decode_thread = threading.Thread(target=self.decode_stage, name='harvester-decode', daemon=True)
+
+        fetch_thread.start()
+        decode_thread.start()
+
+        try:
+            self.persist_stage()
+
+            decode_thread.join()
+            fetch_thread.join()
+        finally:
+            self.fetch_substrate.prefetch_store = {}
+            self.fetch_substrate.close()
+
+        # Decode stage could have created new runtimes
+        self.harvester.metadata_store = self.decoder.metadata_store
+
+        if self.error is not None:
+            self.last_block_hash = self.error_block_hash
+            raise self.error
+
+        return self.last_block
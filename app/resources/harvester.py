@@ -25,18 +25,20 @@ import falcon
 import pytz
 from celery.result import AsyncResult
 from falcon.media.validators.jsonschema import validate
-from scalecodec.base import RuntimeConfiguration
 from sqlalchemy import text, func
 
 from app import settings
 from app.models.data import Block, BlockTotal
-from app.models.harvester import Setting, Status
+from app.models.harvester import Setting, Status, BlockRange
 from app.resources.base import BaseResource
 from app.schemas import load_schema
 from app.processors.converters import PolkascanHarvesterService, BlockAlreadyAdded, BlockIntegrityError
-from substrateinterface import SubstrateInterface
-from app.tasks import accumulate_block_recursive, start_harvester, rebuild_search_index, rebuild_account_info_snapshot
-from app.settings import SUBSTRATE_RPC_URL, TYPE_REGISTRY, TYPE_REGISTRY_FILE
+from app.utils.response_cache import get_response_cache_stats
+from app.utils.rpc_pool import get_rpc_pool
+from app.utils.substrate_pool import pooled_substrate, get_substrate_pool_stats
+from app.tasks import accumulate_block_recursive, start_harvester, rebuild_search_index, rebuild_account_info_snapshot, \
+    start_reprocess, reprocess_block_range
+from app.settings import TYPE_REGISTRY, TYPE_REGISTRY_FILE
 
 
 class PolkascanStartHarvesterResource(BaseResource):
@@ -106,7 +108,27 @@ class PolkascanHarvesterQueueResource(BaseResource):
                     'block_process_queue': [
                         {'from': block_set['block_from'], 'to': block_set['block_to']}
                         for block_set in remaining_sets_result
-                    ]
+                    ],
+                    'block_ranges': {
+                        'status_count': {
+                            status: count for status, count in self.session.query(
+                                BlockRange.status, func.count(BlockRange.id)
+                            ).group_by(BlockRange.status)
+                        },
+                        'unfinished': [
+                            {
+                                'from': block_range.block_from,
+                                'to': block_range.block_to,
+                                'checkpoint': block_range.checkpoint,
+                                'status': block_range.status,
+                                'lease_owner': block_range.lease_owner,
+                                'lease_expires': block_range.lease_expires.isoformat()
+                                if block_range.lease_expires else None,
+                                'attempts': block_range.attempts,
+                                'error': block_range.error
+                            } for block_range in BlockRange.get_unfinished(self.session)
+                        ]
+                    }
                 }
             }
 
@@ -128,13 +150,9 @@ class PolkascanHarvesterStatusResource(BaseResource):
             best_block_datetime = None
             best_block_nr = None
 
-        substrate = SubstrateInterface(
-            url=SUBSTRATE_RPC_URL,
-            runtime_config=RuntimeConfiguration(),
-            type_registry_preset=settings.TYPE_REGISTRY
-        )
-        chain_head_block_id = substrate.get_block_number(substrate.get_chain_head())
-        chain_finalized_block_id = substrate.get_block_number(substrate.get_chain_finalised_head())
+        with pooled_substrate() as substrate:
+            chain_head_block_id = substrate.get_block_number(substrate.get_chain_head())
+            chain_finalized_block_id = substrate.get_block_number(substrate.get_chain_finalised_head())
 
         resp.media = {
             'best_block_datetime': best_block_datetime,
@@ -147,6 +165,21 @@ class PolkascanHarvesterStatusResource(BaseResource):
         }
 
 
+class RPCEndpointsResource(BaseResource):
+
+    def on_get(self, req, resp):
+
+        resp.status = falcon.HTTP_200
+        resp.media = {
+            'status': 'success',
+            'data': {
+                'endpoints': get_rpc_pool().check_health(),
+                'cache': get_response_cache_stats(),
+                'substrate_pool': get_substrate_pool_stats()
+            }
+        }
+
+
 class PolkascanProcessBlockResource(BaseResource):
 
     def on_post(self, req, resp):
@@ -154,12 +187,8 @@ class PolkascanProcessBlockResource(BaseResource):
         block_hash = None
 
         if req.media.get('block_id'):
-            substrate = SubstrateInterface(
-                url=SUBSTRATE_RPC_URL,
-                runtime_config=RuntimeConfiguration(),
-                type_registry_preset=settings.TYPE_REGISTRY
-            )
-            block_hash = substrate.get_block_hash(req.media.get('block_id'))
+            with pooled_substrate() as substrate:
+                block_hash = substrate.get_block_hash(req.media.get('block_id'))
         elif req.media.get('block_hash'):
             block_hash = req.media.get('block_hash')
         else:
@@ -174,7 +203,10 @@ class PolkascanProcessBlockResource(BaseResource):
                 type_registry_file=TYPE_REGISTRY_FILE
             )
 
-            block = Block.query(self.session).filter(Block.hash == block_hash).first()
+            if harvester.block_exists(block_hash):
+                block = Block.query(self.session).filter(Block.hash == block_hash).first()
+            else:
+                block = None
 
             if block:
                 resp.status = falcon.HTTP_200
@@ -355,6 +387,34 @@ class RebuildSearchIndexResource(BaseResource):
         }
 
 
+class ReprocessBlocksResource(BaseResource):
+
+    def on_post(self, req, resp):
+
+        block_from = req.media.get('block_from')
+        block_to = req.media.get('block_to')
+
+        if block_from is None or block_to is None or block_from > block_to:
+            resp.status = falcon.HTTP_BAD_REQUEST
+            resp.media = {'errors': ['Both block_from and block_to should be supplied']}
+            return
+
+        if settings.CELERY_RUNNING:
+            task = start_reprocess.delay(block_from, block_to)
+            data = {
+                'task_id': task.id
+            }
+        else:
+            data = reprocess_block_range(block_from, block_to)
+
+        resp.status = falcon.HTTP_201
+
+        resp.media = {
+            'status': 'Reprocess task created',
+            'data': data
+        }
+
+
 class RebuildAccountInfoResource(BaseResource):
 
     def on_post(self, req, resp):
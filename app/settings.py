@@ -31,6 +31,53 @@ DB_CONNECTION = os.environ.get("DB_CONNECTION", "mysql+mysqlconnector://{}:{}@{}
 ))
 
 SUBSTRATE_RPC_URL = os.environ.get("SUBSTRATE_RPC_URL", "http://substrate-node:9933/")
+SUBSTRATE_WS_URL = os.environ.get("SUBSTRATE_WS_URL", "ws://substrate-node:9944/")
+
+# Comma separated list of HTTP RPC endpoints of equivalent (archive) nodes, requests are spread over them
+SUBSTRATE_RPC_URLS = [
+    url.strip() for url in os.environ.get("SUBSTRATE_RPC_URLS", SUBSTRATE_RPC_URL).split(",") if url.strip()
+]
+
+# Send a duplicate request to another endpoint when there is no response after this amount of milliseconds, or
+# RPC_HEDGE_LATENCY_FACTOR times the average latency of the endpoint if higher. 0 disables hedging
+RPC_HEDGE_DELAY = int(os.environ.get("RPC_HEDGE_DELAY", 500))
+RPC_HEDGE_LATENCY_FACTOR = float(os.environ.get("RPC_HEDGE_LATENCY_FACTOR", 3))
+
+# Seconds a failed RPC endpoint is skipped
+RPC_ENDPOINT_RETRY_INTERVAL = int(os.environ.get("RPC_ENDPOINT_RETRY_INTERVAL", 30))
+
+# Timeout in seconds of RPC requests to endpoints in SUBSTRATE_RPC_URLS
+RPC_REQUEST_TIMEOUT = int(os.environ.get("RPC_REQUEST_TIMEOUT", 60))
+
+# Maximum concurrent requests of the RPC endpoint pool per process
+RPC_POOL_MAX_WORKERS = int(os.environ.get("RPC_POOL_MAX_WORKERS", 32))
+
+# Reuse initialized substrate interfaces and type registries within a process instead of creating them per task
+SUBSTRATE_POOL = bool(int(os.environ.get("SUBSTRATE_POOL", 1)))
+
+# Path of sqlite file to cache RPC responses requested at a block hash, which never change. Not set disables cache
+RPC_CACHE_PATH = os.environ.get("RPC_CACHE_PATH")
+
+# Maximum size in MB of the RPC response cache, least recently used responses are evicted
+RPC_CACHE_MAX_SIZE = int(os.environ.get("RPC_CACHE_MAX_SIZE", 10240))
+
+# Directory of the decoded metadata file shared by the processes of a host, so workers do not retrieve and decode
+# metadata of every spec version themselves and after every restart. Use a directory per chain. Not set disables cache
+METADATA_CACHE_PATH = os.environ.get("METADATA_CACHE_PATH")
+
+# Decoded spec versions kept in memory per process when METADATA_CACHE_PATH is set, others are loaded from the shared
+# file again when needed. 0 keeps all
+METADATA_STORE_SIZE = int(os.environ.get("METADATA_STORE_SIZE", 8))
+
+# Directory to archive the raw SCALE header, extrinsics and events of harvested blocks. Not set disables archive
+BLOCK_ARCHIVE_PATH = os.environ.get("BLOCK_ARCHIVE_PATH")
+
+# Amount of block numbers per archive segment file
+BLOCK_ARCHIVE_SEGMENT_SIZE = int(os.environ.get("BLOCK_ARCHIVE_SEGMENT_SIZE", 100000))
+
+# Amount of blocks per task when reprocessing a range of blocks from the block archive
+REPROCESS_SHARD_SIZE = int(os.environ.get("REPROCESS_SHARD_SIZE", 1000))
+
 SUBSTRATE_ADDRESS_TYPE = int(os.environ.get("SUBSTRATE_ADDRESS_TYPE", 42))
 
 SUBSTRATE_TREASURY_ACCOUNTS = [
@@ -51,6 +98,73 @@ FINALIZATION_ONLY = int(os.environ.get("FINALIZATION_ONLY", 0))
 
 DEBUG = bool(os.environ.get("DEBUG", False))
 
+# Amount of blocks retrieved from the node in one JSON-RPC batch during accumulation, 1 disables batching
+BLOCK_FETCH_WINDOW = int(os.environ.get("BLOCK_FETCH_WINDOW", 10))
+
+# Lookup runtime of blocks in a persisted spec version interval index instead of retrieving it for every block
+SPEC_VERSION_INDEX = bool(int(os.environ.get("SPEC_VERSION_INDEX", 0)))
+
+# Check existence of blocks in a per process index of harvested block ids and hashes instead of the database
+BLOCK_INDEX = bool(int(os.environ.get("BLOCK_INDEX", 0)))
+BLOCK_INDEX_CAPACITY = int(os.environ.get("BLOCK_INDEX_CAPACITY", 20000000))
+BLOCK_INDEX_RELOAD_INTERVAL = int(os.environ.get("BLOCK_INDEX_RELOAD_INTERVAL", 600))
+BLOCK_INDEX_DELTA_INTERVAL = float(os.environ.get("BLOCK_INDEX_DELTA_INTERVAL", 1))
+
+# Heads are added by the WebSocket follower (app/follower.py) instead of the periodic start_harvester task
+HEAD_FOLLOWER = bool(int(os.environ.get("HEAD_FOLLOWER", 0)))
+FOLLOWER_MAX_GAP = int(os.environ.get("FOLLOWER_MAX_GAP", 100))
+
+# asyncio harvester for backfill shards: RPC requests in flight and blocks fetched ahead per window
+ASYNC_HARVESTER = bool(int(os.environ.get("ASYNC_HARVESTER", 0)))
+ASYNC_RPC_CONCURRENCY = int(os.environ.get("ASYNC_RPC_CONCURRENCY", 16))
+ASYNC_BLOCK_WINDOW = int(os.environ.get("ASYNC_BLOCK_WINDOW", 20))
+
+# Backfill history in shards of block numbers processed by independent tasks, 0 follows parent hashes instead
+BACKFILL_SHARD_SIZE = int(os.environ.get("BACKFILL_SHARD_SIZE", 0))
+
+# Backfill through a work queue of block ranges in the database, claimed by workers with a lease that is renewed at
+# every checkpoint. A range of a crashed worker is resumed from its checkpoint after the lease expired
+BLOCK_RANGE_QUEUE = bool(int(os.environ.get("BLOCK_RANGE_QUEUE", 0)))
+BLOCK_RANGE_SIZE = int(os.environ.get("BLOCK_RANGE_SIZE", 1000))
+BLOCK_RANGE_CHECKPOINT_BLOCKS = int(os.environ.get("BLOCK_RANGE_CHECKPOINT_BLOCKS", 20))
+# Seconds
+BLOCK_RANGE_LEASE = int(os.environ.get("BLOCK_RANGE_LEASE", 300))
+BLOCK_RANGE_TASK_DURATION = int(os.environ.get("BLOCK_RANGE_TASK_DURATION", 600))
+# Amount of concurrent process_block_ranges tasks
+BLOCK_RANGE_WORKERS = int(os.environ.get("BLOCK_RANGE_WORKERS", 4))
+BLOCK_RANGE_MAX_ATTEMPTS = int(os.environ.get("BLOCK_RANGE_MAX_ATTEMPTS", 5))
+
+# Pipelined accumulation: fetch, decode and persist blocks in separate stages connected by bounded queues
+HARVESTER_PIPELINE = bool(int(os.environ.get("HARVESTER_PIPELINE", 0)))
+PIPELINE_BLOCKS_PER_TASK = int(os.environ.get("PIPELINE_BLOCKS_PER_TASK", 100))
+PIPELINE_FETCH_QUEUE_SIZE = int(os.environ.get("PIPELINE_FETCH_QUEUE_SIZE", 20))
+PIPELINE_PERSIST_QUEUE_SIZE = int(os.environ.get("PIPELINE_PERSIST_QUEUE_SIZE", 10))
+
+# Decode extrinsics and events of blocks with at least DECODE_POOL_MIN_EXTRINSICS extrinsics in a process pool
+DECODE_POOL_SIZE = int(os.environ.get("DECODE_POOL_SIZE", 0))
+DECODE_POOL_MIN_EXTRINSICS = int(os.environ.get("DECODE_POOL_MIN_EXTRINSICS", 500))
+
+# Insert events, extrinsics, logs and search index rows of a block with one multi-row INSERT per table. Search index
+# rows need innodb_autoinc_lock_mode 0 or 1 for this, with 2 they are inserted one by one to read back their ids
+BULK_INSERT = bool(int(os.environ.get("BULK_INSERT", 1)))
+
+# Size accumulate_block_recursive tasks to take about TASK_TARGET_DURATION seconds, based on a moving average of the
+# processing time per block, within TASK_MIN_BLOCKS and TASK_MAX_BLOCKS. 0 uses fixed tasks of 10 blocks
+TASK_TARGET_DURATION = float(os.environ.get("TASK_TARGET_DURATION", 0))
+TASK_MIN_BLOCKS = int(os.environ.get("TASK_MIN_BLOCKS", 5))
+TASK_MAX_BLOCKS = int(os.environ.get("TASK_MAX_BLOCKS", 500))
+
+# Commit accumulated blocks every GROUP_COMMIT_BLOCKS blocks or GROUP_COMMIT_INTERVAL milliseconds, whichever comes
+# first. On failure the blocks since the last commit are rolled back. 1 commits every block
+GROUP_COMMIT_BLOCKS = int(os.environ.get("GROUP_COMMIT_BLOCKS", 1))
+GROUP_COMMIT_INTERVAL = int(os.environ.get("GROUP_COMMIT_INTERVAL", 1000))
+
+# Write blocks with MySQL upserts, so a block added concurrently by another task is skipped without a rollback
+UPSERT_INGESTION = bool(int(os.environ.get("UPSERT_INGESTION", 0)))
+
+# Only flush pending objects when a query needs them and at the end of a block instead of on every save
+DEFERRED_FLUSH = bool(int(os.environ.get("DEFERRED_FLUSH", 0)))
+
 BALANCE_FULL_SNAPSHOT_INTERVAL = 10000
 CELERY_RUNNING = True
 
@@ -18,14 +18,18 @@
 #
 #  tasks.py
 
+import datetime
 import os
-from time import sleep
+import socket
+from time import sleep, time
 
 import celery
 from celery.result import AsyncResult
+from celery.signals import worker_process_init, worker_ready
+from kombu import Queue
 
 from app import settings
-from scalecodec.base import ScaleDecoder, ScaleBytes, RuntimeConfiguration
+from scalecodec.base import ScaleDecoder, ScaleBytes
 
 from sqlalchemy import create_engine, text, distinct
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError
@@ -33,13 +37,22 @@ from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.sql import func
 
 from app.models.data import Extrinsic, Block, BlockTotal, Account, AccountInfoSnapshot, SearchIndex
-from app.models.harvester import Status
+from app.models.harvester import Status, BlockRange
 from app.processors.converters import PolkascanHarvesterService, HarvesterCouldNotAddBlock, BlockAlreadyAdded, \
     BlockIntegrityError
-
-from substrateinterface import SubstrateInterface
-
-from app.settings import DB_CONNECTION, DEBUG, SUBSTRATE_RPC_URL, TYPE_REGISTRY, FINALIZATION_ONLY, TYPE_REGISTRY_FILE
+from app.processors.async_harvester import AsyncPolkascanHarvesterService
+from app.processors.pipeline import HarvesterPipeline
+from app.utils.block_archive import get_block_archive
+from app.utils.block_index import get_block_index
+from app.utils.group_commit import GroupCommit
+from app.utils.metadata_cache import create_metadata_store, get_metadata_cache_stats
+from app.utils.response_cache import get_response_cache_stats
+from app.utils.rpc_pool import get_rpc_pool_stats
+from app.utils.runtime import SpecVersionIndex
+from app.utils.substrate_pool import get_substrate_pool, get_substrate_pool_stats, init_substrate_pool
+from app.utils.task_sizing import get_task_sizer
+
+from app.settings import DB_CONNECTION, DEBUG, TYPE_REGISTRY, FINALIZATION_ONLY, TYPE_REGISTRY_FILE
 
 CELERY_BROKER = os.environ.get('CELERY_BROKER')
 CELERY_BACKEND = os.environ.get('CELERY_BACKEND')
@@ -56,20 +69,90 @@ app.conf.beat_schedule = {
 
 app.conf.timezone = 'UTC'
 
+# Queues, run a dedicated worker for QUEUE_TIP so new blocks are not delayed by a backlog of historical work
+QUEUE_DEFAULT = 'celery'
+QUEUE_TIP = 'tip'
+QUEUE_BACKFILL = 'backfill'
+QUEUE_SEQUENCER = 'sequencer'
+QUEUE_MAINTENANCE = 'maintenance'
+
+# Workers started without -Q consume all queues
+app.conf.task_default_queue = QUEUE_DEFAULT
+app.conf.task_queues = [
+    Queue(queue) for queue in [QUEUE_DEFAULT, QUEUE_TIP, QUEUE_BACKFILL, QUEUE_SEQUENCER, QUEUE_MAINTENANCE]
+]
+
+# Accumulation tasks started from the chain head are sent to QUEUE_TIP explicitly and continue on the same queue
+app.conf.task_routes = {
+    'app.tasks.start_harvester': {'queue': QUEUE_TIP},
+    'app.tasks.accumulate_block_recursive': {'queue': QUEUE_BACKFILL},
+    'app.tasks.accumulate_block_range': {'queue': QUEUE_BACKFILL},
+    'app.tasks.process_block_ranges': {'queue': QUEUE_BACKFILL},
+    'app.tasks.start_sequencer': {'queue': QUEUE_SEQUENCER},
+    'app.tasks.start_generate_analytics': {'queue': QUEUE_SEQUENCER},
+    'app.tasks.rebuilding_search_index': {'queue': QUEUE_MAINTENANCE},
+    'app.tasks.rebuild_search_index': {'queue': QUEUE_MAINTENANCE},
+    'app.tasks.rebuild_account_info_snapshot': {'queue': QUEUE_MAINTENANCE},
+    'app.tasks.balance_snapshot': {'queue': QUEUE_MAINTENANCE},
+    'app.tasks.update_balances_in_block': {'queue': QUEUE_MAINTENANCE},
+    'app.tasks.start_reprocess': {'queue': QUEUE_MAINTENANCE},
+    'app.tasks.reprocess_block_range': {'queue': QUEUE_MAINTENANCE},
+}
+
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    # Substrate interface and type registries are initialized once per worker process and reused by its tasks
+    init_substrate_pool()
+
+
+@worker_ready.connect
+def check_worker_queues(sender, **kwargs):
+    # Tasks of a queue without a worker are never processed, e.g. when only some of the queues are passed with -Q
+    active_queues = sender.app.control.inspect(timeout=5).active_queues() or {}
+
+    consumed_queues = set(
+        queue['name'] for worker_queues in active_queues.values() for queue in worker_queues
+    )
+
+    for queue in app.conf.task_queues:
+        if queue.name not in consumed_queues:
+            print('! No worker consumes queue "{}", start a worker with -Q {}'.format(queue.name, queue.name))
+
 
 class BaseTask(celery.Task):
 
     def __init__(self):
-        self.metadata_store = {}
+        # Kept between tasks in worker process, backed by the metadata cache when METADATA_CACHE_PATH is set
+        self.metadata_store = create_metadata_store()
 
     def __call__(self, *args, **kwargs):
         self.engine = create_engine(DB_CONNECTION, echo=DEBUG, isolation_level="READ_UNCOMMITTED", pool_pre_ping=True)
         session_factory = sessionmaker(bind=self.engine, autoflush=False, autocommit=False)
         self.session = scoped_session(session_factory)
+        self.borrowed_substrates = []
 
         return super().__call__(*args, **kwargs)
 
+    def borrow_substrate(self):
+        """
+        :return: substrate interface from the pool of the worker process, released when the task returns
+        """
+        substrate = get_substrate_pool().borrow()
+        self.borrowed_substrates.append(substrate)
+
+        return substrate
+
+    def get_queue(self):
+        """
+        :return: Queue this task was received from, QUEUE_BACKFILL when not executed by a worker
+        """
+        return (self.request.delivery_info or {}).get('routing_key') or QUEUE_BACKFILL
+
     def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        for substrate in getattr(self, 'borrowed_substrates', []):
+            get_substrate_pool().release(substrate)
+        self.borrowed_substrates = []
         if hasattr(self, 'session'):
             self.session.remove()
         if hasattr(self, 'engine'):
@@ -111,11 +194,39 @@ def accumulate_block_recursive(self, block_hash, end_block_hash=None):
     max_sequenced_block_id = False
 
     add_count = 0
+    flushes_avoided = 0
+
+    rpc_requests_start = harvester.substrate.rpc_stats['requests']
+
+    if settings.HARVESTER_PIPELINE:
+        return accumulate_block_pipeline(self, harvester, block_hash, end_block_hash)
+
+    group_commit = GroupCommit(self.session)
+
+    # Amount of blocks in this task
+    task_sizer = get_task_sizer()
+
+    if task_sizer.enabled:
+        batch_size = task_sizer.get_batch_size()
+    else:
+        batch_size = 10
 
     try:
 
-        for nr in range(0, 10):
+        task_start = time()
+
+        for nr in range(0, batch_size):
             if not block or block.id > 0:
+
+                block_start = time()
+
+                # Retrieve data of upcoming blocks in one batch
+                if settings.BLOCK_FETCH_WINDOW > 1 and not harvester.substrate.is_prefetched(block_hash):
+                    harvester.substrate.prefetch_blocks(
+                        block_hash, min(settings.BLOCK_FETCH_WINDOW, batch_size - nr),
+                        runtime_versions=not settings.SPEC_VERSION_INDEX
+                    )
+
                 # Process block
                 block = harvester.add_block(block_hash)
 
@@ -123,7 +234,13 @@ def accumulate_block_recursive(self, block_hash, end_block_hash=None):
 
                 add_count += 1
 
-                self.session.commit()
+                if harvester.flush_stats:
+                    flushes_avoided += harvester.flush_stats['flushes_avoided']
+
+                group_commit.add(block)
+
+                if task_sizer.enabled:
+                    task_sizer.record(time() - block_start)
 
                 # Break loop if targeted end block hash is reached
                 if block_hash == end_block_hash or block.id == 0:
@@ -132,27 +249,489 @@ def accumulate_block_recursive(self, block_hash, end_block_hash=None):
                 # Continue with parent block hash
                 block_hash = block.parent_hash
 
+                # Leave remaining blocks to next task when blocks are heavier than expected
+                if task_sizer.enabled and task_sizer.should_stop(nr + 1, time() - task_start):
+                    break
+
+        group_commit.commit()
+
         # Update persistent metadata store in Celery task
         self.metadata_store = harvester.metadata_store
 
         if block_hash != end_block_hash and block and block.id > 0:
-            accumulate_block_recursive.delay(block.parent_hash, end_block_hash)
+            accumulate_block_recursive.apply_async((block.parent_hash, end_block_hash), queue=self.get_queue())
 
     except BlockAlreadyAdded as e:
         print('. Skipped {} '.format(block_hash))
+        group_commit.commit()
     except IntegrityError as e:
         print('. Skipped duplicate {} '.format(block_hash))
+        group_commit.rollback()
     except Exception as exc:
         print('! ERROR adding {}'.format(block_hash))
+        group_commit.rollback()
         raise HarvesterCouldNotAddBlock(block_hash) from exc
 
+    add_count -= group_commit.rolled_back_blocks
+
+    rpc_requests = harvester.substrate.rpc_stats['requests'] - rpc_requests_start
+
     return {
         'result': '{} blocks added'.format(add_count),
         'lastAddedBlockHash': block_hash,
-        'sequencerStartedFrom': max_sequenced_block_id
+        'sequencerStartedFrom': max_sequenced_block_id,
+        'rpcRequests': rpc_requests,
+        'rpcRequestsPerBlock': round(rpc_requests / add_count, 2) if add_count else None,
+        'flushesAvoided': flushes_avoided,
+        'groupCommit': group_commit.stats(),
+        'batchSize': batch_size,
+        'blockCost': task_sizer.stats() if task_sizer.enabled else None,
+        'rpcEndpoints': get_rpc_pool_stats(),
+        'rpcCache': get_response_cache_stats(),
+        'substratePool': get_substrate_pool_stats(),
+        'metadataCache': get_metadata_cache_stats()
+    }
+
+
+def accumulate_block_pipeline(task, harvester, block_hash, end_block_hash=None):
+
+    pipeline = HarvesterPipeline(harvester, block_hash, end_block_hash)
+
+    try:
+        block = pipeline.run()
+
+        # Update persistent metadata store in Celery task
+        task.metadata_store = harvester.metadata_store
+
+        if block and block.id > 0 and block.hash != end_block_hash:
+            accumulate_block_recursive.apply_async((block.parent_hash, end_block_hash), queue=task.get_queue())
+
+    except BlockAlreadyAdded:
+        print('. Skipped {} '.format(pipeline.last_block_hash))
+    except IntegrityError:
+        print('. Skipped duplicate {} '.format(pipeline.last_block_hash))
+    except Exception as exc:
+        print('! ERROR adding {}'.format(pipeline.last_block_hash))
+        raise HarvesterCouldNotAddBlock(pipeline.last_block_hash) from exc
+
+    return {
+        'result': '{} blocks added'.format(pipeline.add_count),
+        'lastAddedBlockHash': pipeline.last_block_hash,
+        'sequencerStartedFrom': False,
+        'rpcRequests': pipeline.rpc_requests,
+        'rpcRequestsPerBlock': round(pipeline.rpc_requests / pipeline.add_count, 2) if pipeline.add_count else None,
+        'flushesAvoided': pipeline.flushes_avoided,
+        'rpcEndpoints': get_rpc_pool_stats(),
+        'rpcCache': get_response_cache_stats(),
+        'substratePool': get_substrate_pool_stats(),
+        'metadataCache': get_metadata_cache_stats()
     }
 
 
+@app.task(base=BaseTask, bind=True)
+def accumulate_block_range(self, block_from, block_to):
+
+    existing_block_ids = set(
+        block_id for block_id, in self.session.query(Block.id).filter(Block.id.between(block_from, block_to))
+    )
+
+    # Process from top of range, so prefetch windows follow the parent hashes
+    block_numbers = [nr for nr in range(block_to, block_from - 1, -1) if nr not in existing_block_ids]
+
+    if settings.ASYNC_HARVESTER:
+        harvester = AsyncPolkascanHarvesterService(
+            db_session=self.session,
+            type_registry=TYPE_REGISTRY,
+            type_registry_file=TYPE_REGISTRY_FILE
+        )
+
+        harvester.metadata_store = self.metadata_store
+        harvester.substrate.metadata_cache = self.metadata_store
+
+        try:
+            add_count = harvester.accumulate_block_numbers(block_numbers)
+        except Exception as exc:
+            raise HarvesterCouldNotAddBlock('#{}-#{}'.format(block_from, block_to)) from exc
+
+        self.metadata_store = harvester.metadata_store
+
+        return {
+            'result': '{} blocks added'.format(add_count),
+            'blockFrom': block_from,
+            'blockTo': block_to
+        }
+
+    harvester = PolkascanHarvesterService(
+        db_session=self.session,
+        type_registry=TYPE_REGISTRY,
+        type_registry_file=TYPE_REGISTRY_FILE
+    )
+
+    harvester.metadata_store = self.metadata_store
+    harvester.substrate.metadata_cache = self.metadata_store
+
+    block_hashes = harvester.substrate.get_block_hashes(block_numbers)
+
+    group_commit = GroupCommit(self.session)
+
+    add_count = 0
+    block_hash = None
+
+    # Position of the first block not committed yet, a rolled back group is retried from there
+    position = 0
+    group_position = 0
+    duplicate_errors = {}
+
+    try:
+        while position < len(block_numbers):
+            block_number = block_numbers[position]
+            block_hash = block_hashes.get(block_number)
+            position += 1
+
+            if not block_hash:
+                print('! No block hash for #{}'.format(block_number))
+                continue
+
+            if duplicate_errors.get(block_number, 0) > 1:
+                print('. Skipped duplicate {} '.format(block_hash))
+                continue
+
+            if settings.BLOCK_FETCH_WINDOW > 1 and not harvester.substrate.is_prefetched(block_hash):
+                harvester.substrate.prefetch_blocks(
+                    block_hash, min(settings.BLOCK_FETCH_WINDOW, block_number - block_from + 1),
+                    runtime_versions=not settings.SPEC_VERSION_INDEX
+                )
+
+            try:
+                block = harvester.add_block(block_hash)
+                add_count += 1
+
+                print('+ Added {} '.format(block_hash))
+
+                if group_commit.add(block):
+                    group_position = position
+
+            except BlockAlreadyAdded:
+                print('. Skipped {} '.format(block_hash))
+            except IntegrityError:
+                # Pending blocks of the group are rolled back as well, the retry skips the duplicate block
+                print('. Duplicate {}, retrying group from #{}'.format(block_hash, block_numbers[group_position]))
+                group_commit.rollback()
+
+                duplicate_errors[block_number] = duplicate_errors.get(block_number, 0) + 1
+                position = group_position
+
+        group_commit.commit()
+
+        # Update persistent metadata store in Celery task
+        self.metadata_store = harvester.metadata_store
+
+    except Exception as exc:
+        print('! ERROR adding {}'.format(block_hash))
+        group_commit.rollback()
+        raise HarvesterCouldNotAddBlock(block_hash) from exc
+
+    add_count -= group_commit.rolled_back_blocks
+
+    return {
+        'result': '{} blocks added'.format(add_count),
+        'blockFrom': block_from,
+        'blockTo': block_to,
+        'rpcRequests': harvester.substrate.rpc_stats['requests'],
+        'groupCommit': group_commit.stats(),
+        'rpcEndpoints': get_rpc_pool_stats(),
+        'rpcCache': get_response_cache_stats(),
+        'substratePool': get_substrate_pool_stats(),
+        'metadataCache': get_metadata_cache_stats()
+    }
+
+
+def start_backfill_shards(block_from, block_to):
+    """
+    Splits [block_from, block_to] in shards of BACKFILL_SHARD_SIZE blocks and starts an `accumulate_block_range` task
+    for each shard, most recent shard first
+
+    :return: list of shards
+    """
+    shards = []
+
+    for shard_to in range(block_to, block_from - 1, -settings.BACKFILL_SHARD_SIZE):
+        shard_from = max(shard_to - settings.BACKFILL_SHARD_SIZE + 1, block_from)
+
+        accumulate_block_range.delay(shard_from, shard_to)
+
+        shards.append({'block_from': shard_from, 'block_to': shard_to})
+
+    return shards
+
+
+def accumulate_leased_range(task, harvester, block_range):
+    """
+    Adds the blocks of a leased BlockRange from its checkpoint downwards. Every BLOCK_RANGE_CHECKPOINT_BLOCKS blocks
+    the checkpoint and lease are updated in the same transaction as the added blocks. A batch is retried once when a
+    concurrent writer added one of its blocks.
+
+    :return: amount of blocks added
+    """
+    add_count = 0
+    block_number = block_range.block_to if block_range.checkpoint is None else block_range.checkpoint
+
+    # Commits are done per checkpoint
+    group_commit = GroupCommit(task.session, max_blocks=settings.BLOCK_RANGE_CHECKPOINT_BLOCKS + 1,
+                               max_interval=settings.BLOCK_RANGE_LEASE * 1000)
+
+    retry_batch = False
+
+    try:
+        while block_number >= block_range.block_from:
+            batch_numbers = list(range(
+                block_number, max(block_number - settings.BLOCK_RANGE_CHECKPOINT_BLOCKS, block_range.block_from - 1),
+                -1
+            ))
+
+            block_hashes = harvester.substrate.get_block_hashes(batch_numbers)
+            batch_count = 0
+            duplicate = False
+
+            for batch_number in batch_numbers:
+                block_hash = block_hashes.get(batch_number)
+
+                if not block_hash:
+                    print('! No block hash for #{}'.format(batch_number))
+                    continue
+
+                if settings.BLOCK_FETCH_WINDOW > 1 and not harvester.substrate.is_prefetched(block_hash):
+                    harvester.substrate.prefetch_blocks(
+                        block_hash, min(settings.BLOCK_FETCH_WINDOW, batch_number - block_range.block_from + 1),
+                        runtime_versions=not settings.SPEC_VERSION_INDEX
+                    )
+
+                try:
+                    block = harvester.add_block(block_hash)
+                    batch_count += 1
+
+                    print('+ Added {} '.format(block_hash))
+
+                    group_commit.add(block)
+
+                except BlockAlreadyAdded:
+                    print('. Skipped {} '.format(block_hash))
+                except IntegrityError:
+                    if retry_batch:
+                        raise
+
+                    print('. Skipped duplicate {}, retrying batch'.format(block_hash))
+                    duplicate = True
+                    break
+
+            if duplicate:
+                # Blocks of the batch added so far are rolled back as well, the retry skips the duplicate block
+                group_commit.rollback()
+                retry_batch = True
+                continue
+
+            retry_batch = False
+            block_number = batch_numbers[-1] - 1
+
+            if not block_range.checkpoint_lease(task.session, block_number, settings.BLOCK_RANGE_LEASE):
+                group_commit.rollback()
+                print('! Lease of range #{}-#{} lost'.format(block_range.block_from, block_range.block_to))
+                return add_count
+
+            group_commit.commit()
+            add_count += batch_count
+
+    except Exception:
+        group_commit.rollback()
+        raise
+
+    if not block_range.finish(task.session):
+        task.session.rollback()
+        print('! Lease of range #{}-#{} lost before finishing'.format(block_range.block_from, block_range.block_to))
+        return add_count
+
+    task.session.commit()
+
+    return add_count
+
+
+@app.task(base=BaseTask, bind=True)
+def process_block_ranges(self):
+    """
+    Claims ranges of the block range work queue and accumulates them, until no range is left or the task ran for
+    BLOCK_RANGE_TASK_DURATION seconds
+    """
+    owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), self.request.id)
+
+    harvester = PolkascanHarvesterService(
+        db_session=self.session,
+        type_registry=TYPE_REGISTRY,
+        type_registry_file=TYPE_REGISTRY_FILE
+    )
+
+    harvester.metadata_store = self.metadata_store
+    harvester.substrate.metadata_cache = self.metadata_store
+
+    task_start = time()
+    add_count = 0
+    ranges = []
+
+    while time() - task_start < settings.BLOCK_RANGE_TASK_DURATION:
+        block_range = BlockRange.claim(self.session, owner, settings.BLOCK_RANGE_LEASE)
+
+        if not block_range:
+            break
+
+        range_result = {'id': block_range.id, 'blockFrom': block_range.block_from, 'blockTo': block_range.block_to}
+
+        try:
+            range_result['added'] = accumulate_leased_range(self, harvester, block_range)
+            add_count += range_result['added']
+
+        except Exception as exc:
+            print('! ERROR accumulating range #{}-#{}: {}'.format(block_range.block_from, block_range.block_to, exc))
+
+            block_range.release(self.session, exc, settings.BLOCK_RANGE_MAX_ATTEMPTS)
+            self.session.commit()
+
+            range_result['error'] = str(exc)
+
+        ranges.append(range_result)
+
+    # Update persistent metadata store in Celery task
+    self.metadata_store = harvester.metadata_store
+
+    return {
+        'result': '{} blocks added'.format(add_count),
+        'owner': owner,
+        'ranges': ranges,
+        'rpcRequests': harvester.substrate.rpc_stats['requests']
+    }
+
+
+def dispatch_block_range_workers(session):
+    """
+    Starts a `process_block_ranges` task for every free worker slot of BLOCK_RANGE_WORKERS when there are ranges to
+    claim. Task ids are kept in the harvester status, like the sequencer task.
+
+    :return: list of started task ids
+    """
+    now = datetime.datetime.utcnow()
+
+    if not BlockRange.query(session).filter(BlockRange.claimable(now)).count():
+        return []
+
+    # Tasks not finished within this time are considered lost
+    max_task_age = datetime.timedelta(seconds=settings.BLOCK_RANGE_TASK_DURATION + settings.BLOCK_RANGE_LEASE)
+
+    task_ids = []
+
+    for slot in range(settings.BLOCK_RANGE_WORKERS):
+        slot_status = Status.get_status(session, 'BLOCK_RANGE_TASK_{}'.format(slot))
+
+        if slot_status.value and not AsyncResult(slot_status.value).ready() and \
+                slot_status.last_modified and now - slot_status.last_modified < max_task_age:
+            continue
+
+        task = process_block_ranges.delay()
+
+        slot_status.value = task.id
+        slot_status.last_modified = now
+        slot_status.save(session)
+
+        task_ids.append(task.id)
+
+    session.commit()
+
+    return task_ids
+
+
+def queue_backfill(session, block_from, block_to):
+    """
+    Schedules accumulation of [block_from, block_to] in the block range work queue or in sharded tasks
+
+    :return: list of block sets
+    """
+    if settings.BLOCK_RANGE_QUEUE:
+        return [
+            {'block_from': block_range.block_from, 'block_to': block_range.block_to}
+            for block_range in BlockRange.add_ranges(session, block_from, block_to, settings.BLOCK_RANGE_SIZE)
+        ]
+
+    return start_backfill_shards(block_from, block_to)
+
+
+@app.task(base=BaseTask, bind=True)
+def reprocess_block_range(self, block_from, block_to):
+
+    block_archive = get_block_archive()
+
+    if not block_archive:
+        return {'result': 'Block archive not configured (BLOCK_ARCHIVE_PATH)'}
+
+    harvester = PolkascanHarvesterService(
+        db_session=self.session,
+        type_registry=TYPE_REGISTRY,
+        type_registry_file=TYPE_REGISTRY_FILE
+    )
+
+    harvester.metadata_store = self.metadata_store
+    harvester.substrate.metadata_cache = self.metadata_store
+    harvester.archive_blocks = False
+
+    reprocess_count = 0
+    missing_block_ids = []
+
+    for block_id in range(block_from, block_to + 1):
+        try:
+            block = harvester.reprocess_block(block_id, block_archive)
+
+            if not block:
+                missing_block_ids.append(block_id)
+                continue
+
+            self.session.commit()
+            reprocess_count += 1
+
+            print('+ Reprocessed #{} {}'.format(block_id, block.hash))
+
+        except Exception as exc:
+            self.session.rollback()
+            print('! ERROR reprocessing #{}'.format(block_id))
+            raise HarvesterCouldNotAddBlock('#{}'.format(block_id)) from exc
+
+    self.metadata_store = harvester.metadata_store
+
+    return {
+        'result': '{} blocks reprocessed'.format(reprocess_count),
+        'blockFrom': block_from,
+        'blockTo': block_to,
+        'notArchived': missing_block_ids,
+        'rpcRequests': harvester.substrate.rpc_stats['requests'],
+        'rpcCache': get_response_cache_stats(),
+        'substratePool': get_substrate_pool_stats(),
+        'metadataCache': get_metadata_cache_stats()
+    }
+
+
+@app.task(base=BaseTask, bind=True)
+def start_reprocess(self, block_from, block_to):
+    """
+    Splits [block_from, block_to] in shards of REPROCESS_SHARD_SIZE blocks, processed in parallel by
+    `reprocess_block_range` tasks
+    """
+    shards = []
+
+    for shard_from in range(block_from, block_to + 1, settings.REPROCESS_SHARD_SIZE):
+        shard_to = min(shard_from + settings.REPROCESS_SHARD_SIZE - 1, block_to)
+
+        task = reprocess_block_range.delay(shard_from, shard_to)
+
+        shards.append({'block_from': shard_from, 'block_to': shard_to, 'task_id': task.id})
+
+    return {'result': '{} reprocess tasks started'.format(len(shards)), 'shards': shards}
+
+
 @app.task(base=BaseTask, bind=True)
 def start_sequencer(self):
     sequencer_task = Status.get_status(self.session, 'SEQUENCER_TASK_ID')
@@ -210,20 +789,31 @@ def rebuilding_search_index(self, search_index_id=None, truncate=False):
 @app.task(base=BaseTask, bind=True)
 def start_harvester(self, check_gaps=False):
 
-    substrate = SubstrateInterface(
-        url=SUBSTRATE_RPC_URL,
-        type_registry_preset=settings.TYPE_REGISTRY,
-        runtime_config=RuntimeConfiguration()
-    )
+    substrate = self.borrow_substrate()
 
     block_sets = []
 
+    if settings.SPEC_VERSION_INDEX:
+        # Extend spec version index up to finalised head, on first run the complete index is built
+        SpecVersionIndex.load(self.session).update(
+            self.session, substrate, substrate.get_block_number(substrate.get_chain_finalised_head())
+        )
+
     if check_gaps:
         # Check for gaps between already harvested blocks and try to fill them first
-        remaining_sets_result = Block.get_missing_block_ids(self.session)
+        if settings.BLOCK_INDEX:
+            block_index = get_block_index(self.session)
+            block_index.refresh(self.session)
+            remaining_sets_result = block_index.get_missing_block_ids()
+        else:
+            remaining_sets_result = Block.get_missing_block_ids(self.session)
 
         for block_set in remaining_sets_result:
 
+            if settings.BACKFILL_SHARD_SIZE > 0 or settings.BLOCK_RANGE_QUEUE:
+                block_sets += queue_backfill(self.session, int(block_set['block_from']), int(block_set['block_to']))
+                continue
+
             # Get start and end block hash
             end_block_hash = substrate.get_block_hash(int(block_set['block_from']))
             start_block_hash = substrate.get_block_hash(int(block_set['block_to']))
@@ -247,17 +837,46 @@ def start_harvester(self, check_gaps=False):
 
     end_block_hash = None
 
-    accumulate_block_recursive.delay(start_block_hash, end_block_hash)
+    if settings.BACKFILL_SHARD_SIZE > 0 or settings.BLOCK_RANGE_QUEUE:
+        backfill_status = Status.get_status(self.session, 'BACKFILL_SHARDED_HEAD')
+
+        if not backfill_status.value and not self.session.query(func.max(Block.id)).one()[0]:
+            # Cold start: shard history up to finalised head, follow chain head from there
+            backfill_head = substrate.get_block_number(substrate.get_chain_finalised_head())
+
+            if backfill_head > 0:
+                block_sets += queue_backfill(self.session, 0, backfill_head - 1)
+
+                end_block_hash = substrate.get_block_hash(backfill_head)
 
-    block_sets.append({
-        'start_block_hash': start_block_hash,
-        'end_block_hash': end_block_hash
-    })
+                backfill_status.value = backfill_head
+                backfill_status.save(self.session)
+                self.session.commit()
+
+    if not settings.HEAD_FOLLOWER:
+        # On a cold start the chain from head down to genesis is historical work
+        if end_block_hash is None and self.session.query(func.max(Block.id)).one()[0] is None:
+            queue = QUEUE_BACKFILL
+        else:
+            queue = QUEUE_TIP
+
+        accumulate_block_recursive.apply_async((start_block_hash, end_block_hash), queue=queue)
+
+        block_sets.append({
+            'start_block_hash': start_block_hash,
+            'end_block_hash': end_block_hash
+        })
+
+    if settings.BLOCK_RANGE_QUEUE:
+        block_range_task_ids = dispatch_block_range_workers(self.session)
+    else:
+        block_range_task_ids = None
 
     return {
         'result': 'Harvester job started',
         'block_sets': block_sets,
-        'sequencer_task_id': sequencer_task.task_id
+        'sequencer_task_id': sequencer_task.task_id,
+        'block_range_task_ids': block_range_task_ids
     }
 
 
@@ -358,11 +977,7 @@ def balance_snapshot(self, account_id=None, block_start=1, block_end=None, block
 
         if block_end is None:
             # Set block end to chaintip
-            substrate = SubstrateInterface(
-                url=SUBSTRATE_RPC_URL,
-                runtime_config=RuntimeConfiguration(),
-                type_registry_preset=settings.TYPE_REGISTRY
-            )
+            substrate = self.borrow_substrate()
             block_end = substrate.get_block_number(substrate.get_chain_finalised_head())
 
         block_range = range(block_start, block_end + 1)
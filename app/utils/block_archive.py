@@ -0,0 +1,314 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  block_archive.py
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+
+from app import settings
+
+# Block archive of the current process, opened on first use
+block_archive = None
+
+# Index entry per block number in segment: offset and length of record in data file, length 0 if not archived
+INDEX_ENTRY = struct.Struct('<QI')
+
+# Record header: block hash, header length, amount of digest logs, body length, events length
+RECORD_HEADER = struct.Struct('<32sIIII')
+
+LOG_LENGTH = struct.Struct('<I')
+
+# Events length of blocks without System.Events storage
+NO_EVENTS = 0xffffffff
+
+
+def encode_compact(value):
+    if value < 1 << 6:
+        return bytes([value << 2])
+    elif value < 1 << 14:
+        return ((value << 2) | 1).to_bytes(2, 'little')
+    elif value < 1 << 30:
+        return ((value << 2) | 2).to_bytes(4, 'little')
+    else:
+        length = (value.bit_length() + 7) // 8
+        return bytes([((length - 4) << 2) | 3]) + value.to_bytes(length, 'little')
+
+
+def decode_compact(data, offset=0):
+    """
+    :return: tuple (value, offset after compact)
+    """
+    mode = data[offset] & 3
+
+    if mode == 0:
+        return data[offset] >> 2, offset + 1
+    elif mode == 1:
+        return int.from_bytes(data[offset:offset + 2], 'little') >> 2, offset + 2
+    elif mode == 2:
+        return int.from_bytes(data[offset:offset + 4], 'little') >> 2, offset + 4
+    else:
+        length = (data[offset] >> 2) + 4
+        return int.from_bytes(data[offset + 1:offset + 1 + length], 'little'), offset + 1 + length
+
+
+def hex_to_bytes(value):
+    return bytes.fromhex(value[2:] if value.startswith('0x') else value)
+
+
+def bytes_to_hex(value):
+    return '0x{}'.format(bytes(value).hex())
+
+
+class ArchivedBlock(object):
+    """
+    Raw SCALE data of an archived block. Fields are memoryviews on the memory-mapped segment file, so nothing is copied
+    until converted.
+    """
+
+    def __init__(self, record):
+        block_hash, header_length, log_count, body_length, events_length = RECORD_HEADER.unpack_from(record)
+
+        offset = RECORD_HEADER.size
+
+        self.block_hash = bytes_to_hex(block_hash)
+        self.log_lengths = [
+            LOG_LENGTH.unpack_from(record, offset + nr * LOG_LENGTH.size)[0] for nr in range(log_count)
+        ]
+        offset += log_count * LOG_LENGTH.size
+
+        self.header = record[offset:offset + header_length]
+        offset += header_length
+
+        self.body = record[offset:offset + body_length]
+        offset += body_length
+
+        if events_length == NO_EVENTS:
+            self.events = None
+        else:
+            self.events = record[offset:offset + events_length]
+
+    def verify(self):
+        """
+        :return: True if the blake2 hash of the header matches the block hash
+        """
+        return bytes_to_hex(hashlib.blake2b(self.header, digest_size=32).digest()) == self.block_hash
+
+    def get_header(self):
+        """
+        :return: header as returned by chain_getHeader
+        """
+        number, offset = decode_compact(self.header, 32)
+        state_root = self.header[offset:offset + 32]
+        extrinsics_root = self.header[offset + 32:offset + 64]
+
+        log_count, offset = decode_compact(self.header, offset + 64)
+
+        logs = []
+        for log_length in self.log_lengths:
+            logs.append(bytes_to_hex(self.header[offset:offset + log_length]))
+            offset += log_length
+
+        return {
+            'parentHash': bytes_to_hex(self.header[0:32]),
+            'number': hex(number),
+            'stateRoot': bytes_to_hex(state_root),
+            'extrinsicsRoot': bytes_to_hex(extrinsics_root),
+            'digest': {'logs': logs}
+        }
+
+    def get_extrinsics(self):
+        """
+        :return: list of memoryviews of SCALE encoded extrinsics, including their length prefix
+        """
+        count, offset = decode_compact(self.body)
+
+        extrinsics = []
+        for nr in range(count):
+            length, data_offset = decode_compact(self.body, offset)
+            extrinsics.append(self.body[offset:data_offset + length])
+            offset = data_offset + length
+
+        return extrinsics
+
+    def get_chain_block(self):
+        """
+        :return: block as returned by chain_getBlock
+        """
+        return {
+            'block': {
+                'header': self.get_header(),
+                'extrinsics': [bytes_to_hex(extrinsic) for extrinsic in self.get_extrinsics()]
+            },
+            'justification': None
+        }
+
+    def get_events_data(self):
+        """
+        :return: hex string of System.Events storage as returned by state_getStorageAt, None if not available
+        """
+        if self.events is not None:
+            return bytes_to_hex(self.events)
+
+
+class BlockArchive(object):
+    """
+    Archive of the raw SCALE encoded header, extrinsics and System.Events storage of harvested blocks.
+
+    Every `segment_size` block numbers share an append-only data file and an index file with a fixed size entry per
+    block number. Both are read through mmap. A re-added block (e.g. after a reorg) is appended again and its index
+    entry replaced. Appends are serialized with a file lock, so processes can share an archive directory.
+    """
+
+    def __init__(self, path, segment_size):
+        self.path = path
+        self.segment_size = segment_size
+        self.write_fds = {}
+        self.data_maps = {}
+        self.index_maps = {}
+
+        os.makedirs(path, exist_ok=True)
+
+    def get_segment_paths(self, segment):
+        return (
+            os.path.join(self.path, '{:08d}.dat'.format(segment)),
+            os.path.join(self.path, '{:08d}.idx'.format(segment))
+        )
+
+    def get_write_fds(self, segment):
+        if segment not in self.write_fds:
+            data_path, index_path = self.get_segment_paths(segment)
+
+            data_fd = os.open(data_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            index_fd = os.open(index_path, os.O_RDWR | os.O_CREAT, 0o644)
+
+            if os.fstat(index_fd).st_size < self.segment_size * INDEX_ENTRY.size:
+                # Sparse file, unused entries read as zero length
+                os.ftruncate(index_fd, self.segment_size * INDEX_ENTRY.size)
+
+            self.write_fds[segment] = (data_fd, index_fd)
+
+        return self.write_fds[segment]
+
+    def add_block(self, block_number, block_hash, header, extrinsics, events_data):
+        """
+        Appends block to archive
+
+        :param block_number:
+        :param block_hash:
+        :param header: dict with header fields as returned by chain_getHeader
+        :param extrinsics: list of hex strings as returned by chain_getBlock
+        :param events_data: hex string of System.Events storage or None
+        """
+        logs = [hex_to_bytes(log) for log in header.get('digest', {}).get('logs', [])]
+
+        header_data = b''.join([
+            hex_to_bytes(header['parentHash']),
+            encode_compact(block_number),
+            hex_to_bytes(header['stateRoot']),
+            hex_to_bytes(header['extrinsicsRoot']),
+            encode_compact(len(logs))
+        ] + logs)
+
+        body_data = b''.join([encode_compact(len(extrinsics))] + [hex_to_bytes(extrinsic) for extrinsic in extrinsics])
+
+        if events_data is None:
+            events = b''
+            events_length = NO_EVENTS
+        else:
+            events = hex_to_bytes(events_data)
+            events_length = len(events)
+
+        record = b''.join([
+            RECORD_HEADER.pack(hex_to_bytes(block_hash), len(header_data), len(logs), len(body_data), events_length)
+        ] + [LOG_LENGTH.pack(len(log)) for log in logs] + [header_data, body_data, events])
+
+        segment, position = divmod(block_number, self.segment_size)
+        data_fd, index_fd = self.get_write_fds(segment)
+
+        fcntl.flock(data_fd, fcntl.LOCK_EX)
+        try:
+            offset = os.fstat(data_fd).st_size
+            os.write(data_fd, record)
+            os.pwrite(index_fd, INDEX_ENTRY.pack(offset, len(record)), position * INDEX_ENTRY.size)
+        finally:
+            fcntl.flock(data_fd, fcntl.LOCK_UN)
+
+    def get_map(self, maps, path, min_size):
+        current_map = maps.get(path)
+
+        if current_map is None or len(current_map) < min_size:
+            if not os.path.exists(path) or os.path.getsize(path) < min_size:
+                return None
+
+            with open(path, 'rb') as f:
+                # Previous map is not closed, memoryviews of returned blocks can still refer to it
+                current_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            maps[path] = current_map
+
+        return current_map
+
+    def get_block(self, block_number):
+        """
+        :param block_number:
+        :return: ArchivedBlock or None if block number is not archived
+        """
+        segment, position = divmod(block_number, self.segment_size)
+        data_path, index_path = self.get_segment_paths(segment)
+
+        index_map = self.get_map(self.index_maps, index_path, (position + 1) * INDEX_ENTRY.size)
+
+        if index_map is None:
+            return None
+
+        offset, length = INDEX_ENTRY.unpack_from(index_map, position * INDEX_ENTRY.size)
+
+        if length == 0:
+            return None
+
+        data_map = self.get_map(self.data_maps, data_path, offset + length)
+
+        if data_map is None:
+            return None
+
+        return ArchivedBlock(memoryview(data_map)[offset:offset + length])
+
+    def close(self):
+        for data_fd, index_fd in self.write_fds.values():
+            os.close(data_fd)
+            os.close(index_fd)
+
+        self.write_fds = {}
+
+
+def get_block_archive():
+    """
+    Returns the block archive of the current process, None when BLOCK_ARCHIVE_PATH is not set
+
+    :return: BlockArchive
+    """
+    global block_archive
+
+    if block_archive is None and settings.BLOCK_ARCHIVE_PATH:
+        block_archive = BlockArchive(settings.BLOCK_ARCHIVE_PATH, settings.BLOCK_ARCHIVE_SEGMENT_SIZE)
+
+    return block_archive
@@ -0,0 +1,172 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  block_index.py
+
+import time
+
+from app import settings
+from app.models.data import Block
+
+# Index of the current process, loaded on first use
+block_index = None
+
+
+class BlockIndex(object):
+    """
+    Compact index of harvested blocks: a bitmap of block ids and a bloom filter of block hashes.
+
+    A positive hash lookup is confirmed in the database. Before a negative lookup is trusted, blocks with an id above
+    the highest loaded id are added from the database (at most every BLOCK_INDEX_DELTA_INTERVAL seconds), so blocks
+    other processes added at the chain tip are known. Blocks other processes added below that id are only known after
+    the next reload, the unique block id still prevents adding them twice.
+    """
+
+    # Block hashes are uniformly distributed, so slices of the hash itself are used as bloom filter hash functions
+    BLOOM_HASH_FUNCTIONS = 7
+    BLOOM_BITS_PER_BLOCK = 10
+
+    def __init__(self, capacity):
+        self.bloom_bits = max(capacity, 1) * self.BLOOM_BITS_PER_BLOCK
+        self.bloom = bytearray(self.bloom_bits // 8 + 1)
+        self.ids = bytearray()
+        self.max_block_id = None
+        # Highest block id read from the database, blocks added by this process don't count
+        self.loaded_max_block_id = None
+        self.loaded_at = time.time()
+        self.refreshed_at = self.loaded_at
+
+    @classmethod
+    def load(cls, session):
+        index = cls(capacity=settings.BLOCK_INDEX_CAPACITY)
+
+        index.add_loaded(session.query(Block.id, Block.hash).yield_per(10000))
+
+        return index
+
+    def add_loaded(self, rows):
+        for block_id, block_hash in rows:
+            self.add(block_id, block_hash)
+
+            if self.loaded_max_block_id is None or block_id > self.loaded_max_block_id:
+                self.loaded_max_block_id = block_id
+
+    def refresh(self, session):
+        """
+        Adds the blocks with an id above the highest loaded block id
+        """
+        query = session.query(Block.id, Block.hash)
+
+        if self.loaded_max_block_id is not None:
+            query = query.filter(Block.id > self.loaded_max_block_id)
+
+        self.add_loaded(query.yield_per(10000))
+        self.refreshed_at = time.time()
+
+    def bloom_positions(self, block_hash):
+        data = bytes.fromhex(block_hash[2:])
+
+        return [
+            int.from_bytes(data[nr * 4:nr * 4 + 4], 'little') % self.bloom_bits
+            for nr in range(self.BLOOM_HASH_FUNCTIONS)
+        ]
+
+    def add(self, block_id, block_hash):
+        if block_id // 8 >= len(self.ids):
+            self.ids.extend(bytes(block_id // 8 - len(self.ids) + 1024))
+
+        self.ids[block_id // 8] |= 1 << (block_id % 8)
+
+        for position in self.bloom_positions(block_hash):
+            self.bloom[position // 8] |= 1 << (position % 8)
+
+        if self.max_block_id is None or block_id > self.max_block_id:
+            self.max_block_id = block_id
+
+    def remove(self, block_id):
+        # Hash stays in bloom filter, lookups of the removed hash fall back to the database
+        if block_id // 8 < len(self.ids):
+            self.ids[block_id // 8] &= ~(1 << (block_id % 8)) & 0xff
+
+    def contains_id(self, block_id):
+        return block_id // 8 < len(self.ids) and bool(self.ids[block_id // 8] & (1 << (block_id % 8)))
+
+    def might_contain_hash(self, block_hash):
+        return all(self.bloom[position // 8] & (1 << (position % 8)) for position in self.bloom_positions(block_hash))
+
+    def block_exists(self, session, block_hash):
+        if not self.might_contain_hash(block_hash):
+            if time.time() - self.refreshed_at < settings.BLOCK_INDEX_DELTA_INTERVAL:
+                return False
+
+            self.refresh(session)
+
+            if not self.might_contain_hash(block_hash):
+                return False
+
+        return Block.query(session).filter_by(hash=block_hash).count() > 0
+
+    def get_missing_block_ids(self):
+        """
+        Ranges of missing block ids below the highest indexed block, in the same format and order as
+        `Block.get_missing_block_ids()`
+
+        :return: list of dicts with 'block_from' and 'block_to'
+        """
+        missing = []
+        block_from = None
+
+        if self.max_block_id is None:
+            return missing
+
+        block_id = 1
+
+        while block_id <= self.max_block_id:
+
+            if block_id % 8 == 0 and block_from is None and self.ids[block_id // 8] == 0xff:
+                # Skip fully harvested byte
+                block_id += 8
+                continue
+
+            if self.contains_id(block_id):
+                if block_from is not None:
+                    missing.append({'block_from': block_from, 'block_to': block_id - 1})
+                    block_from = None
+            elif block_from is None:
+                block_from = block_id
+
+            block_id += 1
+
+        missing.reverse()
+
+        return missing
+
+
+def get_block_index(session):
+    """
+    Returns the block index of the current process, (re)loaded from `data_block` when not loaded yet or older than
+    BLOCK_INDEX_RELOAD_INTERVAL seconds
+
+    :return: BlockIndex
+    """
+    global block_index
+
+    if block_index is None or time.time() - block_index.loaded_at > settings.BLOCK_INDEX_RELOAD_INTERVAL:
+        block_index = BlockIndex.load(session)
+
+    return block_index
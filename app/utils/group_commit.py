@@ -0,0 +1,98 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  group_commit.py
+
+import time
+
+from app import settings
+from app.models.base import pop_rows_written
+from app.utils.block_index import get_block_index
+
+
+class GroupCommit(object):
+    """
+    Commits added blocks in groups of `max_blocks` or when the oldest uncommitted block is older than `max_interval`
+    milliseconds, whichever comes first. `rollback()` reverts to the last committed block.
+    """
+
+    def __init__(self, session, max_blocks=None, max_interval=None):
+        self.session = session
+        self.max_blocks = max_blocks or settings.GROUP_COMMIT_BLOCKS
+        self.max_interval = (max_interval or settings.GROUP_COMMIT_INTERVAL) / 1000
+
+        self.pending_blocks = []
+        self.group_started = None
+
+        self.commits = 0
+        self.committed_blocks = 0
+        self.committed_rows = 0
+        self.commit_time = 0
+        self.rolled_back_blocks = 0
+
+    def add(self, block):
+        """
+        Registers an added block, commits when the group is complete
+
+        :return: True if committed
+        """
+        if not self.pending_blocks:
+            self.group_started = time.time()
+
+        self.pending_blocks.append(block)
+
+        if len(self.pending_blocks) >= self.max_blocks or time.time() - self.group_started >= self.max_interval:
+            self.commit()
+            return True
+
+        return False
+
+    def commit(self):
+        rows = pop_rows_written(self.session)
+
+        start = time.time()
+        self.session.commit()
+        self.commit_time += time.time() - start
+
+        if self.pending_blocks:
+            self.commits += 1
+            self.committed_blocks += len(self.pending_blocks)
+            self.committed_rows += rows
+
+        self.pending_blocks = []
+
+    def rollback(self):
+        pop_rows_written(self.session)
+        self.session.rollback()
+
+        if settings.BLOCK_INDEX:
+            block_index = get_block_index(self.session)
+            for block in self.pending_blocks:
+                block_index.remove(block.id)
+
+        self.rolled_back_blocks += len(self.pending_blocks)
+        self.pending_blocks = []
+
+    def stats(self):
+        return {
+            'commits': self.commits,
+            'blocksPerCommit': round(self.committed_blocks / self.commits, 2) if self.commits else None,
+            'rowsPerCommit': round(self.committed_rows / self.commits, 2) if self.commits else None,
+            'commitLatencyMs': round(self.commit_time / self.commits * 1000, 2) if self.commits else None,
+            'rolledBackBlocks': self.rolled_back_blocks
+        }
@@ -0,0 +1,321 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  metadata_cache.py
+
+import fcntl
+import hashlib
+import io
+import json
+import mmap
+import os
+import pickle
+import struct
+import sys
+import time
+from collections import OrderedDict
+
+from scalecodec.base import RuntimeConfiguration, RuntimeConfigurationObject
+
+from app import settings
+
+try:
+    from importlib.metadata import version as get_package_version
+except ImportError:
+    get_package_version = None
+
+# Metadata cache of the current process, created on first use
+metadata_cache = None
+
+# Increase when the pickled form changes, files of other versions are ignored
+METADATA_CACHE_VERSION = 2
+
+# Record header: spec version, length of pickled metadata
+RECORD_HEADER = struct.Struct('<II')
+
+
+def get_scalecodec_version():
+    try:
+        return get_package_version('scalecodec') if get_package_version else None
+    except Exception:
+        return None
+
+
+class MetadataPickler(pickle.Pickler):
+    """
+    Pickles decoded metadata without the runtime configuration and the decoder classes that scalecodec creates at
+    runtime, those are resolved again in the current process when loaded
+    """
+
+    def persistent_id(self, obj):
+        if isinstance(obj, RuntimeConfigurationObject):
+            return 'runtime_config',
+
+        if isinstance(obj, type) and getattr(sys.modules.get(obj.__module__), obj.__qualname__, None) is not obj:
+            return 'decoder_class', obj.__name__
+
+        return None
+
+
+class MetadataUnpickler(pickle.Unpickler):
+
+    def persistent_load(self, pid):
+        if pid[0] == 'runtime_config':
+            return RuntimeConfiguration()
+
+        if pid[0] == 'decoder_class':
+            decoder_class = RuntimeConfiguration().get_decoder_class(pid[1])
+            if decoder_class is None:
+                raise pickle.UnpicklingError('Unknown decoder class {}'.format(pid[1]))
+            return decoder_class
+
+        raise pickle.UnpicklingError('Unsupported persistent id {}'.format(pid))
+
+
+class MetadataCache(object):
+    """
+    Decoded metadata per spec version, pickled into one append-only file in `path` that all processes of a host
+    memory-map, so a spec version is retrieved and decoded once instead of in every worker process and after every
+    restart. Use a directory per chain.
+
+    The file name contains a hash of the cache format version, scalecodec version and type registry, so other versions
+    are never read. An index of spec version to offset is built by scanning the record headers of the mapped file.
+    Appends are serialized with a file lock, a spec version already in the file is not written again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.header = {
+            'version': METADATA_CACHE_VERSION,
+            'scalecodec': get_scalecodec_version(),
+            'type_registry': settings.TYPE_REGISTRY,
+            'type_registry_file': settings.TYPE_REGISTRY_FILE
+        }
+        self.file_path = os.path.join(self.path, 'metadata-{}.dat'.format(
+            hashlib.sha1(json.dumps(self.header, sort_keys=True).encode()).hexdigest()[:16]
+        ))
+
+        # Opened in the process that uses it, file locks are not shared with forked processes
+        self.pid = None
+        self.fd = None
+        self.data_map = None
+        self.index = {}
+        self.scanned_size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.load_time = 0
+
+        os.makedirs(path, exist_ok=True)
+
+    def open(self):
+        if self.pid != os.getpid():
+            self.fd = os.open(self.file_path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+            self.pid = os.getpid()
+            self.data_map = None
+            self.index = {}
+            self.scanned_size = 0
+
+    def refresh(self):
+        """
+        Maps the file again when it was extended by any process and adds the new records to the index
+        """
+        self.open()
+
+        size = os.fstat(self.fd).st_size
+
+        if size <= self.scanned_size:
+            return
+
+        # Previous map is not closed, data being unpickled can still refer to it
+        self.data_map = mmap.mmap(self.fd, size, access=mmap.ACCESS_READ)
+
+        offset = self.scanned_size
+
+        while offset + RECORD_HEADER.size <= size:
+            spec_version, length = RECORD_HEADER.unpack_from(self.data_map, offset)
+
+            if offset + RECORD_HEADER.size + length > size:
+                # Record still being written
+                break
+
+            # First record of a spec version is used
+            self.index.setdefault(spec_version, (offset + RECORD_HEADER.size, length))
+            offset += RECORD_HEADER.size + length
+
+        self.scanned_size = offset
+
+    def contains(self, spec_version):
+        if spec_version not in self.index:
+            self.refresh()
+
+        return spec_version in self.index
+
+    def get(self, spec_version):
+        """
+        :return: MetadataDecoder or None if not cached
+        """
+        if not self.contains(spec_version):
+            self.misses += 1
+            return None
+
+        start = time.time()
+
+        offset, length = self.index[spec_version]
+
+        try:
+            metadata_decoder = MetadataUnpickler(io.BytesIO(self.data_map[offset:offset + length])).load()
+        except Exception as e:
+            print('! Metadata cache of spec version {} not loaded: {}'.format(spec_version, e))
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.load_time += time.time() - start
+
+        return metadata_decoder
+
+    def set(self, spec_version, metadata_decoder):
+        try:
+            data = io.BytesIO()
+            MetadataPickler(data, protocol=pickle.HIGHEST_PROTOCOL).dump(metadata_decoder)
+            data = data.getvalue()
+        except Exception as e:
+            print('! Metadata of spec version {} not cached: {}'.format(spec_version, e))
+            return
+
+        self.open()
+
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            # Another process could have added it meanwhile
+            self.refresh()
+
+            if spec_version not in self.index:
+                os.write(self.fd, RECORD_HEADER.pack(spec_version, len(data)) + data)
+                self.writes += 1
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes,
+            'loadTimeMs': round(self.load_time / self.hits * 1000, 2) if self.hits else None,
+            'specVersions': len(self.index),
+            'mappedSize': self.scanned_size,
+            'rss': get_rss()
+        }
+
+
+class MetadataStore(OrderedDict):
+    """
+    Dict of decoded metadata per spec version, backed by the metadata cache. Missing spec versions are loaded from the
+    cache on first use and added spec versions are written to it.
+
+    At most `max_size` decoded spec versions are kept in memory, the least recently used ones that are in the cache
+    are dropped and loaded from the mapped file again when needed. 0 keeps all.
+    """
+
+    def __init__(self, cache, max_size=0):
+        super().__init__()
+        self.cache = cache
+        self.max_size = max_size
+
+    def load(self, spec_version):
+        if OrderedDict.__contains__(self, spec_version):
+            self.move_to_end(spec_version)
+        else:
+            metadata_decoder = self.cache.get(spec_version)
+            if metadata_decoder is not None:
+                OrderedDict.__setitem__(self, spec_version, metadata_decoder)
+                self.evict()
+
+    def evict(self):
+        if not self.max_size:
+            return
+
+        for spec_version in list(self.keys())[:-self.max_size]:
+            if self.cache.contains(spec_version):
+                OrderedDict.__delitem__(self, spec_version)
+
+    def __contains__(self, spec_version):
+        self.load(spec_version)
+        return OrderedDict.__contains__(self, spec_version)
+
+    def __getitem__(self, spec_version):
+        self.load(spec_version)
+        return OrderedDict.__getitem__(self, spec_version)
+
+    def get(self, spec_version, default=None):
+        self.load(spec_version)
+        return OrderedDict.get(self, spec_version, default)
+
+    def __setitem__(self, spec_version, metadata_decoder):
+        if OrderedDict.get(self, spec_version) is not metadata_decoder and not self.cache.contains(spec_version):
+            self.cache.set(spec_version, metadata_decoder)
+        OrderedDict.__setitem__(self, spec_version, metadata_decoder)
+        self.move_to_end(spec_version)
+        self.evict()
+
+
+def get_rss():
+    """
+    :return: resident set size in bytes of the current process, None if not available
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def get_metadata_cache():
+    """
+    Returns the metadata cache of the current process, None when METADATA_CACHE_PATH is not set
+
+    :return: MetadataCache
+    """
+    global metadata_cache
+
+    if metadata_cache is None and settings.METADATA_CACHE_PATH:
+        metadata_cache = MetadataCache(settings.METADATA_CACHE_PATH)
+
+    return metadata_cache
+
+
+def create_metadata_store():
+    """
+    :return: MetadataStore backed by the metadata cache, a plain dict when METADATA_CACHE_PATH is not set
+    """
+    cache = get_metadata_cache()
+
+    if cache:
+        return MetadataStore(cache, max_size=settings.METADATA_STORE_SIZE)
+
+    return {}
+
+
+def get_metadata_cache_stats():
+    """
+    :return: dict with hit, miss and write counters and RSS of the current process, None if metadata cache disabled
+    """
+    if metadata_cache:
+        return metadata_cache.stats()
@@ -0,0 +1,179 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  response_cache.py
+
+import json
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+from app import settings
+
+# Response cache of the current process, created on first use
+response_cache = None
+
+BLOCK_HASH_PATTERN = re.compile('^0x[0-9a-fA-F]{64}$')
+
+# Methods of which the response is immutable when the last param is a block hash
+CACHEABLE_METHODS = {
+    'chain_getBlock': 1,
+    'chain_getHeader': 1,
+    'chain_getRuntimeVersion': 1,
+    'state_getMetadata': 1,
+    'state_getStorageAt': 2
+}
+
+
+class RPCResponseCache(object):
+    """
+    Persistent cache of RPC responses that are immutable because they are requested at a specific block hash, stored
+    zlib compressed in a sqlite file that can be shared by the processes of a host.
+
+    When the total size exceeds `max_size` bytes, the least recently used responses are evicted.
+    """
+
+    # Fraction of max size the cache is reduced to on eviction, so not every insert triggers one
+    EVICT_TO = 0.9
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS rpc_response '
+            '(key TEXT PRIMARY KEY, response BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS ix_rpc_response_accessed ON rpc_response (accessed)')
+
+        self.size = self.get_size()
+
+    @staticmethod
+    def is_cacheable(method, params):
+        param_count = CACHEABLE_METHODS.get(method)
+
+        return param_count is not None and len(params) == param_count and \
+            isinstance(params[-1], str) and BLOCK_HASH_PATTERN.match(params[-1]) is not None
+
+    def get_size(self):
+        with self.lock:
+            return self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM rpc_response').fetchone()[0]
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute('SELECT response FROM rpc_response WHERE key = ?', (key,)).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.connection.execute('UPDATE rpc_response SET accessed = ? WHERE key = ?', (time.time(), key))
+
+        return json.loads(zlib.decompress(row[0]).decode())
+
+    def set(self, key, response):
+        # Unknown blocks and empty storage are not cached, the node could know them later
+        if response.get('result') is None or 'error' in response:
+            return
+
+        data = zlib.compress(json.dumps(response, separators=(',', ':')).encode())
+
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO rpc_response (key, response, size, accessed) VALUES (?, ?, ?, ?)',
+                (key, data, len(data), time.time())
+            )
+            self.size += len(data)
+
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            # Other processes share the file, so size is recalculated first
+            self.size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM rpc_response').fetchone()[0]
+            excess = self.size - int(self.max_size * self.EVICT_TO)
+
+            if excess <= 0:
+                return
+
+            keys = []
+            freed = 0
+
+            for key, size in self.connection.execute('SELECT key, size FROM rpc_response ORDER BY accessed'):
+                keys.append(key)
+                freed += size
+
+                if freed >= excess:
+                    break
+
+            self.connection.execute('BEGIN')
+            self.connection.executemany('DELETE FROM rpc_response WHERE key = ?', [(key,) for key in keys])
+            self.connection.execute('COMMIT')
+
+            self.size -= freed
+            self.evictions += len(keys)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': self.size
+        }
+
+
+def get_response_cache():
+    """
+    Returns the RPC response cache of the current process, None when RPC_CACHE_PATH is not set
+
+    :return: RPCResponseCache
+    """
+    global response_cache
+
+    if response_cache is None and settings.RPC_CACHE_PATH:
+        response_cache = RPCResponseCache(settings.RPC_CACHE_PATH, settings.RPC_CACHE_MAX_SIZE * 1024 * 1024)
+
+    return response_cache
+
+
+def reset_response_cache():
+    """
+    Drops the response cache inherited from the parent in a forked process, its sqlite connection can't be shared
+    """
+    global response_cache
+
+    response_cache = None
+
+
+def get_response_cache_stats():
+    """
+    :return: dict with hit, miss and eviction counters of the response cache of the current process, None if disabled
+    """
+    if response_cache:
+        return response_cache.stats()
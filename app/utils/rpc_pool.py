@@ -0,0 +1,272 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  rpc_pool.py
+
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+from requests.adapters import HTTPAdapter
+from substrateinterface.exceptions import SubstrateRequestException
+
+from app import settings
+
+# Endpoint pool of the current process, created on first use
+rpc_pool = None
+
+
+class RPCEndpoint(object):
+
+    # Weight of the latest request in the moving average of the latency
+    LATENCY_SMOOTHING = 0.2
+
+    def __init__(self, url, max_connections):
+        self.url = url
+        self.http_session = requests.Session()
+        self.http_session.mount(url, HTTPAdapter(pool_connections=1, pool_maxsize=max_connections))
+
+        self.latency = None
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.hedged = 0
+        self.healthy = True
+        self.unhealthy_until = 0
+        self.last_error = None
+
+    def update_latency(self, duration):
+        if self.latency is None:
+            self.latency = duration
+        else:
+            self.latency += self.LATENCY_SMOOTHING * (duration - self.latency)
+
+    def as_dict(self):
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'latency_ms': round(self.latency * 1000, 1) if self.latency is not None else None,
+            'in_flight': self.in_flight,
+            'requests': self.requests,
+            'errors': self.errors,
+            'hedged': self.hedged,
+            'last_error': self.last_error
+        }
+
+
+class RPCEndpointPool(object):
+    """
+    Spreads JSON-RPC HTTP requests over multiple endpoints. The endpoint with the lowest expected wait, the average
+    latency multiplied by the amount of requests in flight, is selected. When a request does not complete within the
+    hedge delay, a duplicate is sent to the next best endpoint and the first response is used.
+
+    Endpoints that fail are skipped for RPC_ENDPOINT_RETRY_INTERVAL seconds and the request is retried on another
+    endpoint. JSON-RPC errors are valid responses and are returned as is.
+    """
+
+    # Assumed latency of endpoints without completed requests
+    DEFAULT_LATENCY = 0.05
+
+    def __init__(self, urls, hedge_delay=None, hedge_latency_factor=None, retry_interval=None, max_workers=None):
+        self.max_workers = max_workers or settings.RPC_POOL_MAX_WORKERS
+        self.endpoints = [RPCEndpoint(url, self.max_workers) for url in urls]
+        self.hedge_delay = settings.RPC_HEDGE_DELAY / 1000 if hedge_delay is None else hedge_delay
+        self.hedge_latency_factor = hedge_latency_factor or settings.RPC_HEDGE_LATENCY_FACTOR
+        self.retry_interval = retry_interval or settings.RPC_ENDPOINT_RETRY_INTERVAL
+
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def select_endpoint(self, exclude=()):
+        now = time.time()
+
+        with self.lock:
+            candidates = [
+                endpoint for endpoint in self.endpoints
+                if endpoint not in exclude and (endpoint.healthy or endpoint.unhealthy_until <= now)
+            ]
+
+            if not candidates:
+                if exclude:
+                    return None
+                # All endpoints failed recently, try them anyway
+                candidates = self.endpoints
+
+            endpoint = min(
+                candidates,
+                key=lambda item: (item.latency or self.DEFAULT_LATENCY) * (item.in_flight + 1)
+            )
+            endpoint.in_flight += 1
+
+            return endpoint
+
+    def send(self, endpoint, data, headers):
+        """
+        Posts request to given endpoint, `select_endpoint()` already counted it as in flight. Raised errors get the
+        URL of the endpoint as `endpoint_url`.
+        """
+        start = time.time()
+
+        try:
+            response = endpoint.http_session.post(
+                endpoint.url, data=data, headers=headers, timeout=settings.RPC_REQUEST_TIMEOUT
+            )
+
+            if response.status_code != 200:
+                raise SubstrateRequestException(
+                    "RPC request to {} failed with HTTP status code {}".format(endpoint.url, response.status_code))
+
+            json_body = response.json()
+
+        except (requests.RequestException, ValueError, SubstrateRequestException) as e:
+            with self.lock:
+                endpoint.in_flight -= 1
+                endpoint.requests += 1
+                endpoint.errors += 1
+                endpoint.healthy = False
+                endpoint.unhealthy_until = time.time() + self.retry_interval
+                endpoint.last_error = str(e)
+
+            print('! RPC endpoint {} failed: {}'.format(endpoint.url, e))
+            e.endpoint_url = endpoint.url
+            raise
+
+        with self.lock:
+            endpoint.in_flight -= 1
+            endpoint.requests += 1
+            endpoint.healthy = True
+            endpoint.update_latency(time.time() - start)
+
+        return json_body
+
+    def get_hedge_delay(self, endpoint):
+        if endpoint.latency is None:
+            return self.hedge_delay
+
+        return max(self.hedge_delay, endpoint.latency * self.hedge_latency_factor)
+
+    def request(self, payload, headers=None):
+        """
+        Performs a JSON-RPC request or batch request on the best available endpoint. When all endpoints fail the error
+        of the last failed endpoint is raised, like a request without endpoint pool would.
+
+        :param payload: dict or list of dicts
+        :param headers:
+        :return: decoded JSON response body
+        """
+        data = json.dumps(payload)
+        tried = []
+        last_error = None
+
+        # Every endpoint is tried at most once
+        while len(tried) < len(self.endpoints):
+            endpoint = self.select_endpoint(exclude=tried)
+
+            if endpoint is None:
+                break
+
+            tried.append(endpoint)
+            futures = [self.executor.submit(self.send, endpoint, data, headers)]
+
+            if self.hedge_delay > 0 and len(tried) < len(self.endpoints):
+                done, pending = wait(futures, timeout=self.get_hedge_delay(endpoint))
+
+                if not done:
+                    hedge_endpoint = self.select_endpoint(exclude=tried)
+
+                    if hedge_endpoint:
+                        with self.lock:
+                            hedge_endpoint.hedged += 1
+
+                        tried.append(hedge_endpoint)
+                        futures.append(self.executor.submit(self.send, hedge_endpoint, data, headers))
+
+            pending = futures
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    if future.exception() is None:
+                        # Slower duplicate keeps running in the background and only updates the stats
+                        return future.result()
+
+                    last_error = future.exception()
+
+        if last_error is None:
+            raise SubstrateRequestException('No RPC endpoint available')
+
+        print('! RPC request failed on all endpoints, last error from {}: {!r}'.format(
+            last_error.endpoint_url, last_error
+        ))
+        raise last_error
+
+    def check_health(self):
+        """
+        Sends a `system_health` request to every endpoint, which also updates their health and latency
+
+        :return: list of endpoint stats
+        """
+        data = json.dumps({"jsonrpc": "2.0", "method": "system_health", "params": [], "id": 1})
+
+        for endpoint in self.endpoints:
+            with self.lock:
+                endpoint.in_flight += 1
+            try:
+                self.send(endpoint, data, {'content-type': "application/json", 'cache-control': "no-cache"})
+            except (requests.RequestException, ValueError, SubstrateRequestException):
+                pass
+
+        return self.stats()
+
+    def stats(self):
+        with self.lock:
+            return [endpoint.as_dict() for endpoint in self.endpoints]
+
+
+def get_rpc_pool():
+    """
+    Returns the RPC endpoint pool of the current process for SUBSTRATE_RPC_URLS, shared by all substrate interfaces
+
+    :return: RPCEndpointPool
+    """
+    global rpc_pool
+
+    if rpc_pool is None:
+        rpc_pool = RPCEndpointPool(settings.SUBSTRATE_RPC_URLS)
+
+    return rpc_pool
+
+
+def reset_rpc_pool():
+    """
+    Drops the RPC endpoint pool inherited from the parent in a forked process, its threads don't exist in the child
+    """
+    global rpc_pool
+
+    rpc_pool = None
+
+
+def get_rpc_pool_stats():
+    """
+    :return: list of endpoint stats of the RPC endpoint pool of the current process, None if not in use
+    """
+    if rpc_pool:
+        return rpc_pool.stats()
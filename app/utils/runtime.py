@@ -0,0 +1,232 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  runtime.py
+
+import bisect
+from collections import OrderedDict
+
+from app.models.base import bulk_insert, supports_upsert, upsert
+from app.models.data import RuntimeInterval, RuntimeDefinitionVersion, RuntimeCallDefinition, \
+    RuntimeCallParamDefinition, RuntimeEventDefinition, RuntimeEventAttributeDefinition, RuntimeStorageDefinition, \
+    RuntimeConstantDefinition, RuntimeTypeDefinition
+
+# Definition model per RuntimeDefinitionVersion kind
+DEFINITION_MODELS = {
+    RuntimeDefinitionVersion.KIND_CALL: RuntimeCallDefinition,
+    RuntimeDefinitionVersion.KIND_EVENT: RuntimeEventDefinition,
+    RuntimeDefinitionVersion.KIND_STORAGE: RuntimeStorageDefinition,
+    RuntimeDefinitionVersion.KIND_CONSTANT: RuntimeConstantDefinition,
+    RuntimeDefinitionVersion.KIND_TYPE: RuntimeTypeDefinition
+}
+
+# Amount of hashes per IN clause when looking up existing definitions
+HASH_LOOKUP_SIZE = 1000
+
+
+class SpecVersionIndex(object):
+    """
+    Interval map from block number to the spec version of the runtime at that block, persisted in `RuntimeInterval`.
+
+    Runtime upgrades are located with a binary search over `chain_getRuntimeVersion`. This assumes a spec version
+    never returns to an earlier value, so equal spec versions at both ends of a range mean there is no upgrade in
+    between.
+    """
+
+    def __init__(self, intervals=None):
+        self.intervals = []
+        self.block_froms = []
+
+        for block_from, block_to, spec_version in sorted(intervals or []):
+            self.intervals.append([block_from, block_to, spec_version])
+            self.block_froms.append(block_from)
+
+    @classmethod
+    def load(cls, session):
+        return cls([
+            (interval.block_from, interval.block_to, interval.spec_version)
+            for interval in RuntimeInterval.query(session)
+        ])
+
+    @property
+    def block_to(self):
+        if self.intervals:
+            return self.intervals[-1][1]
+
+    def get_spec_version(self, block_number):
+        """
+        :param block_number:
+        :return: spec version of the runtime at given block number or None if not indexed (yet)
+        """
+        idx = bisect.bisect_right(self.block_froms, block_number) - 1
+
+        if idx >= 0 and block_number <= self.intervals[idx][1]:
+            return self.intervals[idx][2]
+
+    @staticmethod
+    def retrieve_spec_version(substrate, block_number):
+        runtime_version = substrate.get_block_runtime_version(substrate.get_block_hash(block_number))
+        return runtime_version['specVersion']
+
+    def find_upgrades(self, substrate, block_from, spec_from, block_to, spec_to, upgrades):
+        if spec_from == spec_to:
+            return
+
+        if block_to - block_from == 1:
+            upgrades.append((block_to, spec_to))
+            return
+
+        block_mid = (block_from + block_to) // 2
+        spec_mid = self.retrieve_spec_version(substrate, block_mid)
+
+        self.find_upgrades(substrate, block_from, spec_from, block_mid, spec_mid, upgrades)
+        self.find_upgrades(substrate, block_mid, spec_mid, block_to, spec_to, upgrades)
+
+    def update(self, session, substrate, head_block_number):
+        """
+        Extends the index up to `head_block_number` (should be finalised) and stores changed intervals
+
+        :return: list of (block number, spec version) of runtime upgrades found
+        """
+        if not self.intervals:
+            self.intervals.append([0, 0, self.retrieve_spec_version(substrate, 0)])
+            self.block_froms.append(0)
+
+        last_interval = self.intervals[-1]
+
+        if head_block_number <= last_interval[1]:
+            return []
+
+        upgrades = []
+
+        self.find_upgrades(
+            substrate, last_interval[1], last_interval[2],
+            head_block_number, self.retrieve_spec_version(substrate, head_block_number),
+            upgrades
+        )
+
+        changed_intervals = [last_interval]
+
+        for block_number, spec_version in upgrades:
+            self.intervals[-1][1] = block_number - 1
+            self.intervals.append([block_number, block_number, spec_version])
+            self.block_froms.append(block_number)
+            changed_intervals.append(self.intervals[-1])
+
+        self.intervals[-1][1] = head_block_number
+
+        for block_from, block_to, spec_version in changed_intervals:
+            session.merge(RuntimeInterval(block_from=block_from, block_to=block_to, spec_version=spec_version))
+
+        session.commit()
+
+        return upgrades
+
+
+class RuntimeDefinitionWriter(object):
+    """
+    Collects the calls, events, storage functions, constants and types of a spec version. `flush()` inserts the
+    definitions not stored by earlier spec versions and links all of them to the spec version.
+    """
+
+    def __init__(self, spec_version):
+        self.spec_version = spec_version
+        self.definitions = {kind: {} for kind in DEFINITION_MODELS}
+        self.children = {}
+        self.versions = []
+
+    def add(self, kind, values, children=None, module_id=None, index=None, lookup=None):
+        """
+        :param kind: RuntimeDefinitionVersion kind
+        :param values: dict of definition column values, without hash
+        :param children: list of dicts of RuntimeCallParamDefinition or RuntimeEventAttributeDefinition values
+        :return: definition hash
+        """
+        # Booleans are read back as integers from MySQL, hashes are calculated the same way for both
+        values = {key: int(value) if isinstance(value, bool) else value for key, value in values.items()}
+
+        definition_hash = DEFINITION_MODELS[kind].get_hash(kind, [values, children or []])
+
+        if definition_hash not in self.definitions[kind]:
+            self.definitions[kind][definition_hash] = values
+            self.children[definition_hash] = children or []
+
+        self.versions.append(RuntimeDefinitionVersion(
+            spec_version=self.spec_version,
+            kind=kind,
+            module_id=module_id,
+            index=index,
+            lookup=lookup,
+            definition_hash=definition_hash
+        ))
+
+        return definition_hash
+
+    def get_new_hashes(self, session, kind):
+        model = DEFINITION_MODELS[kind]
+        hashes = list(self.definitions[kind].keys())
+        existing = set()
+
+        for offset in range(0, len(hashes), HASH_LOOKUP_SIZE):
+            existing.update(row.hash for row in session.query(model.hash).filter(
+                model.hash.in_(hashes[offset:offset + HASH_LOOKUP_SIZE])
+            ))
+
+        return [definition_hash for definition_hash in hashes if definition_hash not in existing]
+
+    def flush(self, session):
+        """
+        Definitions and their params and attributes are upserted on MySQL, a concurrent worker storing another spec
+        version can insert the same definitions between the lookup of new hashes and the insert
+
+        :return: dict with amount of new definitions per kind
+        """
+        new_definitions = {}
+        rows = OrderedDict((model.__table__, []) for model in list(DEFINITION_MODELS.values()) + [
+            RuntimeCallParamDefinition, RuntimeEventAttributeDefinition
+        ])
+
+        for kind, model in DEFINITION_MODELS.items():
+            new_hashes = self.get_new_hashes(session, kind)
+            new_definitions[kind] = len(new_hashes)
+
+            for definition_hash in new_hashes:
+                rows[model.__table__].append(dict(self.definitions[kind][definition_hash], hash=definition_hash))
+
+                for position, child in enumerate(self.children[definition_hash]):
+                    if kind == RuntimeDefinitionVersion.KIND_CALL:
+                        rows[RuntimeCallParamDefinition.__table__].append(
+                            dict(child, call_hash=definition_hash, position=position)
+                        )
+                    elif kind == RuntimeDefinitionVersion.KIND_EVENT:
+                        rows[RuntimeEventAttributeDefinition.__table__].append(dict(child, event_hash=definition_hash))
+
+        for table, table_rows in rows.items():
+            if not table_rows:
+                continue
+
+            if supports_upsert(session):
+                upsert(session, table, table_rows)
+            else:
+                session.execute(table.insert(), table_rows)
+
+        with bulk_insert(session, [RuntimeDefinitionVersion]):
+            for runtime_definition_version in self.versions:
+                runtime_definition_version.save(session)
+
+        return new_definitions
@@ -0,0 +1,370 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  substrate.py
+
+import copy
+import json
+
+import requests
+
+from substrateinterface import SubstrateInterface
+from substrateinterface.constants import STORAGE_HASH_SYSTEM_EVENTS, STORAGE_HASH_SYSTEM_EVENTS_V9
+from substrateinterface.exceptions import SubstrateRequestException
+
+from app import settings
+from app.utils.response_cache import get_response_cache
+from app.utils.rpc_pool import get_rpc_pool
+
+
+class HarvesterSubstrateInterface(SubstrateInterface):
+    """
+    SubstrateInterface used by the harvester, adds JSON-RPC batch requests and a prefetch store of responses for a
+    window of blocks, so the existing block processing can be fed without separate round trips per block
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prefetch_store = {}
+        # Optional requests.Session to reuse HTTP connections
+        self.http_session = None
+        # Pool of SUBSTRATE_RPC_URLS, only used when multiple endpoints are configured
+        if len(settings.SUBSTRATE_RPC_URLS) > 1:
+            self.endpoint_pool = get_rpc_pool()
+        else:
+            self.endpoint_pool = None
+        # Persistent cache of immutable responses, when RPC_CACHE_PATH is set
+        self.response_cache = get_response_cache()
+        self.rpc_stats = {
+            'requests': 0,
+            'calls': 0,
+            'prefetched': 0,
+            'cached': 0
+        }
+
+    def reset(self):
+        """
+        Clears state of the previous user when borrowed from the substrate pool, the metadata cache is kept
+        """
+        self.prefetch_store = {}
+        self.http_session = None
+        self.mock_extrinsics = None
+        self.rpc_stats = {
+            'requests': 0,
+            'calls': 0,
+            'prefetched': 0,
+            'cached': 0
+        }
+
+    @staticmethod
+    def rpc_key(method, params):
+        return '{}:{}'.format(method, json.dumps(params, separators=(',', ':')))
+
+    def rpc_request(self, method, params, result_handler=None):
+
+        if not result_handler:
+            response = self.prefetch_store.get(self.rpc_key(method, params))
+
+            if response is not None:
+                self.rpc_stats['prefetched'] += 1
+                # Callers modify results in place (e.g. add_block pops header fields)
+                return copy.deepcopy(response)
+
+            if self.response_cache and self.response_cache.is_cacheable(method, params):
+                response = self.response_cache.get(self.rpc_key(method, params))
+
+                if response is not None:
+                    self.rpc_stats['cached'] += 1
+                    return response
+
+        self.rpc_stats['requests'] += 1
+        self.rpc_stats['calls'] += 1
+
+        if not self.websocket and not result_handler:
+            json_body = self.post_payload({
+                "jsonrpc": "2.0",
+                "method": method,
+                "params": params,
+                "id": self.request_id
+            })
+
+            self.request_id += 1
+
+            if 'error' in json_body:
+                raise SubstrateRequestException(json_body['error'])
+        else:
+            json_body = super().rpc_request(method, params, result_handler=result_handler)
+
+        if self.response_cache and not result_handler and self.response_cache.is_cacheable(method, params):
+            self.response_cache.set(self.rpc_key(method, params), json_body)
+
+        return json_body
+
+    def post_payload(self, payload):
+        """
+        Posts a JSON-RPC request or batch request over HTTP
+
+        :param payload: dict or list of dicts
+        :return: decoded JSON response body
+        """
+        if self.endpoint_pool:
+            return self.endpoint_pool.request(payload, headers=self.default_headers)
+
+        response = (self.http_session or requests).request(
+            "POST", self.url, data=json.dumps(payload), headers=self.default_headers
+        )
+
+        if response.status_code != 200:
+            raise SubstrateRequestException(
+                "RPC request failed with HTTP status code {}".format(response.status_code))
+
+        return response.json()
+
+    def set_runtime(self, block_hash, spec_version, metadata_decoder):
+        """
+        Sets the runtime state like `init_runtime()` does, for a block of which the runtime is already known, without
+        any RPC requests
+
+        :param block_hash:
+        :param spec_version: Spec version of the runtime of the parent block
+        :param metadata_decoder: Metadata of that runtime
+        """
+        self.block_hash = block_hash
+        self.block_id = None
+
+        if spec_version != self.runtime_version:
+            self.runtime_version = spec_version
+            self.transaction_version = None
+            self.metadata_decoder = metadata_decoder
+
+        self.runtime_config.set_active_spec_version_id(spec_version)
+
+    def rpc_batch_request(self, calls):
+        """
+        Performs a list of (method, params) calls in one JSON-RPC batch request
+
+        :param calls: list of (method, params) tuples
+        :return: list of responses in the same order as `calls`
+        """
+        if not calls:
+            return []
+
+        cached_responses = {}
+
+        if self.response_cache:
+            for idx, (method, params) in enumerate(calls):
+                if self.response_cache.is_cacheable(method, params):
+                    response = self.response_cache.get(self.rpc_key(method, params))
+
+                    if response is not None:
+                        cached_responses[idx] = response
+
+            self.rpc_stats['cached'] += len(cached_responses)
+
+            if len(cached_responses) == len(calls):
+                return [cached_responses[idx] for idx in range(len(calls))]
+
+        payload = []
+        payload_calls = []
+
+        for idx, (method, params) in enumerate(calls):
+            if idx in cached_responses:
+                continue
+
+            payload_calls.append((idx, method, params))
+            payload.append({
+                "jsonrpc": "2.0",
+                "method": method,
+                "params": params,
+                "id": self.request_id
+            })
+            self.request_id += 1
+
+        self.debug_message('RPC batch request #{}-#{}: {} calls'.format(
+            payload[0]['id'], payload[-1]['id'], len(payload))
+        )
+
+        self.rpc_stats['requests'] += 1
+        self.rpc_stats['calls'] += len(payload)
+
+        if self.websocket:
+            self.websocket.send(json.dumps(payload))
+
+            json_body = None
+            while type(json_body) is not list:
+                json_body = json.loads(self.websocket.recv())
+        else:
+            json_body = self.post_payload(payload)
+
+        responses = {message.get('id'): message for message in json_body}
+
+        results = dict(cached_responses)
+
+        for (idx, method, params), item in zip(payload_calls, payload):
+            results[idx] = responses.get(item['id'], {'error': 'No response'})
+
+            if self.response_cache and self.response_cache.is_cacheable(method, params):
+                self.response_cache.set(self.rpc_key(method, params), results[idx])
+
+        return [results[idx] for idx in range(len(calls))]
+
+    def get_block_hashes(self, block_numbers, batch_size=100):
+        """
+        Resolves block hashes by block number with batches of chain_getBlockHash calls
+
+        :param block_numbers: list of block numbers
+        :param batch_size: Amount of calls per batch request
+        :return: dict of block hash by block number, numbers without known block are omitted
+        """
+        block_hashes = {}
+
+        for offset in range(0, len(block_numbers), batch_size):
+            batch_numbers = block_numbers[offset:offset + batch_size]
+
+            responses = self.rpc_batch_request([('chain_getBlockHash', [nr]) for nr in batch_numbers])
+
+            for block_number, response in zip(batch_numbers, responses):
+                if response.get('result'):
+                    block_hashes[block_number] = response['result']
+
+        return block_hashes
+
+    @staticmethod
+    def get_events_storage_hash(metadata_decoder):
+        if metadata_decoder and metadata_decoder.version.index < 9:
+            return STORAGE_HASH_SYSTEM_EVENTS
+        return STORAGE_HASH_SYSTEM_EVENTS_V9
+
+    def get_block_events_data(self, block_hash, metadata_decoder):
+        """
+        Retrieves the undecoded System.Events storage of given block, storage key is determined by metadata version
+
+        :param block_hash:
+        :param metadata_decoder: Metadata of the runtime of the parent block
+        :return: hex string of SCALE encoded events
+        """
+        response = self.rpc_request(
+            "state_getStorageAt", [self.get_events_storage_hash(metadata_decoder), block_hash]
+        )
+
+        if 'error' in response:
+            raise SubstrateRequestException(response['error']['message'])
+
+        if not response.get('result'):
+            raise SubstrateRequestException("Error occurred during retrieval of events")
+
+        return response['result']
+
+    def is_prefetched(self, block_hash):
+        return self.rpc_key('chain_getBlock', [block_hash]) in self.prefetch_store
+
+    def prefetch_blocks(self, block_hash, window_size, runtime_versions=True):
+        """
+        Retrieves block, System.Events storage and runtime version of `block_hash` and its ancestors in a window of
+        `window_size` blocks, using one batch for the block hashes and one batch for the block data. Responses are put
+        in the prefetch store and served by `rpc_request()` for the identical method and params.
+
+        :param block_hash: Hash of the first (highest) block of the window
+        :param window_size: Amount of blocks in window
+        :param runtime_versions: Also retrieve runtime versions of the blocks in window
+        :return: list of block hashes in the window, ordered from `block_hash` towards genesis
+        """
+        self.prefetch_store = {}
+
+        header = self.rpc_request('chain_getHeader', [block_hash]).get('result')
+
+        if not header:
+            return []
+
+        block_number = int(header['number'], 16)
+
+        # Retrieve hashes of ancestors including the parent of the last block for its runtime version
+        ancestor_numbers = list(range(block_number - 1, max(block_number - window_size, 0) - 1, -1))
+
+        hash_responses = self.rpc_batch_request([('chain_getBlockHash', [nr]) for nr in ancestor_numbers])
+
+        window_hashes = [block_hash] + [response.get('result') for response in hash_responses]
+
+        if len(window_hashes) > 1 and window_hashes[1] != header['parentHash']:
+            # Block is not on the canonical chain, only prefetch the block itself
+            window_hashes = [block_hash]
+            block_hashes = [block_hash]
+        elif ancestor_numbers and ancestor_numbers[-1] > 0:
+            # Last hash is only used for the runtime version of the parent of the last block in window
+            block_hashes = window_hashes[:-1]
+        else:
+            block_hashes = window_hashes
+
+        events_storage_hash = self.get_events_storage_hash(self.metadata_decoder)
+
+        calls = []
+        for window_hash in block_hashes:
+            calls.append(('chain_getBlock', [window_hash]))
+            calls.append(('state_getStorageAt', [events_storage_hash, window_hash]))
+
+        if runtime_versions:
+            for window_hash in window_hashes:
+                calls.append(('chain_getRuntimeVersion', [window_hash]))
+
+        for (method, params), response in zip(calls, self.rpc_batch_request(calls)):
+            if 'error' not in response:
+                self.prefetch_store[self.rpc_key(method, params)] = response
+
+        # Verify chain of parent hashes and add headers to store
+        prefetched_hashes = []
+
+        for window_hash in block_hashes:
+            block_response = self.prefetch_store.get(self.rpc_key('chain_getBlock', [window_hash]))
+
+            if not block_response or not block_response.get('result'):
+                break
+
+            if prefetched_hashes and \
+                    self.prefetch_store[self.rpc_key('chain_getBlock', [prefetched_hashes[-1]])]['result']['block'][
+                        'header']['parentHash'] != window_hash:
+                break
+
+            self.prefetch_store[self.rpc_key('chain_getHeader', [window_hash])] = {
+                'jsonrpc': '2.0',
+                'result': block_response['result']['block']['header'],
+                'id': block_response.get('id')
+            }
+
+            prefetched_hashes.append(window_hash)
+
+        return prefetched_hashes
+
+    def prefetched_responses(self, block_hash, parent_hash=None):
+        """
+        Returns the responses in the prefetch store needed to process `block_hash`, so they can be handed over to
+        another HarvesterSubstrateInterface instance
+
+        :param block_hash:
+        :param parent_hash: When provided the runtime version of the parent block is included
+        :return: dict of responses by rpc key
+        """
+        responses = {
+            key: response for key, response in self.prefetch_store.items() if '"{}"'.format(block_hash) in key
+        }
+
+        if parent_hash:
+            parent_runtime_key = self.rpc_key('chain_getRuntimeVersion', [parent_hash])
+            if parent_runtime_key in self.prefetch_store:
+                responses[parent_runtime_key] = self.prefetch_store[parent_runtime_key]
+
+        return responses
@@ -0,0 +1,191 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  substrate_pool.py
+
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+from scalecodec.base import RuntimeConfiguration
+from scalecodec.type_registry import load_type_registry_file
+
+from app import settings
+from app.utils.substrate import HarvesterSubstrateInterface
+
+# Substrate pool of the current process, created on first use or by the worker_process_init hook
+substrate_pool = None
+
+
+class SubstratePool(object):
+    """
+    Initialized HarvesterSubstrateInterface instances of the current process, keyed by URL and type registry. Tasks and
+    requests borrow an idle instance instead of creating one and loading the type registries again.
+
+    Type registries are loaded in the process wide RuntimeConfiguration when an instance is created, so idle instances
+    are only reused for the key of the last created instance.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.idle = {}
+        self.active_key = None
+        self.lock = threading.Lock()
+
+        self.created = 0
+        self.borrowed = 0
+        self.reused = 0
+        self.init_time = 0
+
+    @staticmethod
+    def get_key(url, type_registry_preset, type_registry_file):
+        return url, type_registry_preset, type_registry_file
+
+    def create(self, key):
+        url, type_registry_preset, type_registry_file = key
+
+        start = time.time()
+
+        if type_registry_file:
+            custom_type_registry = load_type_registry_file(type_registry_file)
+        else:
+            custom_type_registry = None
+
+        substrate = HarvesterSubstrateInterface(
+            url=url,
+            type_registry=custom_type_registry,
+            type_registry_preset=type_registry_preset,
+            runtime_config=RuntimeConfiguration()
+        )
+        substrate.pool_key = key
+        substrate.pool_borrowed = False
+
+        with self.lock:
+            self.created += 1
+            self.init_time += time.time() - start
+            if self.active_key != key:
+                # Instances of other keys refer to type registries that are no longer loaded
+                self.idle = {}
+                self.active_key = key
+
+        return substrate
+
+    def borrow(self, url=None, type_registry_preset=None, type_registry_file=None, owner=None):
+        """
+        Returns an idle substrate interface for given URL and type registry, a new one if none available. Defaults are
+        SUBSTRATE_RPC_URL, TYPE_REGISTRY and TYPE_REGISTRY_FILE.
+
+        :param owner: optional object, the instance is released when the owner is garbage collected
+        :return: HarvesterSubstrateInterface
+        """
+        key = self.get_key(
+            url or settings.SUBSTRATE_RPC_URL,
+            type_registry_preset or settings.TYPE_REGISTRY,
+            settings.TYPE_REGISTRY_FILE if type_registry_file is None else type_registry_file
+        )
+
+        substrate = None
+
+        with self.lock:
+            self.borrowed += 1
+            if self.enabled and key == self.active_key and self.idle.get(key):
+                substrate = self.idle[key].pop()
+                self.reused += 1
+
+        if substrate is None:
+            substrate = self.create(key)
+
+        substrate.reset()
+        substrate.pool_borrowed = True
+
+        if owner is not None:
+            weakref.finalize(owner, self.release, substrate)
+
+        return substrate
+
+    def release(self, substrate):
+        """
+        Returns a borrowed substrate interface to the pool, releasing an instance twice has no effect
+        """
+        if not getattr(substrate, 'pool_borrowed', False):
+            return
+
+        substrate.pool_borrowed = False
+
+        # Prefetched responses are not kept alive while idle
+        substrate.reset()
+
+        with self.lock:
+            if self.enabled and substrate.pool_key == self.active_key:
+                self.idle.setdefault(substrate.pool_key, []).append(substrate)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'created': self.created,
+                'borrowed': self.borrowed,
+                'reused': self.reused,
+                'idle': sum(len(instances) for instances in self.idle.values()),
+                'initTimeMs': round(self.init_time / self.created * 1000, 2) if self.created else None
+            }
+
+
+def get_substrate_pool():
+    """
+    :return: SubstratePool of the current process
+    """
+    global substrate_pool
+
+    if substrate_pool is None:
+        substrate_pool = SubstratePool(enabled=settings.SUBSTRATE_POOL)
+
+    return substrate_pool
+
+
+def init_substrate_pool():
+    """
+    Creates the substrate pool of the current process with an idle instance for the default URL and type registry,
+    called when a worker process starts
+    """
+    pool = get_substrate_pool()
+    pool.release(pool.borrow())
+
+    return pool
+
+
+@contextmanager
+def pooled_substrate(url=None, type_registry_preset=None, type_registry_file=None):
+    """
+    Borrows a substrate interface for the duration of the with-block
+    """
+    pool = get_substrate_pool()
+    substrate = pool.borrow(url, type_registry_preset, type_registry_file)
+
+    try:
+        yield substrate
+    finally:
+        pool.release(substrate)
+
+
+def get_substrate_pool_stats():
+    """
+    :return: dict with created, borrowed and reused counters of the substrate pool of the current process
+    """
+    if substrate_pool:
+        return substrate_pool.stats()
@@ -0,0 +1,97 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  task_sizing.py
+
+from app import settings
+
+# Block cost measurements of the current worker process
+task_sizer = None
+
+
+class TaskSizer(object):
+    """
+    Determines the amount of blocks of an accumulation task from a moving average of the processing time per block,
+    so tasks take about `target_duration` seconds regardless of how heavy the blocks are.
+    """
+
+    # Weight of the latest block in the moving average
+    SMOOTHING = 0.1
+
+    def __init__(self, target_duration, min_blocks, max_blocks):
+        self.target_duration = target_duration
+        self.min_blocks = min_blocks
+        self.max_blocks = max_blocks
+        self.block_duration = None
+
+    @property
+    def enabled(self):
+        return self.target_duration > 0
+
+    def record(self, duration):
+        if self.block_duration is None:
+            self.block_duration = duration
+        else:
+            self.block_duration += self.SMOOTHING * (duration - self.block_duration)
+
+    def clamp(self, block_count):
+        return min(max(block_count, self.min_blocks), self.max_blocks)
+
+    def get_batch_size(self):
+        """
+        :return: amount of blocks expected to take the target duration, `min_blocks` when nothing is measured yet
+        """
+        if not self.block_duration:
+            return self.min_blocks
+
+        return self.clamp(int(self.target_duration / self.block_duration))
+
+    def should_stop(self, block_count, elapsed):
+        """
+        Stops a task early when the next block is expected to exceed the target duration, for blocks that are heavier
+        than the average the batch size is based on
+
+        :param block_count: blocks processed so far in task
+        :param elapsed: seconds since start of task
+        """
+        if block_count < self.min_blocks or not self.block_duration:
+            return False
+
+        return elapsed + self.block_duration > self.target_duration
+
+    def stats(self):
+        return {
+            'blockDurationMs': round(self.block_duration * 1000, 2) if self.block_duration is not None else None,
+            'targetDuration': self.target_duration
+        }
+
+
+def get_task_sizer():
+    """
+    :return: TaskSizer of the current worker process
+    """
+    global task_sizer
+
+    if task_sizer is None:
+        task_sizer = TaskSizer(
+            target_duration=settings.TASK_TARGET_DURATION,
+            min_blocks=settings.TASK_MIN_BLOCKS,
+            max_blocks=settings.TASK_MAX_BLOCKS
+        )
+
+    return task_sizer
@@ -0,0 +1,214 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  test_async_harvester.py
+
+import unittest
+from unittest import mock
+
+from sqlalchemy.exc import IntegrityError
+
+from app import settings
+from app.processors import async_harvester, converters
+from app.processors.async_harvester import AsyncPolkascanHarvesterService
+from app.processors.converters import BlockAlreadyAdded
+from app.utils.substrate import HarvesterSubstrateInterface
+
+CHAIN_HEAD = 10
+
+
+def block_hash(block_number):
+    return '0x{:064x}'.format(block_number)
+
+
+class StandInSubstrate(object):
+    """
+    Serves a chain of blocks 0..CHAIN_HEAD, responses in the prefetch store are used before the chain
+    """
+
+    rpc_key = staticmethod(HarvesterSubstrateInterface.rpc_key)
+    get_events_storage_hash = staticmethod(HarvesterSubstrateInterface.get_events_storage_hash)
+
+    def __init__(self, direct_calls):
+        self.direct_calls = direct_calls
+        self.prefetch_store = {}
+        self.metadata_decoder = None
+        self.http_session = None
+        self.metadata_cache = None
+
+    def response(self, result):
+        return {'jsonrpc': '2.0', 'result': result, 'id': 1}
+
+    def rpc_request(self, method, params):
+        response = self.prefetch_store.get(self.rpc_key(method, params))
+
+        if response is not None:
+            return response
+
+        self.direct_calls.append((method, params))
+
+        if method == 'chain_getBlockHash':
+            return self.response(block_hash(params[0]) if params[0] <= CHAIN_HEAD else None)
+
+        if method == 'chain_getBlock':
+            block_number = int(params[0], 16)
+            return self.response({
+                'block': {
+                    'header': {'number': hex(block_number), 'parentHash': block_hash(block_number - 1)},
+                    'extrinsics': []
+                }
+            })
+
+        if method == 'state_getStorageAt':
+            return self.response('0x00')
+
+        if method == 'chain_getRuntimeVersion':
+            return self.response({'specVersion': 1})
+
+        raise ValueError('Unexpected method {}'.format(method))
+
+    def get_runtime_state(self, module, storage_function, params=None, block_hash=None):
+        return {'result': '{}.{}@{}'.format(module, storage_function, block_hash)}
+
+
+class StandInPool(object):
+
+    def __init__(self):
+        self.direct_calls = []
+
+    def borrow(self, owner=None, **kwargs):
+        return StandInSubstrate(self.direct_calls)
+
+
+class StandInAsyncHarvester(AsyncPolkascanHarvesterService):
+    """
+    Records the stored blocks instead of decoding them
+    """
+
+    def __init__(self, *args, already_added=(), duplicates=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.already_added = set(already_added)
+        self.duplicates = set(duplicates)
+        self.added_order = []
+        self.prefetched_blocks = []
+        self.runtime_states = []
+
+    def add_block(self, block_hash):
+        block_number = int(block_hash, 16)
+
+        if block_number in self.already_added:
+            raise BlockAlreadyAdded(block_hash)
+
+        if block_number in self.duplicates:
+            raise IntegrityError('INSERT INTO data_block', {}, Exception('Duplicate entry'))
+
+        # Responses of the whole window are handed over before the first block of the window is stored
+        self.prefetched_blocks.append(sorted(
+            int(key.split('"')[1], 16) for key in self.substrate.prefetch_store
+            if key.startswith('chain_getBlock:')
+        ))
+
+        self.substrate.rpc_request('chain_getBlock', [block_hash])
+
+        # Processor hooks fan out storage calls from the database thread
+        self.runtime_states.append(self.async_storage.get_runtime_states([
+            {'module': 'System', 'storage_function': 'Account', 'block_hash': block_hash},
+            {'module': 'Balances', 'storage_function': 'TotalIssuance', 'block_hash': block_hash}
+        ]))
+
+        self.added_order.append(block_number)
+
+
+class AsyncHarvesterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = StandInPool()
+        self.patches = [
+            mock.patch.object(settings, 'SPEC_VERSION_INDEX', False),
+            mock.patch.object(async_harvester, 'get_substrate_pool', return_value=self.pool),
+            mock.patch.object(converters, 'get_substrate_pool', return_value=self.pool)
+        ]
+        for patch in self.patches:
+            patch.start()
+
+        self.db_session = mock.Mock()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def create_harvester(self, **kwargs):
+        return StandInAsyncHarvester(self.db_session, concurrency=2, window_size=2, **kwargs)
+
+    def test_window_order(self):
+        harvester = self.create_harvester()
+
+        add_count = harvester.accumulate_block_numbers([9, 8, 7, 6, 5])
+
+        self.assertEqual(add_count, 5)
+        self.assertEqual(harvester.added_order, [9, 8, 7, 6, 5])
+        self.assertEqual(self.db_session.commit.call_count, 5)
+        self.db_session.remove.assert_called_once_with()
+
+    def test_prefetch_handoff(self):
+        harvester = self.create_harvester()
+
+        harvester.accumulate_block_numbers([9, 8, 7, 6, 5])
+
+        # Every block is stored with the responses of its own window only
+        self.assertEqual(harvester.prefetched_blocks, [[8, 9], [8, 9], [6, 7], [6, 7], [5]])
+
+        # Blocks are only fetched by the window fetches, never on demand by add_block
+        self.assertEqual(
+            sorted(params[0] for method, params in self.pool.direct_calls if method == 'chain_getBlockHash'),
+            [5, 6, 7, 8, 9]
+        )
+        self.assertEqual(
+            sorted(int(params[0], 16) for method, params in self.pool.direct_calls if method == 'chain_getBlock'),
+            [5, 6, 7, 8, 9]
+        )
+
+    def test_runtime_states(self):
+        harvester = self.create_harvester()
+
+        harvester.accumulate_block_numbers([4, 3])
+
+        self.assertEqual(harvester.runtime_states, [
+            [
+                {'result': 'System.Account@{}'.format(block_hash(4))},
+                {'result': 'Balances.TotalIssuance@{}'.format(block_hash(4))}
+            ],
+            [
+                {'result': 'System.Account@{}'.format(block_hash(3))},
+                {'result': 'Balances.TotalIssuance@{}'.format(block_hash(3))}
+            ]
+        ])
+
+    def test_skipped_blocks(self):
+        harvester = self.create_harvester(already_added=[8], duplicates=[6])
+
+        add_count = harvester.accumulate_block_numbers([12, 11, 10, 9, 8, 7, 6, 5])
+
+        # Blocks 12 and 11 are beyond the chain head and have no block hash
+        self.assertEqual(add_count, 4)
+        self.assertEqual(harvester.added_order, [10, 9, 7, 5])
+        self.assertEqual(self.db_session.rollback.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
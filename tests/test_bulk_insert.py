@@ -0,0 +1,93 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  test_bulk_insert.py
+
+import unittest
+from unittest import mock
+
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+
+from app.models.base import BulkWriter, bulk_insert, has_consecutive_autoincrement
+from app.models.data import SearchIndex, Log
+
+
+def create_search_index(block_id, account_id):
+    return SearchIndex(block_id=block_id, index_type_id=1, account_id=account_id)
+
+
+class BulkInsertTestCase(unittest.TestCase):
+
+    def setUp(self):
+        engine = sa.create_engine('sqlite://')
+        SearchIndex.__table__.create(engine)
+        Log.__table__.create(engine)
+
+        self.session = sessionmaker(bind=engine, autoflush=False, autocommit=False)()
+
+        # Ids already taken by rows of another writer
+        self.session.add(create_search_index(1, 'other'))
+        self.session.add(create_search_index(1, 'other'))
+        self.session.flush()
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_autoincrement_ids(self):
+        search_indices = [create_search_index(2, 'account-{}'.format(nr)) for nr in range(5)]
+
+        with bulk_insert(self.session, [SearchIndex, Log]):
+            for search_index in search_indices:
+                search_index.save(self.session)
+
+            Log(block_id=2, log_idx=0, type_id=0, type='Other', data={}).save(self.session)
+
+        self.assertFalse(has_consecutive_autoincrement(self.session))
+
+        # Ids of the objects match their rows
+        for search_index in search_indices:
+            self.assertEqual(
+                self.session.query(SearchIndex.account_id).filter_by(id=search_index.id).scalar(),
+                search_index.account_id
+            )
+
+        self.assertEqual(len(set(search_index.id for search_index in search_indices)), 5)
+        self.assertEqual(self.session.query(Log).count(), 1)
+
+    def test_consecutive_autoincrement(self):
+        session = mock.Mock(info={'consecutive_autoincrement': True})
+        session.execute.side_effect = [mock.Mock(lastrowid=10), mock.Mock(lastrowid=20)]
+
+        search_indices = [create_search_index(2, 'account-{}'.format(nr)) for nr in range(3)]
+
+        bulk_writer = BulkWriter([SearchIndex])
+        bulk_writer.MAX_INSERT_ROWS = 2
+
+        for search_index in search_indices:
+            bulk_writer.add(search_index)
+
+        bulk_writer.flush(session)
+
+        # Multi-row INSERT per chunk, ids follow LAST_INSERT_ID() of the chunk
+        self.assertEqual(session.execute.call_count, 2)
+        self.assertEqual([search_index.id for search_index in search_indices], [10, 11, 20])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,331 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  test_follower.py
+
+import base64
+import hashlib
+import json
+import socket
+import struct
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from sqlalchemy.exc import OperationalError
+
+from app import settings
+from app import follower
+from app.follower import HeadFollower
+from app.processors.converters import BlockAlreadyAdded
+
+
+def block_hash(block_number):
+    return '0x{:064x}'.format(block_number)
+
+
+def recv_exact(conn, length):
+    data = b''
+    while len(data) < length:
+        chunk = conn.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed')
+        data += chunk
+    return data
+
+
+def read_frame(conn):
+    """
+    :return: tuple (opcode, payload) of a masked client frame
+    """
+    first, second = recv_exact(conn, 2)
+    length = second & 0x7f
+
+    if length == 126:
+        length = struct.unpack('>H', recv_exact(conn, 2))[0]
+    elif length == 127:
+        length = struct.unpack('>Q', recv_exact(conn, 8))[0]
+
+    mask = recv_exact(conn, 4)
+    payload = recv_exact(conn, length)
+
+    return first & 0x0f, bytes(byte ^ mask[nr % 4] for nr, byte in enumerate(payload))
+
+
+def send_frame(conn, payload, opcode=0x1):
+    if isinstance(payload, str):
+        payload = payload.encode()
+
+    if len(payload) < 126:
+        header = struct.pack('>BB', 0x80 | opcode, len(payload))
+    else:
+        header = struct.pack('>BBH', 0x80 | opcode, 126, len(payload))
+
+    conn.sendall(header + payload)
+
+
+class StandInNode(object):
+    """
+    WebSocket server answering head subscriptions like a Substrate node. Every connection announces the heads of the
+    next script, connections are dropped after that except the last one.
+    """
+
+    def __init__(self, scripts):
+        self.scripts = list(scripts)
+        self.subscribe_methods = []
+        self.connections = 0
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'ws://127.0.0.1:{}'.format(self.server.getsockname()[1])
+
+    def serve(self):
+        while True:
+            try:
+                conn, address = self.server.accept()
+            except OSError:
+                return
+
+            self.connections += 1
+            threading.Thread(target=self.handle, args=(conn, self.connections), daemon=True).start()
+
+    def handshake(self, conn):
+        request = b''
+        while b'\r\n\r\n' not in request:
+            request += conn.recv(1024)
+
+        key = [
+            line.split(':', 1)[1].strip() for line in request.decode().split('\r\n')
+            if line.lower().startswith('sec-websocket-key:')
+        ][0]
+
+        accept = base64.b64encode(
+            hashlib.sha1((key + '258EAFA5-E914-47DA-95CA-C5AB0DC85B11').encode()).digest()
+        ).decode()
+
+        conn.sendall((
+            'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+            'Sec-WebSocket-Accept: {}\r\n\r\n'.format(accept)
+        ).encode())
+
+    def handle(self, conn, connection_nr):
+        try:
+            self.handshake(conn)
+
+            opcode, payload = read_frame(conn)
+            request = json.loads(payload.decode())
+            self.subscribe_methods.append(request['method'])
+
+            subscription_id = 'subscription-{}'.format(connection_nr)
+            send_frame(conn, json.dumps({'jsonrpc': '2.0', 'result': subscription_id, 'id': request['id']}))
+
+            for block_number in self.scripts[connection_nr - 1]:
+                send_frame(conn, json.dumps({
+                    'jsonrpc': '2.0',
+                    'method': 'chain_finalizedHead',
+                    'params': {
+                        'subscription': subscription_id,
+                        'result': {'number': hex(block_number), 'parentHash': block_hash(block_number - 1)}
+                    }
+                }))
+
+            if connection_nr < len(self.scripts):
+                return
+
+            # Keep the last connection open until the client closes it
+            while opcode != 0x8:
+                opcode, payload = read_frame(conn)
+
+            send_frame(conn, payload, opcode=0x8)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def close(self):
+        self.server.close()
+
+
+class StandInHarvester(object):
+    """
+    Chain of blocks 0..head of which `added` are stored, blocks are identified by the hash of their number
+    """
+
+    def __init__(self, added):
+        self.added = set(added)
+        self.added_order = []
+        self.substrate = self
+
+    def rpc_request(self, method, params):
+        assert method == 'chain_getBlockHash'
+        return {'jsonrpc': '2.0', 'result': block_hash(params[0]), 'id': 1}
+
+    def add_block(self, hash):
+        block_number = int(hash, 16)
+
+        if block_number in self.added:
+            raise BlockAlreadyAdded(hash)
+
+        self.added.add(block_number)
+        self.added_order.append(block_number)
+
+        return SimpleNamespace(id=block_number, hash=hash, parent_hash=block_hash(block_number - 1))
+
+
+class HeadFollowerTestCase(unittest.TestCase):
+
+    def run_follower(self, scripts, expected_heads):
+        node = StandInNode(scripts)
+        heads = []
+
+        def on_head(header):
+            heads.append(int(header['number'], 16))
+            if len(heads) == expected_heads:
+                head_follower.stop()
+
+        head_follower = HeadFollower(node.url, on_head=on_head, reconnect_delay=0.01)
+
+        thread = threading.Thread(target=head_follower.run, daemon=True)
+        thread.start()
+        thread.join(timeout=10)
+
+        node.close()
+
+        self.assertFalse(thread.is_alive(), 'Follower did not stop')
+
+        return node, heads
+
+    def test_subscription(self):
+        node, heads = self.run_follower([[10, 11, 12]], expected_heads=3)
+
+        self.assertEqual(heads, [10, 11, 12])
+        self.assertEqual(node.subscribe_methods, ['chain_subscribeFinalizedHeads'])
+
+    def test_reconnect(self):
+        node, heads = self.run_follower([[10], [], [15]], expected_heads=2)
+
+        self.assertEqual(heads, [10, 15])
+        self.assertEqual(node.connections, 3)
+        self.assertEqual(node.subscribe_methods, ['chain_subscribeFinalizedHeads'] * 3)
+
+
+class HeadFollowerGapTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.patches = [
+            mock.patch.object(settings, 'BLOCK_FETCH_WINDOW', 1),
+            mock.patch.object(follower, 'accumulate_block_recursive')
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def create_follower(self, added, max_gap):
+        head_follower = HeadFollower('ws://127.0.0.1:1', max_gap=max_gap)
+        head_follower.harvester = StandInHarvester(added)
+        head_follower.db_session = mock.Mock()
+        return head_follower
+
+    def test_gap_fill(self):
+        head_follower = self.create_follower(added=range(0, 11), max_gap=10)
+
+        head_follower.add_head({'number': hex(14)})
+
+        self.assertEqual(head_follower.harvester.added_order, [14, 13, 12, 11])
+        self.assertEqual(head_follower.db_session.commit.call_count, 4)
+        follower.accumulate_block_recursive.apply_async.assert_not_called()
+
+    def test_gap_larger_than_max_gap(self):
+        head_follower = self.create_follower(added=range(0, 6), max_gap=3)
+
+        head_follower.add_head({'number': hex(14)})
+
+        self.assertEqual(head_follower.harvester.added_order, [14, 13, 12])
+        follower.accumulate_block_recursive.apply_async.assert_called_once_with(
+            (block_hash(11),), queue=follower.QUEUE_TIP
+        )
+
+    def test_reached_genesis(self):
+        head_follower = self.create_follower(added=[], max_gap=10)
+
+        head_follower.add_head({'number': hex(2)})
+
+        self.assertEqual(head_follower.harvester.added_order, [2, 1, 0])
+        follower.accumulate_block_recursive.apply_async.assert_not_called()
+
+
+class HeadFollowerDatabaseErrorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.patch = mock.patch.object(settings, 'BLOCK_FETCH_WINDOW', 1)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+
+    def test_database_error(self):
+        node = StandInNode([[10], [11]])
+        harvester = StandInHarvester(added=range(0, 10))
+        db_session = mock.Mock()
+        init_attempts = []
+
+        head_follower = HeadFollower(node.url, max_gap=10, reconnect_delay=0.01)
+
+        def init_harvester():
+            init_attempts.append(len(init_attempts) + 1)
+            head_follower.db_session = db_session
+
+            if len(init_attempts) == 1:
+                raise OperationalError('SELECT 1', {}, Exception('Lost connection to MySQL server'))
+
+            head_follower.harvester = harvester
+
+        def on_head(header):
+            head_follower.add_head(header)
+            head_follower.stop()
+
+        head_follower.init_harvester = init_harvester
+        head_follower.on_head = on_head
+
+        thread = threading.Thread(target=head_follower.run, daemon=True)
+        thread.start()
+        thread.join(timeout=10)
+
+        node.close()
+
+        self.assertFalse(thread.is_alive(), 'Follower did not stop')
+
+        # Head 10 is added as parent of the first head after the database error
+        self.assertEqual(init_attempts, [1, 2])
+        self.assertEqual(node.connections, 2)
+        self.assertEqual(harvester.added_order, [11, 10])
+        db_session.rollback.assert_any_call()
+
+
+if __name__ == '__main__':
+    unittest.main()
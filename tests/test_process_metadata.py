@@ -0,0 +1,161 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  test_process_metadata.py
+
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import sqlalchemy as sa
+from sqlalchemy import event
+from sqlalchemy.dialects.mysql import LONGTEXT, LONGBLOB
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import sessionmaker
+
+from app import settings
+from app.models.base import BaseModel
+from app.models.data import Runtime, RuntimeModule
+from app.processors import converters
+from app.processors.converters import PolkascanHarvesterService
+
+
+@compiles(LONGTEXT, 'sqlite')
+def compile_longtext(element, compiler, **kw):
+    return 'TEXT'
+
+
+@compiles(LONGBLOB, 'sqlite')
+def compile_longblob(element, compiler, **kw):
+    return 'BLOB'
+
+
+def create_engine():
+    engine = sa.create_engine('sqlite://')
+
+    # Let SQLAlchemy emit BEGIN, pysqlite doesn't support SAVEPOINT otherwise
+    @event.listens_for(engine, 'connect')
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def do_begin(connection):
+        connection.execute('BEGIN')
+
+    BaseModel.metadata.create_all(engine, tables=[
+        table for table in BaseModel.metadata.sorted_tables if table.name.startswith('runtime')
+    ])
+
+    return engine
+
+
+class StandInSubstrate(object):
+
+    def __init__(self):
+        self.metadata_cache = {}
+        self.metadata_decoder = SimpleNamespace(
+            data='0x6d657461', value={'magicNumber': 1635018093}, version=None,
+            metadata=SimpleNamespace(modules=[])
+        )
+
+    def get_block_runtime_version(self, block_hash):
+        return {'implName': 'stand-in', 'implVersion': 1, 'specName': 'stand-in', 'apis': [], 'authoringVersion': 1}
+
+    def get_type_registry(self, block_hash=None):
+        return {}
+
+
+class ProcessMetadataTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.patches = [
+            mock.patch.object(settings, 'SPEC_VERSION_INDEX', False),
+            mock.patch.object(converters, 'get_substrate_pool')
+        ]
+        for patch in self.patches:
+            patch.start()
+
+        converters.get_substrate_pool.return_value.borrow.return_value = StandInSubstrate()
+
+        self.db_session = sessionmaker(bind=create_engine(), autoflush=False, autocommit=False)()
+        self.harvester = PolkascanHarvesterService(self.db_session)
+
+    def tearDown(self):
+        self.db_session.close()
+
+        for patch in self.patches:
+            patch.stop()
+
+    def store_concurrent_runtime(self, spec_version):
+        """
+        Stores the spec version between the lookup of process_metadata and its insert, as a concurrent worker would
+        """
+        query = Runtime.query
+
+        def concurrent_query(session):
+            Runtime.query = query
+            session.execute(Runtime.__table__.insert(), {'id': spec_version, 'spec_version': spec_version})
+            return mock.Mock(**{'get.return_value': None})
+
+        Runtime.query = concurrent_query
+        self.addCleanup(setattr, Runtime, 'query', query)
+
+    def test_store_metadata(self):
+        self.harvester.process_metadata(1, '0x01')
+        self.db_session.commit()
+
+        runtime = Runtime.query(self.db_session).get(1)
+
+        self.assertEqual(runtime.spec_name, 'stand-in')
+        self.assertEqual(runtime.json_metadata_decoded, {'magicNumber': 1635018093})
+        self.assertIn(1, self.harvester.metadata_store)
+
+    def test_duplicate_spec_version(self):
+        # Pending row of the caller, e.g. a block of the current group commit
+        self.db_session.add(RuntimeModule(spec_version=0, module_id='system', name='System', count_call_functions=0,
+                                          count_storage_functions=0, count_events=0, count_constants=0,
+                                          count_errors=0))
+
+        self.store_concurrent_runtime(1)
+
+        self.harvester.process_metadata(1, '0x01')
+
+        self.assertIs(self.harvester.metadata_store[1], self.harvester.substrate.metadata_decoder)
+
+        # Only the savepoint is rolled back, the session remains usable and keeps the pending row
+        self.db_session.commit()
+
+        self.assertEqual(RuntimeModule.query(self.db_session).filter_by(spec_version=0).count(), 1)
+        self.assertEqual(Runtime.query(self.db_session).count(), 1)
+        self.assertIsNone(Runtime.query(self.db_session).get(1).spec_name)
+
+    def test_duplicate_without_runtime(self):
+        self.db_session.execute(Runtime.__table__.insert(), {'id': 1, 'spec_version': 1})
+
+        # Integrity errors are raised when the spec version is not found afterwards
+        with mock.patch.object(Runtime, 'query') as runtime_query:
+            runtime_query.return_value.get.return_value = None
+
+            with self.assertRaises(sa.exc.IntegrityError):
+                self.harvester.process_metadata(1, '0x01')
+
+        self.assertNotIn(1, self.harvester.metadata_store)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+#  Polkascan PRE Harvester
+#
+#  Copyright 2018-2020 openAware BV (NL).
+#  This file is part of Polkascan.
+#
+#  Polkascan is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Polkascan is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Polkascan. If not, see <http://www.gnu.org/licenses/>.
+#
+#  test_rpc_pool.py
+
+import threading
+import time
+import unittest
+
+import requests
+
+from app.utils.rpc_pool import RPCEndpointPool
+
+PAYLOAD = {"jsonrpc": "2.0", "method": "chain_getBlockHash", "params": [1], "id": 1}
+
+
+class StandInResponse(object):
+
+    def __init__(self, body):
+        self.status_code = 200
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class StandInEndpoint(object):
+    """
+    HTTP session of an endpoint answering after `delay` seconds, or failing with `error`
+    """
+
+    def __init__(self, name, delay=0, error=None):
+        self.name = name
+        self.delay = delay
+        self.error = error
+        self.posted_at = []
+        self.released = threading.Event()
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        self.posted_at.append(time.time())
+
+        # Slow requests end early when the test is done
+        self.released.wait(self.delay)
+
+        if self.error:
+            raise self.error
+
+        return StandInResponse({"jsonrpc": "2.0", "result": self.name, "id": 1})
+
+
+class RPCEndpointPoolTestCase(unittest.TestCase):
+
+    def create_pool(self, endpoints, hedge_delay=0.05, hedge_latency_factor=3):
+        pool = RPCEndpointPool(
+            ['http://{}:9933/'.format(endpoint.name) for endpoint in endpoints],
+            hedge_delay=hedge_delay, hedge_latency_factor=hedge_latency_factor, retry_interval=30, max_workers=4
+        )
+
+        for pool_endpoint, endpoint in zip(pool.endpoints, endpoints):
+            pool_endpoint.http_session = endpoint
+            self.addCleanup(endpoint.released.set)
+
+        return pool
+
+    def test_select_endpoint(self):
+        pool = self.create_pool([StandInEndpoint('a'), StandInEndpoint('b'), StandInEndpoint('c')])
+        endpoint_a, endpoint_b, endpoint_c = pool.endpoints
+
+        endpoint_a.latency = 0.01
+        endpoint_a.in_flight = 3
+        endpoint_b.latency = 0.03
+        endpoint_c.latency = 0.02
+        endpoint_c.healthy = False
+        endpoint_c.unhealthy_until = time.time() + 30
+
+        # Expected wait latency * (in_flight + 1) is 0.04 for a and 0.03 for b, c is skipped while unhealthy
+        self.assertIs(pool.select_endpoint(), endpoint_b)
+        self.assertEqual(endpoint_b.in_flight, 1)
+
+        # b now expects 0.06
+        self.assertIs(pool.select_endpoint(), endpoint_a)
+        self.assertEqual(endpoint_a.in_flight, 4)
+
+        self.assertIs(pool.select_endpoint(exclude=[endpoint_a, endpoint_b]), None)
+
+        # Unknown latency counts as the default latency
+        endpoint_c.unhealthy_until = 0
+        endpoint_c.latency = None
+
+        self.assertIs(pool.select_endpoint(exclude=[endpoint_a]), endpoint_c)
+
+    def assert_hedged_after(self, pool, hedge_delay):
+        slow, fast = [endpoint.http_session for endpoint in pool.endpoints]
+
+        start = time.time()
+        response = pool.request(PAYLOAD)
+
+        self.assertEqual(response['result'], 'fast')
+        self.assertEqual(len(slow.posted_at), 1)
+        self.assertEqual(len(fast.posted_at), 1)
+
+        self.assertGreaterEqual(fast.posted_at[0] - start, hedge_delay)
+        self.assertLess(fast.posted_at[0] - start, hedge_delay + 0.15)
+        self.assertEqual(pool.endpoints[1].hedged, 1)
+
+    def test_hedge_delay(self):
+        pool = self.create_pool([StandInEndpoint('slow', delay=2), StandInEndpoint('fast')], hedge_delay=0.1)
+
+        # Latency times factor is below the hedge delay
+        pool.endpoints[0].latency = 0.01
+        pool.endpoints[1].latency = 0.02
+
+        self.assert_hedged_after(pool, 0.1)
+
+    def test_hedge_latency_factor(self):
+        pool = self.create_pool([StandInEndpoint('slow', delay=2), StandInEndpoint('fast')], hedge_delay=0.05)
+
+        # Hedge after 3 times the average latency of the endpoint
+        pool.endpoints[0].latency = 0.1
+        pool.endpoints[1].latency = 0.2
+
+        self.assert_hedged_after(pool, 0.3)
+
+    def test_failover(self):
+        failing = StandInEndpoint('failing', error=requests.ConnectionError('Connection refused'))
+        working = StandInEndpoint('working')
+
+        pool = self.create_pool([failing, working], hedge_delay=1)
+        pool.endpoints[0].latency = 0.01
+        pool.endpoints[1].latency = 0.02
+
+        response = pool.request(PAYLOAD)
+
+        self.assertEqual(response['result'], 'working')
+        self.assertEqual(len(failing.posted_at), 1)
+        self.assertEqual(len(working.posted_at), 1)
+
+        # Failed endpoint is skipped by the next request
+        self.assertFalse(pool.endpoints[0].healthy)
+        self.assertEqual(pool.endpoints[0].errors, 1)
+        self.assertIs(pool.select_endpoint(), pool.endpoints[1])
+
+    def test_all_endpoints_fail(self):
+        endpoints = [
+            StandInEndpoint('a', error=requests.ConnectionError('Connection refused')),
+            StandInEndpoint('b', error=requests.Timeout('Read timed out'))
+        ]
+
+        pool = self.create_pool(endpoints, hedge_delay=1)
+        pool.endpoints[0].latency = 0.01
+        pool.endpoints[1].latency = 0.02
+
+        # Error of the last endpoint is raised as is
+        with self.assertRaises(requests.Timeout) as context:
+            pool.request(PAYLOAD)
+
+        self.assertEqual(context.exception.endpoint_url, 'http://b:9933/')
+        self.assertEqual([len(endpoint.posted_at) for endpoint in endpoints], [1, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()